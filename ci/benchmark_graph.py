@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the dependency resolution on synthetic recipe graphs.
+
+Generates graphs of recipes with alternative dependencies and conflicts,
+and times how long :class:`~pythonforandroid.graph.DependencyResolver`
+takes to choose and order their recipes:
+```
+python -m ci.benchmark_graph 100 300 600
+```
+"""
+import random
+import sys
+import time
+from unittest import mock
+
+from pythonforandroid.graph import DependencyResolver, fix_deplist
+from pythonforandroid.recipeindex import RecipeMetadata
+
+
+def make_recipes(size, seed=0):
+    """
+    Returns ``size`` synthetic recipes by name, and requirements pulling in
+    most of them.
+
+    About a third of the recipes depend on ``recipe1``, which conflicts with
+    the required ``recipe0``, so they can't be built. The others may depend
+    on those as the first of two alternatives, so the resolver has to
+    backtrack to choose the second one.
+    """
+    rand = random.Random(seed)
+    recipes = {
+        'recipe0': RecipeMetadata('recipe0'),
+        'recipe1': RecipeMetadata('recipe1', conflicts=['recipe0']),
+    }
+    good = ['recipe0']
+    bad = ['recipe1']
+    for index in range(2, size):
+        name = 'recipe{}'.format(index)
+        depends = [rand.choice(good) for _ in range(rand.randint(1, 3))]
+        if rand.random() < 0.3:
+            bad.append(name)
+            depends.append('recipe1')
+        else:
+            good.append(name)
+            if rand.random() < 0.3:
+                depends.append((rand.choice(bad), rand.choice(good[:-1])))
+        recipes[name] = RecipeMetadata(name, depends=depends)
+    requirements = ['recipe0'] + good[-max(1, size // 10):] + [
+        (rand.choice(bad), rand.choice(good)) for _ in range(5)]
+    return recipes, requirements
+
+
+def resolve(recipes, requirements):
+    """
+    Returns the build order of ``recipes`` chosen for ``requirements``.
+    """
+    def get_recipe_metadata(name, ctx):
+        if name not in recipes:
+            raise ValueError('Recipe does not exist: {}'.format(name))
+        return recipes[name]
+
+    with mock.patch(
+            'pythonforandroid.graph.get_recipe_metadata',
+            get_recipe_metadata):
+        return DependencyResolver(None, fix_deplist(requirements)).resolve()
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [100, 300, 600]
+    for size in sizes:
+        recipes, requirements = make_recipes(size)
+        start = time.time()
+        order = resolve(recipes, requirements)
+        print('{} recipes: chose {} in {:.3f}s'.format(
+            size, len(order), time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+In-process extraction of recipe source archives.
+
+Archives are read in a single streaming pass, with their root directory
+(e.g. ``Python-3.7.4/``) stripped on the fly, instead of being listed and
+extracted separately with external tools.
+"""
+
+from os import chmod, makedirs, rename, symlink
+from os.path import dirname, exists, join, normpath
+from shutil import copyfileobj, rmtree
+from tempfile import mkdtemp
+import stat
+import tarfile
+import zipfile
+
+
+TAR_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+ZIP_EXTENSIONS = ('.zip', )
+
+
+def is_archive(filename):
+    '''Returns whether :func:`extract_archive` knows how to extract
+    ``filename``.'''
+    return filename.endswith(TAR_EXTENSIONS + ZIP_EXTENSIONS)
+
+
+def _split_root(name):
+    '''Returns the root directory of an archive member name and the rest of
+    the name, or None and the name itself for top level files.'''
+    name = name.lstrip('/')
+    while name.startswith('./'):
+        name = name[2:]
+    root, sep, rest = name.partition('/')
+    if not sep:
+        return None, name
+    return root, rest
+
+
+class _RootStripper:
+    '''Strips the root directory of the first member from the names of
+    all the members that share it.'''
+
+    def __init__(self):
+        self.root = None
+        self.first = True
+
+    def __call__(self, name, is_dir=False):
+        root, rest = _split_root(name)
+        if self.first:
+            self.first = False
+            if root is None and is_dir:
+                root, rest = rest, ''
+            self.root = root
+        elif root is None and is_dir and rest == self.root:
+            rest = ''
+        if root is None or root != self.root:
+            # members outside the root directory are kept as they are
+            return name.lstrip('/')
+        return rest
+
+
+def _extract_tar(filename, target_dir):
+    strip = _RootStripper()
+    # streaming mode ('r|*'), so the archive is decompressed only once
+    with tarfile.open(filename, 'r|*') as tar:
+        if hasattr(tarfile, 'tar_filter'):
+            # same rules as the tar command: no absolute paths or members
+            # escaping the target directory
+            tar.extraction_filter = tarfile.tar_filter
+        directories = []
+        for member in tar:
+            member.name = strip(member.name, member.isdir())
+            if member.islnk():
+                member.linkname = strip(member.linkname)
+            if not member.name:
+                continue
+            if member.isdir():
+                # like extractall(), the mode and mtime of the directories
+                # are only set once their content is extracted, in case
+                # they are read-only
+                directories.append(member)
+                tar.extract(member, target_dir, set_attrs=False)
+            else:
+                tar.extract(member, target_dir)
+        directories.sort(key=lambda member: member.name, reverse=True)
+        for member in directories:
+            path = join(target_dir, member.name)
+            if hasattr(tarfile, 'tar_filter'):
+                member = tarfile.tar_filter(member, target_dir)
+            tar.chown(member, path, False)
+            tar.utime(member, path)
+            tar.chmod(member, path)
+
+
+def _extract_zip(filename, target_dir):
+    strip = _RootStripper()
+    target_dir = normpath(target_dir)
+    with zipfile.ZipFile(filename) as zip_file:
+        for info in zip_file.infolist():
+            name = strip(info.filename, info.is_dir())
+            if not name:
+                continue
+            path = normpath(join(target_dir, name))
+            if not path.startswith(target_dir + '/'):
+                raise ValueError('{} tries to extract {} outside of the '
+                                 'target directory'.format(filename, name))
+            # zip files made on unix keep the file mode in the upper bits
+            mode = info.external_attr >> 16
+            if info.is_dir():
+                makedirs(path, exist_ok=True)
+                continue
+            makedirs(dirname(path), exist_ok=True)
+            if stat.S_ISLNK(mode):
+                symlink(zip_file.read(info).decode('utf-8'), path)
+                continue
+            with zip_file.open(info) as source, open(path, 'wb') as dest:
+                copyfileobj(source, dest, 1024 * 1024)
+            if mode:
+                chmod(path, stat.S_IMODE(mode))
+
+
+def extract_archive(filename, target_dir):
+    '''Extracts the tar or zip archive ``filename`` to ``target_dir``,
+    stripping its root directory, if any.
+
+    The archive is first extracted into a temporary directory next to
+    ``target_dir``, which is renamed once complete, so an interrupted
+    extraction never leaves a partial ``target_dir`` behind.
+    '''
+    if filename.endswith(ZIP_EXTENSIONS):
+        extract = _extract_zip
+    elif filename.endswith(TAR_EXTENSIONS):
+        extract = _extract_tar
+    else:
+        raise ValueError('Unknown archive format: {}'.format(filename))
+    parent_dir = dirname(normpath(target_dir))
+    makedirs(parent_dir, exist_ok=True)
+    temp_dir = mkdtemp(prefix='.extract-', dir=parent_dir)
+    try:
+        extract(filename, temp_dir)
+        # mkdtemp makes the directory private
+        chmod(temp_dir, 0o755)
+        if exists(target_dir):
+            rmtree(target_dir)
+        rename(temp_dir, target_dir)
+    except BaseException:
+        rmtree(temp_dir, ignore_errors=True)
+        raise
@@ -46,6 +46,13 @@ class Arch:
         '-Wl,-Bsymbolic-functions',
     ]
 
+    env_variables = (
+        'PATH', 'USE_CCACHE', 'LC_ALL', 'TZ', 'SOURCE_DATE_EPOCH',
+        'PYTHONHASHSEED', 'BUILD_DATE', 'BUILD_TIME',
+    )
+    '''The variables of our own environment :meth:`get_env` depends on
+    (besides the `CCACHE_*` ones).'''
+
     def __init__(self, ctx):
         self.ctx = ctx
 
@@ -55,6 +62,9 @@ class Arch:
         # linked for all others.
         self.extra_global_link_paths = []
 
+        # The environments computed by get_env, see _get_env_key
+        self._env_cache = {}
+
     def __str__(self):
         return self.arch
 
@@ -138,6 +148,44 @@ class Arch:
         return join(self.clang_path, compiler)
 
     def get_env(self, with_flags_in_cc=True):
+        '''Returns the environment to build for this arch with.
+
+        It is computed once, and then cached until the build context
+        changes (see :meth:`invalidate_env`). Each call returns a new copy,
+        that the caller is free to modify.
+        '''
+        key = self._get_env_key(with_flags_in_cc)
+        env = self._env_cache.get(key)
+        if env is None:
+            env = self._env_cache[key] = self._compute_env(with_flags_in_cc)
+        return dict(env)
+
+    def invalidate_env(self):
+        '''Forgets the environments returned by :meth:`get_env`, e.g. after
+        changing the build context in a way it can't detect.'''
+        self._env_cache.clear()
+
+    def _get_env_key(self, with_flags_in_cc):
+        '''(internal) Returns the state of the build context and of our
+        own environment the result of :meth:`get_env` depends on.'''
+        ctx = self.ctx
+        python_recipe = ctx.python_recipe
+        return (
+            with_flags_in_cc,
+            tuple(self.extra_global_link_paths),
+            ctx.ndk_dir, ctx.ndk_api, ctx.ndk_sysroot, ctx.toolchain_version,
+            ctx.ccache, ctx.build_dir, ctx.libs_dir,
+            getattr(getattr(ctx.bootstrap, 'distribution', None), 'name', None),
+            getattr(python_recipe, 'name', None),
+            getattr(python_recipe, 'version', None),
+            tuple(sorted(
+                (key, value) for key, value in environ.items()
+                if key in self.env_variables or key.startswith('CCACHE_'))),
+        )
+
+    def _compute_env(self, with_flags_in_cc):
+        '''(internal) Computes the environment returned by
+        :meth:`get_env`, without modifying our own.'''
         env = {}
 
         # CFLAGS/CXXFLAGS: the processor flags
@@ -190,12 +238,12 @@ class Arch:
             )
 
         # Compiler: `CC` and `CXX` (and make sure that the compiler exists)
-        environ['PATH'] = '{clang_path}:{path}'.format(
+        env['PATH'] = '{clang_path}:{path}'.format(
             clang_path=self.clang_path, path=environ['PATH']
         )
-        cc = find_executable(self.clang_exe, path=environ['PATH'])
+        cc = find_executable(self.clang_exe, path=env['PATH'])
         if cc is None:
-            print('Searching path are: {!r}'.format(environ['PATH']))
+            print('Searching path are: {!r}'.format(env['PATH']))
             raise BuildInterruptingException(
                 'Couldn\'t find executable for CC. This indicates a '
                 'problem locating the {} executable in the Android '
@@ -251,8 +299,6 @@ class Arch:
             ),
         )
 
-        env['PATH'] = environ['PATH']
-
         # for reproducible builds
         if 'SOURCE_DATE_EPOCH' in environ:
             for k in 'LC_ALL TZ SOURCE_DATE_EPOCH PYTHONHASHSEED BUILD_DATE BUILD_TIME'.split():
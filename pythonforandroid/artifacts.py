@@ -0,0 +1,219 @@
+"""
+Cache of built recipes.
+
+When ``$P4A_ARTIFACT_CACHE`` is set, the outputs of each recipe build are
+stored in a cache, keyed by the build fingerprint of the recipe (see
+:mod:`pythonforandroid.fingerprint`), and later builds with the same
+fingerprint restore them instead of building the recipe again.
+
+The outputs of a build are the files it added or changed in the recipe
+build dir, its ``objects_<name>`` dir, and the libs and python installs
+dirs of the arch. The cache is either a directory (possibly on a shared
+filesystem), or an http(s) url the artifacts are downloaded from with GET
+and uploaded to with PUT requests.
+
+Only files are restored: a recipe whose build also sets up the build
+context (e.g. hostpython3 setting ``ctx.hostpython``), or installs files
+out of its outputs (e.g. the python recipes installed in the hostpython
+too), does it again in
+:meth:`~pythonforandroid.recipe.Recipe.postrestore_arch`.
+"""
+
+from os import environ, lstat, makedirs, replace, unlink, walk
+from os.path import exists, join, relpath
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+import shutil
+import tarfile
+import tempfile
+
+from pythonforandroid.download import USER_AGENT
+from pythonforandroid.logger import debug, info, warning
+
+
+ARTIFACT_CACHE_VARIABLE = 'P4A_ARTIFACT_CACHE'
+
+
+class DirectoryArtifactCache:
+    '''Keeps the artifacts as files of a directory.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __repr__(self):
+        return self.directory
+
+    def fetch(self, key, filename):
+        '''Copies the artifact ``key`` to ``filename``, returns whether it
+        was found.'''
+        artifact = join(self.directory, key)
+        if not exists(artifact):
+            return False
+        shutil.copyfile(artifact, filename)
+        return True
+
+    def store(self, key, filename):
+        '''Adds the file ``filename`` to the cache as the artifact
+        ``key``.'''
+        makedirs(self.directory, exist_ok=True)
+        artifact = join(self.directory, key)
+        shutil.copyfile(filename, artifact + '.tmp')
+        replace(artifact + '.tmp', artifact)
+
+
+class HTTPArtifactCache:
+    '''Gets the artifacts from ``<url>/<key>`` with GET requests, and
+    uploads them with PUT requests.'''
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def __repr__(self):
+        return self.url
+
+    def fetch(self, key, filename):
+        request = Request('{}/{}'.format(self.url, key),
+                          headers={'User-agent': USER_AGENT})
+        try:
+            with urlopen(request) as response, open(filename, 'wb') as fileh:
+                shutil.copyfileobj(response, fileh, 1024 * 1024)
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            return False
+        return True
+
+    def store(self, key, filename):
+        with open(filename, 'rb') as fileh:
+            request = Request(
+                '{}/{}'.format(self.url, key), data=fileh, method='PUT',
+                headers={'User-agent': USER_AGENT,
+                         'Content-Type': 'application/octet-stream',
+                         'Content-Length': str(lstat(filename).st_size)})
+            urlopen(request).close()
+
+
+def get_artifact_cache():
+    '''Returns the artifact cache configured with ``$P4A_ARTIFACT_CACHE``,
+    or None.'''
+    location = environ.get(ARTIFACT_CACHE_VARIABLE)
+    if not location:
+        return None
+    if location.startswith(('http://', 'https://')):
+        return HTTPArtifactCache(location)
+    return DirectoryArtifactCache(location)
+
+
+def get_artifact_key(recipe, arch, build_fingerprint):
+    '''Returns the name of the artifact of ``recipe`` built for ``arch``
+    with the given fingerprint.'''
+    return '{}-{}-{}.tar.gz'.format(
+        recipe.get_dir_name(), arch.arch, build_fingerprint)
+
+
+def get_output_dirs(recipe, arch):
+    '''Returns the directories ``recipe`` may write its outputs to when
+    built for ``arch``, by name.'''
+    ctx = recipe.ctx
+    return {
+        'build': recipe.get_build_dir(arch.arch),
+        'objects': join(recipe.get_build_container_dir(arch.arch),
+                        'objects_{}'.format(recipe.name)),
+        'libs': ctx.get_libs_dir(arch.arch),
+        'python-installs': ctx.get_python_install_dir(arch.arch),
+    }
+
+
+def snapshot_dirs(dirs):
+    '''Returns the size and modification time of all the files in each
+    of the directories ``dirs`` (a dict of directories by name).'''
+    snapshot = {}
+    for name, directory in dirs.items():
+        files = snapshot[name] = {}
+        for dirn, _, filens in walk(directory):
+            for filen in filens:
+                filename = join(dirn, filen)
+                file_stat = lstat(filename)
+                files[relpath(filename, directory)] = (
+                    file_stat.st_size, file_stat.st_mtime_ns)
+    return snapshot
+
+
+def pack_changes(dirs, snapshot, filename):
+    '''Writes to ``filename`` a tarball of all the files of ``dirs`` added
+    or modified since ``snapshot`` was taken. Returns how many there
+    are.'''
+    changes = snapshot_dirs(dirs)
+    count = 0
+    with tarfile.open(filename, 'w:gz', compresslevel=1) as tar:
+        for name, files in sorted(changes.items()):
+            before = snapshot.get(name, {})
+            for path, state in sorted(files.items()):
+                if before.get(path) == state:
+                    continue
+                # don't let files sharing an inode become tar hardlinks,
+                # their targets may not be part of the same directory
+                tar.inodes.clear()
+                tar.add(join(dirs[name], path), '{}/{}'.format(name, path),
+                        recursive=False)
+                count += 1
+    return count
+
+
+def unpack_changes(dirs, filename):
+    '''Extracts a tarball written by :func:`pack_changes` to ``dirs``.'''
+    with tarfile.open(filename, 'r|gz') as tar:
+        if hasattr(tarfile, 'tar_filter'):
+            tar.extraction_filter = tarfile.tar_filter
+        for member in tar:
+            name, _, member.name = member.name.partition('/')
+            if name not in dirs or not member.name:
+                raise ValueError('Unexpected file {} in {}'.format(
+                    member.name, filename))
+            tar.extract(member, dirs[name])
+
+
+def restore_recipe_artifact(cache, recipe, arch, build_fingerprint):
+    '''Restores the outputs of ``recipe`` for ``arch`` from ``cache``, if
+    it has them for ``build_fingerprint``. Returns whether it did.
+
+    The cache is only an optimisation: errors are reported as warnings,
+    and the recipe is then built as usual.
+    '''
+    key = get_artifact_key(recipe, arch, build_fingerprint)
+    temp_file = tempfile.NamedTemporaryFile(suffix='.tar.gz', delete=False)
+    temp_file.close()
+    try:
+        if not cache.fetch(key, temp_file.name):
+            debug('{} not found in the artifact cache'.format(key))
+            return False
+        unpack_changes(get_output_dirs(recipe, arch), temp_file.name)
+    except (OSError, URLError, tarfile.TarError, ValueError) as e:
+        warning('Could not restore {} from the artifact cache {}: {}'.format(
+            key, cache, e))
+        return False
+    finally:
+        unlink(temp_file.name)
+    info('{} for {} restored from the artifact cache'.format(
+        recipe.name, arch.arch))
+    return True
+
+
+def store_recipe_artifact(cache, recipe, arch, build_fingerprint, snapshot):
+    '''Stores in ``cache`` the outputs of the build of ``recipe`` for
+    ``arch``, i.e. the changes since ``snapshot`` (as returned by
+    :func:`snapshot_dirs` for :func:`get_output_dirs`).'''
+    key = get_artifact_key(recipe, arch, build_fingerprint)
+    temp_file = tempfile.NamedTemporaryFile(suffix='.tar.gz', delete=False)
+    temp_file.close()
+    try:
+        count = pack_changes(
+            get_output_dirs(recipe, arch), snapshot, temp_file.name)
+        cache.store(key, temp_file.name)
+        info('Stored {} files built by {} in the artifact cache'.format(
+            count, recipe.name))
+    except (OSError, URLError, tarfile.TarError) as e:
+        warning('Could not store {} in the artifact cache {}: {}'.format(
+            key, cache, e))
+    finally:
+        unlink(temp_file.name)
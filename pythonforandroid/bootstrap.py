@@ -8,10 +8,13 @@ import sh
 import shlex
 import shutil
 
+from pythonforandroid.elf import read_elf_file
 from pythonforandroid.logger import (shprint, info, logger, debug)
+from pythonforandroid.timing import timed
 from pythonforandroid.util import (
     current_directory, ensure_dir, temp_directory, BuildInterruptingException)
 from pythonforandroid.recipe import Recipe
+from pythonforandroid.recipeindex import get_recipe_metadata
 
 
 def copy_files(src_root, dest_root, override=True, symlink=False):
@@ -222,7 +225,7 @@ class Bootstrap:
                 ok = True
                 # Check if the bootstap's dependencies have an internal conflict:
                 for recipe in possible_dependencies:
-                    recipe = Recipe.get_recipe(recipe, ctx)
+                    recipe = get_recipe_metadata(recipe, ctx)
                     if any(conflict in recipes for conflict in recipe.conflicts):
                         ok = False
                         break
@@ -230,7 +233,7 @@ class Bootstrap:
                 # packages:
                 for recipe in recipes:
                     try:
-                        recipe = Recipe.get_recipe(recipe, ctx)
+                        recipe = get_recipe_metadata(recipe, ctx)
                     except ValueError:
                         conflicts = []
                     else:
@@ -370,7 +373,7 @@ class Bootstrap:
         info('Stripping libraries')
         env = arch.get_env()
         tokens = shlex.split(env['STRIP'])
-        strip = sh.Command(tokens[0])
+        strip = sh.Command(tokens[0], search_paths=env['PATH'].split(':'))
         if len(tokens) > 1:
             strip = strip.bake(tokens[1:])
 
@@ -380,13 +383,21 @@ class Bootstrap:
                          '-iname', '*.so', _env=env).stdout.decode('utf-8')
 
         logger.info('Stripping libraries in private dir')
-        for filen in filens.split('\n'):
-            if not filen:
-                continue  # skip the last ''
-            try:
-                strip(filen, _env=env)
-            except sh.ErrorReturnCode_1:
-                logger.debug('Failed to strip ' + filen)
+        with timed('strip', arch=arch.arch):
+            for filen in filens.split('\n'):
+                if not filen:
+                    continue  # skip the last ''
+                try:
+                    if not read_elf_file(filen).has_symtab:
+                        continue  # already stripped
+                except (OSError, ValueError):
+                    # e.g. libpybundle.so is an archive
+                    logger.debug('Not stripping non-ELF file ' + filen)
+                    continue
+                try:
+                    strip(filen, _env=env)
+                except sh.ErrorReturnCode_1:
+                    logger.debug('Failed to strip ' + filen)
 
     def fry_eggs(self, sitepackages):
         info('Frying eggs in {}'.format(sitepackages))
@@ -415,7 +426,7 @@ def expand_dependencies(recipes, ctx):
             if isinstance(entry, (tuple, list)):
                 entry = entry[0]
             try:
-                recipe = Recipe.get_recipe(entry, ctx)
+                recipe = get_recipe_metadata(entry, ctx)
                 recipes_with_deps += recipe.depends
             except ValueError:
                 # it's a pure python package without a recipe, so we
@@ -221,6 +221,14 @@ int main(int argc, char *argv[]) {
     PyRun_SimpleString(add_site_packages_dir);
     /* "sys.path.append(join(dirname(realpath(__file__)), 'site-packages'))") */
     PyRun_SimpleString("sys.path = ['.'] + sys.path");
+
+    /* import the extension modules from libpymodules.so when they were
+     * biglinked (see --biglink)
+     */
+    PyRun_SimpleString("try:\n"
+                       "    import _p4a_pymodules\n"
+                       "except ImportError:\n"
+                       "    pass\n");
   }
 
   PyRun_SimpleString(
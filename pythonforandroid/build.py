@@ -1,29 +1,51 @@
 from os.path import (
     abspath, join, realpath, dirname, expanduser, exists,
-    split, isdir
+    split, isdir, isfile
 )
 from os import environ
 import copy
+import csv
 import os
 import glob
+import hashlib
+import json
+import multiprocessing
 import sys
 import re
 import sh
 import shutil
 import subprocess
+import tempfile
 from contextlib import suppress
+from multiprocessing.connection import wait
 
 from pythonforandroid.util import (
     current_directory, ensure_dir,
     BuildInterruptingException,
 )
-from pythonforandroid.logger import (info, warning, info_notify, info_main, shprint)
+from pythonforandroid.logger import (
+    debug, info, warning, info_notify, info_main, shprint)
 from pythonforandroid.archs import ArchARM, ArchARMv7_a, ArchAarch_64, Archx86, Archx86_64
+from pythonforandroid.artifacts import (
+    get_artifact_cache, get_output_dirs, restore_recipe_artifact,
+    snapshot_dirs, store_recipe_artifact)
+from pythonforandroid.download import DEFAULT_DOWNLOAD_JOBS, download_recipes
+from pythonforandroid.elf import read_elf_file
+from pythonforandroid.fingerprint import (
+    discard_outdated_build, discard_outdated_sources, get_build_fingerprint,
+    get_source_fingerprint, is_build_outdated, read_fingerprints,
+    write_fingerprints,
+)
+from pythonforandroid.graph import find_levels, get_build_graph
+from pythonforandroid.probes import (
+    PROBES_FILENAME, ProbeCache, get_dir_state, get_path_state)
 from pythonforandroid.pythonpackage import get_package_name
-from pythonforandroid.recipe import CythonRecipe, Recipe
+from pythonforandroid.recipe import CythonRecipe, PythonRecipe, Recipe
+from pythonforandroid.recipeindex import get_recipe_metadata
 from pythonforandroid.recommendations import (
     check_ndk_version, check_target_api, check_ndk_api,
     RECOMMENDED_NDK_API, RECOMMENDED_TARGET_API)
+from pythonforandroid.timing import get_records, timed
 from pythonforandroid.util import build_platform
 
 
@@ -56,8 +78,33 @@ def get_toolchain_versions(ndk_dir, arch):
     return toolchain_versions, toolchain_path_exists
 
 
-def select_and_check_toolchain_version(sdk_dir, ndk_dir, arch, ndk_sysroot_exists, py_platform):
-    toolchain_versions, toolchain_path_exists = get_toolchain_versions(ndk_dir, arch)
+def get_missing_executables():
+    '''Returns the host tools needed by the build that are not in the
+    PATH.'''
+    return [
+        executable for executable in (
+            "pkg-config",
+            "autoconf",
+            "automake",
+            "libtoolize",
+            "tar",
+            "bzip2",
+            "unzip",
+            "make",
+            "gcc",
+            "g++",
+        )
+        if not sh.which(executable)
+    ]
+
+
+def select_and_check_toolchain_version(sdk_dir, ndk_dir, arch, ndk_sysroot_exists, py_platform,
+                                       probes=None):
+    probes = probes or ProbeCache()
+    toolchain_versions, toolchain_path_exists = probes.get(
+        'toolchain_versions_{}'.format(arch.toolchain_prefix),
+        get_dir_state(ndk_dir, ['toolchains']),
+        lambda: get_toolchain_versions(ndk_dir, arch))
     ok = ndk_sysroot_exists and toolchain_path_exists
     toolchain_versions.sort()
 
@@ -90,20 +137,11 @@ def select_and_check_toolchain_version(sdk_dir, ndk_dir, arch, ndk_sysroot_exist
             toolchain_version=toolchain_version,
             py_platform=py_platform, path=environ.get('PATH'))
 
-    for executable in (
-        "pkg-config",
-        "autoconf",
-        "automake",
-        "libtoolize",
-        "tar",
-        "bzip2",
-        "unzip",
-        "make",
-        "gcc",
-        "g++",
-    ):
-        if not sh.which(executable):
-            warning(f"Missing executable: {executable} is not installed")
+    missing_executables = probes.get(
+        'missing_executables_{}'.format(arch.toolchain_prefix),
+        get_path_state(environ['PATH']), get_missing_executables)
+    for executable in missing_executables:
+        warning(f"Missing executable: {executable} is not installed")
 
     if not ok:
         raise BuildInterruptingException(
@@ -126,6 +164,17 @@ def get_targets(sdk_dir):
     return targets
 
 
+def has_cython():
+    '''Returns whether Cython is installed for the host python3.'''
+    try:
+        subprocess.check_output([
+            "python3", "-m", "cython", "--help",
+        ])
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
 def get_available_apis(sdk_dir):
     targets = get_targets(sdk_dir)
     apis = [s for s in targets if re.match(r'^ *API level: ', s)]
@@ -183,6 +232,10 @@ class Context:
 
     java_build_tool = 'auto'
 
+    jobs = 1  # How many recipes may be built at the same time
+
+    download_jobs = DEFAULT_DOWNLOAD_JOBS  # How many downloads may run at once
+
     @property
     def packages_path(self):
         '''Where packages are downloaded before being unpacked'''
@@ -309,6 +362,9 @@ class Context:
         if self._build_env_prepared:
             return
 
+        probes = ProbeCache(join(self.storage_dir, PROBES_FILENAME))
+        path_state = get_path_state(environ.get('PATH', ''))
+
         # Work out where the Android SDK is
         sdk_dir = None
         if user_sdk_dir:
@@ -355,7 +411,9 @@ class Context:
         for arch in self.archs:
             # Maybe We could remove this one in a near future (ARMv5 is definitely old)
             check_target_api(android_api, arch)
-        apis = get_available_apis(self.sdk_dir)
+        apis = probes.get(
+            'available_apis', get_dir_state(self.sdk_dir, ['platforms', 'tools']),
+            lambda: get_available_apis(self.sdk_dir))
         info('Available Android APIs are ({})'.format(
             ', '.join(map(str, apis))))
         if android_api in apis:
@@ -420,15 +478,13 @@ class Context:
         check_ndk_api(ndk_api, self.android_api)
 
         # path to some tools
-        self.ccache = sh.which("ccache")
+        self.ccache = probes.get(
+            'ccache', path_state, lambda: sh.which("ccache"), keep=bool,
+            valid=exists)
         if not self.ccache:
             info('ccache is missing, the build will not be optimized in the '
                  'future.')
-        try:
-            subprocess.check_output([
-                "python3", "-m", "cython", "--help",
-            ])
-        except subprocess.CalledProcessError:
+        if not probes.get('cython', path_state, has_cython, keep=bool):
             warning('Cython for python3 missing. If you are building for '
                     ' a python 3 target (which is the default)'
                     ' then THINGS WILL BREAK.')
@@ -444,8 +500,13 @@ class Context:
         for arch in self.archs:
             # We assume that the toolchain version is the same for all the archs.
             self.toolchain_version = select_and_check_toolchain_version(
-                self.sdk_dir, self.ndk_dir, arch, ndk_sysroot_exists, py_platform
+                self.sdk_dir, self.ndk_dir, arch, ndk_sysroot_exists, py_platform,
+                probes
             )
+            # the toolchain may have changed
+            arch.invalidate_env()
+
+        probes.save()
 
     def __init__(self):
         self.include_dirs = []
@@ -462,6 +523,7 @@ class Context:
 
         self.local_recipes = None
         self.copy_libs = False
+        self.biglink = False
 
         self.activity_class_name = u'org.kivy.android.PythonActivity'
         self.service_class_name = u'org.kivy.android.PythonService'
@@ -537,7 +599,7 @@ class Context:
 
         # Try to look up recipe by name:
         try:
-            recipe = Recipe.get_recipe(name, self)
+            recipe = get_recipe_metadata(name, self)
         except ValueError:
             pass
         else:
@@ -570,57 +632,355 @@ def build_recipes(build_order, python_modules, ctx, project_dir,
 
     # download is arch independent
     info_main('# Downloading recipes ')
-    for recipe in recipes:
-        recipe.download_if_necessary()
+    download_recipes(recipes, ctx.download_jobs)
 
     for arch in ctx.archs:
         info_main('# Building all recipes for arch {}'.format(arch.arch))
 
         info_main('# Unpacking recipes')
         for recipe in recipes:
-            ensure_dir(recipe.get_build_container_dir(arch.arch))
-            recipe.prepare_build_dir(arch.arch)
+            discard_outdated_sources(recipe, arch)
+            unpack_recipe(recipe, arch)
 
         info_main('# Prebuilding recipes')
         # 2) prebuild packages
         for recipe in recipes:
-            info_main('Prebuilding {} for {}'.format(recipe.name, arch.arch))
-            recipe.prebuild_arch(arch)
-            recipe.apply_patches(arch)
+            prebuild_recipe(recipe, arch)
 
         # 3) build packages
         info_main('# Building recipes')
-        for recipe in recipes:
-            info_main('Building {} for {}'.format(recipe.name, arch.arch))
-            if recipe.should_build(arch):
-                recipe.build_arch(arch)
-            else:
-                info('{} said it is already built, skipping'
-                     .format(recipe.name))
-            recipe.install_libraries(arch)
+        if ctx.jobs > 1:
+            build_recipes_in_parallel(recipes, arch, ctx, ctx.jobs)
+        else:
+            for recipe in recipes:
+                build_recipe(recipe, arch)
 
         # 4) biglink everything
         info_main('# Biglinking object files')
-        if not ctx.python_recipe:
-            biglink(ctx, arch)
+        if ctx.biglink:
+            with timed('biglink', arch=arch.arch):
+                biglink_modules(ctx, arch)
+        elif not ctx.python_recipe:
+            with timed('biglink', arch=arch.arch):
+                biglink(ctx, arch)
         else:
-            warning(
-                "Context's python recipe found, "
-                "skipping biglink (will this work?)"
-            )
+            info('Not biglinking the extension modules (see --biglink)')
+            remove_biglinked_modules(ctx, arch)
 
         # 5) postbuild packages
         info_main('# Postbuilding recipes')
         for recipe in recipes:
             info_main('Postbuilding {} for {}'.format(recipe.name, arch.arch))
-            recipe.postbuild_arch(arch)
+            with timed('postbuild', recipe=recipe.name, arch=arch.arch):
+                recipe.postbuild_arch(arch)
 
     info_main('# Installing pure Python modules')
+    pure_wheels = {}
+    if python_modules:
+        with timed('pure_wheels'):
+            pure_wheels = get_pure_wheels(ctx, [
+                module for module in python_modules
+                if any(ctx.not_has_package(module, arch)
+                       for arch in ctx.archs)])
     for arch in ctx.archs:
-        run_pymodules_install(
-            ctx, arch, python_modules, project_dir,
-            ignore_setup_py=ignore_project_setup_py
-        )
+        with timed('pymodules_install', arch=arch.arch):
+            run_pymodules_install(
+                ctx, arch, python_modules, project_dir,
+                ignore_setup_py=ignore_project_setup_py,
+                pure_wheels=pure_wheels
+            )
+
+
+def unpack_recipe(recipe, arch):
+    '''Unpacks the sources of ``recipe`` in its build dir for ``arch``.'''
+    with timed('unpack', recipe=recipe.name, arch=arch.arch):
+        ensure_dir(recipe.get_build_container_dir(arch.arch))
+        recipe.prepare_build_dir(arch.arch)
+
+
+def prebuild_recipe(recipe, arch):
+    '''Prebuilds and patches the unpacked sources of ``recipe``.'''
+    info_main('Prebuilding {} for {}'.format(recipe.name, arch.arch))
+    with timed('prebuild', recipe=recipe.name, arch=arch.arch):
+        recipe.prebuild_arch(arch)
+    with timed('patch', recipe=recipe.name, arch=arch.arch):
+        recipe.apply_patches(arch)
+
+
+def build_recipe(recipe, arch, store_artifact=True):
+    '''Builds a single (already unpacked and prebuilt) recipe for the
+    given arch, and installs its libraries.
+
+    With an artifact cache (see :mod:`pythonforandroid.artifacts`), the
+    outputs of the build are restored from the cache when it has them,
+    and stored in it otherwise. If ``store_artifact`` is False, they are
+    not stored, and the snapshot of the output dirs taken before building
+    is returned instead, to let the caller store them later.
+    '''
+    info_main('Building {} for {}'.format(recipe.name, arch.arch))
+    should_build = recipe.should_build(arch)
+    source_fingerprint = get_source_fingerprint(recipe, arch)
+    build_fingerprint = get_build_fingerprint(
+        recipe, arch, source_fingerprint)
+    if discard_outdated_build(
+            recipe, arch, source_fingerprint, build_fingerprint):
+        # build_arch() would otherwise run again in the tree of the
+        # last build, keeping e.g. objects built with the old flags
+        unpack_recipe(recipe, arch)
+        prebuild_recipe(recipe, arch)
+        should_build = True
+    elif not should_build and is_build_outdated(
+            recipe, arch, build_fingerprint):
+        info('{} is already built, but from other sources, flags or '
+             'dependencies, rebuilding'.format(recipe.name))
+        should_build = True
+    cache = get_artifact_cache() if should_build else None
+    snapshot = None
+    if not should_build:
+        info('{} said it is already built, skipping'
+             .format(recipe.name))
+    elif cache is None:
+        with timed('build', recipe=recipe.name, arch=arch.arch):
+            recipe.build_arch(arch)
+    elif not restore_recipe_artifact(cache, recipe, arch, build_fingerprint):
+        snapshot = snapshot_dirs(get_output_dirs(recipe, arch))
+        with timed('build', recipe=recipe.name, arch=arch.arch):
+            recipe.build_arch(arch)
+    else:
+        # only the files were restored, not what the build sets up
+        recipe.postrestore_arch(arch)
+    with timed('install_libraries', recipe=recipe.name, arch=arch.arch):
+        recipe.install_libraries(arch)
+    if snapshot is not None and store_artifact:
+        store_recipe_artifact(
+            cache, recipe, arch, build_fingerprint, snapshot)
+        snapshot = None
+    write_fingerprints(recipe, arch, source_fingerprint, build_fingerprint)
+    return snapshot
+
+
+def _get_value_state(value, parents=()):
+    '''(internal) Returns what identifies a value that isn't plain: its
+    ``id()``, and for the lists, tuples, sets and dicts the state of their
+    items too, so that changing them in place changes it.'''
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if id(value) in parents:
+        return id(value)
+    parents += (id(value),)
+    if isinstance(value, (list, tuple)):
+        items = tuple(_get_value_state(item, parents) for item in value)
+    elif isinstance(value, (set, frozenset)):
+        items = frozenset(_get_value_state(item, parents) for item in value)
+    elif isinstance(value, dict):
+        items = tuple(
+            (_get_value_state(key, parents), _get_value_state(item, parents))
+            for key, item in value.items())
+    else:
+        return id(value)
+    return id(value), items
+
+
+def _get_state(obj):
+    '''(internal) Returns the attributes of ``obj`` (the build context or
+    a recipe) by name, as ``(True, value)`` for the plain (picklable)
+    values, e.g. `ctx.hostpython`, which recipes may set while building,
+    and as ``(False, state)`` for the others (see
+    :func:`_get_value_state`).'''
+    return {
+        key: ((True, value)
+              if isinstance(value, (str, int, float, bool, type(None)))
+              else (False, _get_value_state(value)))
+        for key, value in vars(obj).items()
+    }
+
+
+def _get_state_changes(before, after):
+    '''(internal) Returns the plain attributes changed between the states
+    ``before`` and ``after`` (see :func:`_get_state`) with their new value,
+    and the names of the other attributes that changed (or were deleted),
+    whose changes can't be sent back by a worker process.'''
+    changes = {}
+    lost = [key for key in before if key not in after]
+    for key, (plain, value) in after.items():
+        if before.get(key) == (plain, value):
+            continue
+        if plain:
+            changes[key] = value
+        else:
+            lost.append(key)
+    return changes, sorted(lost)
+
+
+def _build_recipe_worker(recipe, arch, conn):
+    '''(internal) Entry point of the worker processes forked by
+    :func:`build_recipes_in_parallel`. Sends back to the parent the
+    changes done by the build (see :func:`_get_state_changes`) to the
+    context, the recipe and the environment, the snapshot of its output
+    dirs if it was built (see :func:`build_recipe`) and its timings.'''
+    ctx_state = _get_state(recipe.ctx)
+    recipe_state = _get_state(recipe)
+    env = dict(environ)
+    records = get_records()
+    first_record = len(records)
+    snapshot = build_recipe(recipe, arch, store_artifact=False)
+    ctx_changes, ctx_lost = _get_state_changes(
+        ctx_state, _get_state(recipe.ctx))
+    recipe_changes, recipe_lost = _get_state_changes(
+        recipe_state, _get_state(recipe))
+    conn.send(({
+        'ctx': ctx_changes,
+        'recipe': recipe_changes,
+        'environ': {
+            key: environ.get(key) for key in set(env) | set(environ)
+            if env.get(key) != environ.get(key)
+        },
+        'lost': ['ctx.' + key for key in ctx_lost] + [
+            'recipe.' + key for key in recipe_lost],
+    }, snapshot, records[first_record:]))
+    conn.close()
+
+
+def _apply_worker_changes(recipe, ctx, changes):
+    '''(internal) Replays in the main process the changes sent back by
+    :func:`_build_recipe_worker`, so that the later builds see them.'''
+    if changes['lost']:
+        raise BuildInterruptingException(
+            'Building {} changed {} in a worker process, which can\'t be '
+            'kept: the recipe must set build_in_parallel = False'.format(
+                recipe.name, ', '.join(changes['lost'])))
+    for key, value in changes['ctx'].items():
+        setattr(ctx, key, value)
+    for key, value in changes['recipe'].items():
+        setattr(recipe, key, value)
+    for key, value in changes['environ'].items():
+        if value is None:
+            environ.pop(key, None)
+        else:
+            environ[key] = value
+
+
+def _installs_python_packages(recipe):
+    '''(internal) Returns whether building ``recipe`` installs Python
+    packages into the python installs dir, which may not be done by
+    several recipes at the same time (they all update e.g. its
+    ``easy-install.pth``).'''
+    return isinstance(recipe, PythonRecipe)
+
+
+def _store_parallel_artifact(recipe, arch, snapshot, overlapped):
+    '''(internal) Stores the outputs of a recipe built by
+    :func:`build_recipes_in_parallel` in the artifact cache.'''
+    if overlapped:
+        debug('{} was built along with other recipes, not storing it in '
+              'the artifact cache'.format(recipe.name))
+        return
+    store_recipe_artifact(
+        get_artifact_cache(), recipe, arch,
+        read_fingerprints(recipe, arch)['build'], snapshot)
+
+
+def build_recipes_in_parallel(recipes, arch, ctx, jobs):
+    '''Builds the given recipes for one arch, running up to ``jobs``
+    recipe builds at the same time in forked worker processes.
+
+    A recipe is only started once all the recipes it depends on (see
+    :func:`~pythonforandroid.graph.get_build_graph`) have been built and
+    installed, so independent branches of the dependency graph (e.g.
+    libffi, openssl and sqlite3) get compiled concurrently.
+
+    The recipes installing Python packages are built one at a time, as
+    they all install into the same site-packages. Only the plain state
+    changed by a worker is kept (see :attr:`Recipe.build_in_parallel`),
+    and the recipes which don't allow it are built in this process,
+    while no other recipe is building.
+
+    The outputs of a recipe are stored in the artifact cache, if any,
+    only when it was built alone: the libs and python installs dirs are
+    shared by all the recipes, so the files added to them while several
+    recipes were building can't be told apart.
+    '''
+    graph = get_build_graph(ctx, [recipe.name for recipe in recipes])
+    debug('Recipes that can be built in parallel for {}: {}'.format(
+        arch.arch, find_levels(graph)))
+    recipes_by_name = {recipe.name: recipe for recipe in recipes}
+    pending = dict(recipes_by_name)
+    running = {}
+    built = set()
+    # the recipes built at the same time as some other one
+    overlapped = set()
+    mp_context = multiprocessing.get_context('fork')
+
+    try:
+        while pending or running:
+            ready = sorted(name for name in pending if graph[name] <= built)
+            serial = [name for name in ready
+                      if not recipes_by_name[name].build_in_parallel]
+            if serial:
+                # wait for the running builds to finish, then build it here
+                if not running:
+                    name = serial[0]
+                    build_recipe(pending.pop(name), arch)
+                    built.add(name)
+                    continue
+                ready = []
+            for name in ready:
+                if len(running) >= jobs:
+                    break
+                recipe = recipes_by_name[name]
+                if _installs_python_packages(recipe) and any(
+                        _installs_python_packages(recipes_by_name[entry[0]])
+                        for entry in running.values()):
+                    continue
+                pending.pop(name)
+                reader, writer = mp_context.Pipe(duplex=False)
+                process = mp_context.Process(
+                    target=_build_recipe_worker,
+                    args=(recipe, arch, writer),
+                    name='p4a-build-{}-{}'.format(name, arch.arch))
+                process.start()
+                writer.close()
+                running[process.sentinel] = (name, process, reader)
+                if len(running) > 1:
+                    overlapped.update(
+                        entry[0] for entry in running.values())
+
+            if not running:
+                raise BuildInterruptingException(
+                    'Could not schedule the build of {} for {}: dependency '
+                    'cycle detected'.format(', '.join(sorted(pending)),
+                                            arch.arch))
+
+            for sentinel in wait(list(running)):
+                name, process, reader = running.pop(sentinel)
+                try:
+                    changes, snapshot, records = reader.recv()
+                except EOFError:
+                    changes = snapshot = None
+                    records = []
+                get_records().extend(records)
+                reader.close()
+                process.join()
+                if process.exitcode != 0 or changes is None:
+                    raise BuildInterruptingException(
+                        'Building {} for {} failed (exit code {})'.format(
+                            name, arch.arch, process.exitcode))
+                # Replay any context changes done by the recipe (e.g. the
+                # hostpython location), so that later builds can see them
+                _apply_worker_changes(recipes_by_name[name], ctx, changes)
+                if snapshot is not None:
+                    _store_parallel_artifact(
+                        recipes_by_name[name], arch, snapshot,
+                        name in overlapped)
+                built.add(name)
+                info('{} built for {} ({} of {} recipes done)'.format(
+                    name, arch.arch, len(built), len(recipes)))
+    finally:
+        for name, process, reader in running.values():
+            warning('Interrupting the build of {} for {}'.format(
+                name, arch.arch))
+            process.terminate()
+            process.join()
 
 
 def project_has_setup_py(project_dir):
@@ -630,6 +990,27 @@ def project_has_setup_py(project_dir):
             ))
 
 
+def get_recorded_entries(site_packages_dir, dist_dirs):
+    '''Returns the top-level entries of ``site_packages_dir`` installed
+    by the packages of the given ``.dist-info`` (or ``.egg-info``) dirs, as
+    listed in their install records (i.e. their ``RECORD`` file), including
+    these dirs, or None if one of them has no record (e.g. a legacy
+    ``setup.py install``).'''
+    entries = set(dist_dirs)
+    for dist_dir in dist_dirs:
+        record = join(site_packages_dir, dist_dir, 'RECORD')
+        if not exists(record):
+            return None
+        with open(record, newline='') as fileh:
+            for row in csv.reader(fileh):
+                path = os.path.normpath(row[0]) if row else ''
+                # e.g. scripts are installed outside site-packages
+                if not path or path.startswith('..') or os.path.isabs(path):
+                    continue
+                entries.add(path.split(os.sep)[0])
+    return sorted(entries)
+
+
 def run_setuppy_install(ctx, project_dir, env=None, arch=None):
     env = env or {}
 
@@ -654,12 +1035,17 @@ def run_setuppy_install(ctx, project_dir, env=None, arch=None):
         # upgraded & reinstalled:
         with open('._tmp_p4a_recipe_constraints.txt', 'wb') as fileh:
             fileh.write(constraints.encode("utf-8", "replace"))
+        ctx_site_packages_dir = os.path.normpath(
+            os.path.abspath(ctx.get_site_packages_dir(arch))
+        )
+        venv_site_packages_dir = os.path.normpath(
+            get_venv_site_packages_dir(join(ctx.build_dir, "venv"))
+        )
+        overlay_file = join(venv_site_packages_dir, VENV_OVERLAY_FILENAME)
         try:
-
-            info('Populating venv\'s site-packages with '
-                 'ctx.get_site_packages_dir()...')
-
-            # Copy dist contents into site-packages for discovery.
+            # Make the contents of ctx.get_site_packages_dir() visible in
+            # the venv's site-packages without copying them, by adding it
+            # to the venv's sys.path with a .pth file.
             # Why this is needed:
             # --target is somewhat evil and messes with discovery of
             # packages in PYTHONPATH if that also includes the target
@@ -667,38 +1053,20 @@ def run_setuppy_install(ctx, project_dir, env=None, arch=None):
             # site-packages folder instead.
             # Reference:
             # https://github.com/pypa/pip/issues/6223
-            ctx_site_packages_dir = os.path.normpath(
-                os.path.abspath(ctx.get_site_packages_dir(arch))
-            )
-            venv_site_packages_dir = os.path.normpath(os.path.join(
-                ctx.build_dir, "venv", "lib", [
-                    f for f in os.listdir(os.path.join(
-                        ctx.build_dir, "venv", "lib"
-                    )) if f.startswith("python")
-                ][0], "site-packages"
-            ))
-            copied_over_contents = []
-            for f in os.listdir(ctx_site_packages_dir):
-                full_path = os.path.join(ctx_site_packages_dir, f)
-                if not os.path.exists(os.path.join(
-                            venv_site_packages_dir, f
-                        )):
-                    if os.path.isdir(full_path):
-                        shutil.copytree(full_path, os.path.join(
-                            venv_site_packages_dir, f
-                        ))
-                    else:
-                        shutil.copy2(full_path, os.path.join(
-                            venv_site_packages_dir, f
-                        ))
-                    copied_over_contents.append(f)
+            info('Adding ctx.get_site_packages_dir() to the venv\'s '
+                 'site-packages...')
+            with open(overlay_file, "w") as fileh:
+                fileh.write(ctx_site_packages_dir + "\n")
 
             # Get listing of virtualenv's site-packages, to see the
-            # newly added things afterwards & copy them back into
-            # the distribution folder / build context site-packages:
+            # newly added things afterwards:
             previous_venv_contents = os.listdir(
                 venv_site_packages_dir
             )
+            # pip doesn't uninstall the packages out of the venv, so the
+            # overlay is left as is even when the install upgrades one:
+            # check that it stays so
+            overlay_contents = os.listdir(ctx_site_packages_dir)
 
             # Actually run setup.py:
             info('Launching package install...')
@@ -711,13 +1079,30 @@ def run_setuppy_install(ctx, project_dir, env=None, arch=None):
                      replace("'", "'\"'\"'")),
                     _env=copy.copy(env))
 
-            # Go over all new additions and copy them back:
+            removed = (set(overlay_contents) -
+                       set(os.listdir(ctx_site_packages_dir)))
+            if removed:
+                raise BuildInterruptingException(
+                    'The project install removed {} from {}'.format(
+                        ', '.join(sorted(removed)), ctx_site_packages_dir))
+
+            # Copy what the install added, as listed in the install
+            # records of the new packages (or everything it added, if one
+            # has none), into the distribution folder / build context
+            # site-packages:
             info('Copying additions resulting from setup.py back '
                  'into ctx.get_site_packages_dir()...')
-            new_venv_additions = []
-            for f in (set(os.listdir(venv_site_packages_dir)) -
-                      set(previous_venv_contents)):
-                new_venv_additions.append(f)
+            new_venv_contents = (set(os.listdir(venv_site_packages_dir)) -
+                                 set(previous_venv_contents))
+            new_entries = get_recorded_entries(venv_site_packages_dir, [
+                f for f in new_venv_contents
+                if f.endswith((".dist-info", ".egg-info"))])
+            if new_entries is None:
+                new_entries = sorted(new_venv_contents)
+            for f in new_entries:
+                if f in previous_venv_contents or exists(
+                        join(ctx_site_packages_dir, f)):
+                    continue
                 full_path = os.path.join(venv_site_packages_dir, f)
                 if os.path.isdir(full_path):
                     shutil.copytree(full_path, os.path.join(
@@ -731,22 +1116,178 @@ def run_setuppy_install(ctx, project_dir, env=None, arch=None):
             # Undo all the changes we did to the venv-site packages:
             info('Reverting additions to '
                  'virtualenv\'s site-packages...')
-            for f in set(copied_over_contents + new_venv_additions):
+            for f in new_venv_contents:
                 full_path = os.path.join(venv_site_packages_dir, f)
                 if os.path.isdir(full_path):
                     shutil.rmtree(full_path)
                 else:
                     os.remove(full_path)
         finally:
+            if exists(overlay_file):
+                os.remove(overlay_file)
             os.remove("._tmp_p4a_recipe_constraints.txt")
 
 
+# The versions of pip and Cython installed in the venv the non-recipe
+# requirements are installed with. The Cython one can be changed with
+# $P4A_VENV_CYTHON_VERSION, e.g. for the modules needing Cython 3.
+VENV_PIP_VERSION = '23.3.2'
+VENV_CYTHON_VERSION = '0.29.36'
+VENV_CYTHON_VERSION_VARIABLE = 'P4A_VENV_CYTHON_VERSION'
+
+VENV_STAMP_FILENAME = 'p4a-venv-stamp.json'
+
+# The .pth file adding the site-packages of an arch to the venv's during a
+# project install
+VENV_OVERLAY_FILENAME = 'p4a-site-packages.pth'
+
+
+def get_venv_site_packages_dir(venv_dir):
+    lib_dir = join(venv_dir, 'lib')
+    return join(lib_dir, [
+        f for f in os.listdir(lib_dir) if f.startswith('python')][0],
+        'site-packages')
+
+
+def get_venv_cython_version():
+    '''Returns the version of Cython to install in the venv, from
+    ``$P4A_VENV_CYTHON_VERSION`` or else ``VENV_CYTHON_VERSION``.'''
+    return environ.get(VENV_CYTHON_VERSION_VARIABLE) or VENV_CYTHON_VERSION
+
+
+def ensure_pip_venv(ctx):
+    '''Makes sure the venv in ``ctx.build_dir`` the non-recipe requirements
+    are installed with exists, with the pinned versions of pip and Cython.
+
+    The venv is reused by the next builds and by the other archs, and only
+    recreated when the hostpython or the pinned versions change, or when
+    its site-packages was modified (e.g. by a failed project install), as
+    recorded in its stamp file.'''
+    venv_dir = join(ctx.build_dir, 'venv')
+    stamp_file = join(venv_dir, VENV_STAMP_FILENAME)
+    host_python = sh.Command(ctx.hostpython)
+    cython_version = get_venv_cython_version()
+    stamp = {
+        'hostpython': ctx.hostpython,
+        'hostpython_version': str(host_python(
+            '-c', 'import sys; print(sys.version)')).strip(),
+        'pip': VENV_PIP_VERSION,
+        'cython': cython_version,
+    }
+    try:
+        with open(stamp_file) as fileh:
+            recorded_stamp = json.load(fileh)
+        site_packages = sorted(os.listdir(
+            get_venv_site_packages_dir(venv_dir)))
+    except (OSError, ValueError, IndexError):
+        recorded_stamp = None
+    else:
+        if recorded_stamp == dict(stamp, site_packages=site_packages):
+            info('Reusing the venv in {}'.format(venv_dir))
+            return
+    if exists(venv_dir):
+        info('Recreating the venv in {}'.format(venv_dir))
+        shutil.rmtree(venv_dir)
+    shprint(host_python, '-m', 'venv', venv_dir)
+
+    venv_pip = sh.Command(join(venv_dir, 'bin', 'pip'))
+    info('Install pip {} in the venv'.format(VENV_PIP_VERSION))
+    shprint(venv_pip, 'install', 'pip=={}'.format(VENV_PIP_VERSION))
+    # Cython is installed in case one of the modules needs it to build
+    info('Install Cython {} in the venv'.format(cython_version))
+    shprint(venv_pip, 'install', 'Cython=={}'.format(cython_version))
+
+    stamp['site_packages'] = sorted(os.listdir(
+        get_venv_site_packages_dir(venv_dir)))
+    with open(stamp_file, 'w') as fileh:
+        json.dump(stamp, fileh)
+
+
+def get_requirement_line(module):
+    '''Returns the requirement of ``module`` to give to pip, pinned to the
+    version set in ``VERSION_<module>`` if any.'''
+    key = 'VERSION_' + module
+    if key in environ:
+        return '{}=={}'.format(module, environ[key])
+    return module
+
+
+def get_pure_wheels(ctx, modules):
+    '''Returns the pure-Python wheels (i.e. tagged ``none-any``) available
+    for the given non-recipe requirements, by requirement, as the dirs
+    they are installed in once for all the archs.
+
+    The wheels are kept in ``ctx.build_dir`` along with their installs, by
+    name and version, and only downloaded again if pip finds a newer
+    matching version. The requirements without such a wheel, which may
+    have native code, are left out to be installed for each arch.'''
+    if not modules:
+        return {}
+    ensure_pip_venv(ctx)
+    wheelhouse = join(ctx.build_dir, 'wheelhouse')
+    installs_dir = join(ctx.build_dir, 'pure-installs')
+    ensure_dir(wheelhouse)
+    ensure_dir(installs_dir)
+    venv_pip = sh.Command(join(ctx.build_dir, 'venv', 'bin', 'pip'))
+    pure_wheels = {}
+    for module in modules:
+        download_dir = tempfile.mkdtemp(
+            prefix='p4a-wheel-', dir=ctx.build_dir)
+        try:
+            try:
+                shprint(venv_pip, 'download', '--no-deps',
+                        '--only-binary=:all:', '--platform', 'any',
+                        '--implementation', 'py', '--abi', 'none',
+                        '--python-version',
+                        ctx.python_recipe.major_minor_version_string,
+                        '--find-links', wheelhouse, '-d', download_dir,
+                        get_requirement_line(module))
+            except sh.ErrorReturnCode:
+                info('No pure-Python wheel of {}, it will be installed for '
+                     'each arch'.format(module))
+                continue
+            wheel = os.listdir(download_dir)[0]
+            if not exists(join(wheelhouse, wheel)):
+                shutil.move(join(download_dir, wheel), wheelhouse)
+        finally:
+            shutil.rmtree(download_dir)
+
+        install_dir = join(installs_dir, wheel[:-len('.whl')])
+        if not exists(install_dir):
+            info('Installing pure-Python wheel {}'.format(wheel))
+            if exists(install_dir + '.tmp'):
+                shutil.rmtree(install_dir + '.tmp')
+            shprint(venv_pip, 'install', '--no-deps', '--target',
+                    install_dir + '.tmp', join(wheelhouse, wheel))
+            os.rename(install_dir + '.tmp', install_dir)
+        pure_wheels[module] = install_dir
+    return pure_wheels
+
+
+def link_tree(source_dir, target_dir):
+    '''Hardlinks the files of ``source_dir`` into ``target_dir``, replacing
+    the existing ones, or copies them if they can't be linked.'''
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        target_path = join(target_dir, os.path.relpath(dirpath, source_dir))
+        ensure_dir(target_path)
+        for filename in filenames:
+            target_file = join(target_path, filename)
+            if exists(target_file):
+                os.remove(target_file)
+            try:
+                os.link(join(dirpath, filename), target_file)
+            except OSError:
+                shutil.copy2(join(dirpath, filename), target_file)
+
+
 def run_pymodules_install(ctx, arch, modules, project_dir=None,
-                          ignore_setup_py=False):
+                          ignore_setup_py=False, pure_wheels=None):
     """ This function will take care of all non-recipe things, by:
 
         1. Processing them from --requirements (the modules argument)
-           and installing them
+           and installing them. Those in pure_wheels (see
+           get_pure_wheels()) are linked from their shared install
+           instead of being installed again for this arch.
 
         2. Installing the user project/app itself via setup.py if
            ignore_setup_py=True
@@ -757,6 +1298,14 @@ def run_pymodules_install(ctx, arch, modules, project_dir=None,
 
     modules = [m for m in modules if ctx.not_has_package(m, arch)]
 
+    pure_wheels = pure_wheels or {}
+    for module in modules:
+        if module in pure_wheels:
+            info('Linking pure-Python module {} into {}'.format(
+                module, ctx.get_site_packages_dir(arch)))
+            link_tree(pure_wheels[module], ctx.get_site_packages_dir(arch))
+    modules = [m for m in modules if m not in pure_wheels]
+
     # We change current working directory later, so this has to be an absolute
     # path or `None` in case that we didn't supply the `project_dir` via kwargs
     project_dir = abspath(project_dir) if project_dir else None
@@ -787,24 +1336,12 @@ def run_pymodules_install(ctx, arch, modules, project_dir=None,
             "project may not be compatible for Android install."
         )
 
-    # Use our hostpython to create the virtualenv
-    host_python = sh.Command(ctx.hostpython)
+    # Use our hostpython to create the virtualenv, or reuse it
+    ensure_pip_venv(ctx)
     with current_directory(join(ctx.build_dir)):
-        shprint(host_python, '-m', 'venv', 'venv')
-
-        # Prepare base environment and upgrade pip:
+        # Prepare base environment:
         base_env = dict(copy.copy(os.environ))
         base_env["PYTHONPATH"] = ctx.get_site_packages_dir(arch)
-        info('Upgrade pip to latest version')
-        shprint(sh.bash, '-c', (
-            "source venv/bin/activate && pip install -U pip"
-        ), _env=copy.copy(base_env))
-
-        # Install Cython in case modules need it to build:
-        info('Install Cython in case one of the modules needs it to build')
-        shprint(sh.bash, '-c', (
-            "venv/bin/pip install Cython"
-        ), _env=copy.copy(base_env))
 
         # Get environment variables for build (with CC/compiler set):
         standard_recipe = CythonRecipe()
@@ -830,12 +1367,7 @@ def run_pymodules_install(ctx, arch, modules, project_dir=None,
             info('Creating a requirements.txt file for the Python modules')
             with open('requirements.txt', 'w') as fileh:
                 for module in modules:
-                    key = 'VERSION_' + module
-                    if key in environ:
-                        line = '{}=={}\n'.format(module, environ[key])
-                    else:
-                        line = '{}\n'.format(module)
-                    fileh.write(line)
+                    fileh.write(get_requirement_line(module) + '\n')
 
             info('Installing Python modules with pip')
             info(
@@ -913,6 +1445,25 @@ def biglink(ctx, arch):
             env=env)
 
 
+# The files biglink_function() records the arguments and fingerprint of
+# its last link in, in the objects dir
+BIGLINK_ARGS_FILENAME = '.biglink-args'
+BIGLINK_FINGERPRINT_FILENAME = '.biglink-fingerprint'
+
+
+def get_link_fingerprint(linker, link_args):
+    '''Returns a fingerprint of a link with the given arguments, which
+    covers the contents of the object files it links.'''
+    digest = hashlib.sha256(
+        json.dumps([linker, link_args]).encode('utf-8'))
+    for arg in link_args:
+        if arg.endswith('.o') and isfile(arg):
+            with open(arg, 'rb') as fileh:
+                for chunk in iter(lambda: fileh.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
 def biglink_function(soname, objs_paths, extra_link_dirs=None, env=None):
     if extra_link_dirs is None:
         extra_link_dirs = []
@@ -942,13 +1493,10 @@ def biglink_function(soname, objs_paths, extra_link_dirs=None, env=None):
             data = fd.read()
             args.extend(data.split(" "))
 
-    unique_args = []
-    while args:
-        a = args.pop()
-        if a in ('-L', ):
-            continue
-        if a not in unique_args:
-            unique_args.insert(0, a)
+    # Keep the last occurrence of each argument, so that libraries come
+    # after the objects needing them
+    unique_args = list(reversed(dict.fromkeys(
+        a for a in reversed(args) if a and a != '-L')))
 
     for dir in extra_link_dirs:
         link = '-L{}'.format(dir)
@@ -958,8 +1506,249 @@ def biglink_function(soname, objs_paths, extra_link_dirs=None, env=None):
     cc_name = env['CC']
     cc = sh.Command(cc_name.split()[0])
     cc = cc.bake(*cc_name.split()[1:])
+    link_args = ['-shared', '-O3', '-o', soname] + unique_args
+
+    fingerprint = get_link_fingerprint(cc_name, link_args)
+    fingerprint_file = join(objs_paths[0], BIGLINK_FINGERPRINT_FILENAME)
+    if exists(soname) and exists(fingerprint_file):
+        with open(fingerprint_file) as fileh:
+            if fileh.read() == fingerprint:
+                info('{} is up to date, not relinking'.format(soname))
+                return
+
+    # The arguments are given in a response file, as they may not fit on
+    # a command line
+    response_file = join(objs_paths[0], BIGLINK_ARGS_FILENAME)
+    with open(response_file, 'w') as fileh:
+        fileh.write('\n'.join(
+            '"{}"'.format(arg.replace('\\', '\\\\').replace('"', '\\"'))
+            for arg in link_args) + '\n')
+    shprint(cc, '@' + response_file, _env=env)
+    with open(fingerprint_file, 'w') as fileh:
+        fileh.write(fingerprint)
+
+
+# tools/liblink installs a placeholder instead of each extension it links
+# to an object file, which starts with this and the name of the object
+LIBLINK_PLACEHOLDER_PREFIX = b'p4a-liblink '
+
+# With --biglink, the library the extension modules are linked into and
+# the module importing them from it, both installed in the site-packages
+PYMODULES_LIBRARY = 'libpymodules.so'
+PYMODULES_FINDER_MODULE = '_p4a_pymodules'
+PYMODULES_FINDER_TEMPLATE = '''\
+"""
+Imports the extension modules linked into {library}, so that the
+library is loaded once instead of one library per module.
+
+Generated by python-for-android, and imported at startup.
+"""
+
+from importlib.machinery import ExtensionFileLoader
+from importlib.util import spec_from_file_location
+from os.path import dirname, join
+import sys
+
+LIBRARY = join(dirname(__file__), {library!r})
+
+MODULES = frozenset([
+{modules}
+])
+
+
+class PyModulesFinder:
+
+    @classmethod
+    def find_spec(cls, fullname, path=None, target=None):
+        if fullname not in MODULES:
+            return None
+        return spec_from_file_location(
+            fullname, LIBRARY, loader=ExtensionFileLoader(fullname, LIBRARY))
+
+
+sys.meta_path.insert(0, PyModulesFinder)
+'''
+
+
+def get_extension_module_name(site_packages_dir, filename):
+    '''Returns the name of the extension module installed as ``filename``
+    in ``site_packages_dir``, e.g. ``kivy._event`` for
+    ``kivy/_event.cpython-38-x86_64-linux-gnu.so``.'''
+    dirn, basename = split(os.path.relpath(filename, site_packages_dir))
+    parts = [part for part in dirn.split(os.sep) if part]
+    return '.'.join(parts + [basename.split('.')[0]])
+
+
+def collect_linked_extensions(ctx, arch):
+    '''Returns the object files (without their ``.o``) tools/liblink
+    linked the extension modules of the recipes to, by module name.
+
+    The placeholders liblink installed in the site-packages are replaced
+    by a ``.module`` file next to their object file, so that the modules
+    of the recipes that are not rebuilt are known to later builds. When a
+    recipe is installed again, the ``.module`` files of its objects that
+    it no longer installs (e.g. of a module dropped from the recipe) are
+    removed.'''
+    site_packages_dir = ctx.get_site_packages_dir(arch)
+    objects = {}
+    recipe_objects = []
+    for name in ctx.recipe_build_order:
+        recipe = Recipe.get_recipe(name, ctx)
+        objects_dir = join(recipe.get_build_container_dir(arch.arch),
+                           'objects_{}'.format(recipe.name))
+        if not isdir(objects_dir):
+            continue
+        recipe_objects.append(set())
+        for filename in os.listdir(objects_dir):
+            if (filename.endswith('.so.o') and
+                    exists(join(objects_dir, filename[:-1] + 'libs'))):
+                objects[filename[:-2]] = join(objects_dir, filename[:-2])
+                recipe_objects[-1].add(filename[:-2])
+
+    installed = set()
+    for root, dirnames, filenames in os.walk(site_packages_dir):
+        for filename in filenames:
+            if not filename.endswith('.so'):
+                continue
+            path = join(root, filename)
+            with open(path, 'rb') as fileh:
+                data = fileh.read(1024)
+            if not data.startswith(LIBLINK_PLACEHOLDER_PREFIX):
+                continue
+            object_name = data[len(LIBLINK_PLACEHOLDER_PREFIX):].decode(
+                'utf-8').strip()
+            if object_name not in objects:
+                raise BuildInterruptingException(
+                    'No object file {} to biglink {}, clean the build of '
+                    'the recipe installing it'.format(object_name, path))
+            with open(objects[object_name] + '.module', 'w') as fileh:
+                fileh.write(get_extension_module_name(site_packages_dir, path))
+            os.remove(path)
+            installed.add(object_name)
+
+    for names in recipe_objects:
+        if not names & installed:
+            continue
+        for object_name in names - installed:
+            if exists(objects[object_name] + '.module'):
+                os.remove(objects[object_name] + '.module')
+
+    modules = {}
+    for path in objects.values():
+        if exists(path + '.module'):
+            with open(path + '.module') as fileh:
+                modules[fileh.read()] = path
+    return modules
+
+
+def link_extension(object_path, filename, env):
+    '''Links the object file tools/liblink linked an extension module to
+    (without its ``.o``) into the shared library ``filename``, on its
+    own.'''
+    with open(object_path + '.libs') as fileh:
+        libs = [arg for arg in fileh.read().split(' ') if arg and arg != '-L']
+    cc_name = env['CC']
+    cc = sh.Command(cc_name.split()[0])
+    cc = cc.bake(*cc_name.split()[1:])
+    shprint(cc, '-shared', '-o', filename, object_path + '.o', *libs,
+            _env=env)
+
+
+def remove_biglinked_modules(ctx, arch):
+    '''Removes the library and the module installed by
+    :func:`biglink_modules`, if any.'''
+    site_packages_dir = ctx.get_site_packages_dir(arch)
+    for filename in (PYMODULES_LIBRARY, PYMODULES_FINDER_MODULE + '.py'):
+        with suppress(FileNotFoundError):
+            os.remove(join(site_packages_dir, filename))
+
+
+def biglink_modules(ctx, arch):
+    '''Links the extension modules of the recipes, that tools/liblink
+    linked to object files (see ``--biglink``), into a single
+    libpymodules.so in the site-packages, and installs the module
+    importing them from it.
+
+    Python finds the init function of a module by its last name only
+    (``PyInit_buffer`` for ``kivy.graphics.buffer``), so the modules with
+    the name of another one are linked to their own library instead, as
+    without biglink.'''
+    site_packages_dir = ctx.get_site_packages_dir(arch)
+    modules = collect_linked_extensions(ctx, arch)
+    env = arch.get_env()
 
-    shprint(cc, '-shared', '-O3', '-o', soname, *unique_args, _env=env)
+    biglinked = {}
+    for module in sorted(modules):
+        short_name = module.rpartition('.')[2]
+        if short_name not in biglinked:
+            biglinked[short_name] = module
+            continue
+        info('{} has the name of {}, linking it on its own'.format(
+            module, biglinked[short_name]))
+        link_extension(modules[module], join(
+            site_packages_dir, *module.split('.')) + '.so', env)
+    biglinked = sorted(biglinked.values())
+    if not biglinked:
+        info('There seem to be no extension modules to biglink, skipping.')
+        remove_biglinked_modules(ctx, arch)
+        return
+
+    # Only the object files of the biglinked modules go in the objects
+    # dir given to biglink_function()
+    objects_dir = join(ctx.build_dir, 'biglink', arch.arch)
+    ensure_dir(objects_dir)
+    for filename in os.listdir(objects_dir):
+        if filename.endswith(('.so.o', '.so.libs')):
+            os.remove(join(objects_dir, filename))
+    for module in biglinked:
+        for ext in ('.o', '.libs'):
+            os.symlink(modules[module] + ext,
+                       join(objects_dir, module + '.so' + ext))
+
+    library = join(site_packages_dir, PYMODULES_LIBRARY)
+    info('Biglinking {} extension modules into {}'.format(
+        len(biglinked), library))
+    with current_directory(arch.ndk_lib_dir):
+        biglink_function(
+            library, [objects_dir],
+            extra_link_dirs=[ctx.get_libs_dir(arch.arch),
+                             os.path.abspath('.')],
+            env=env)
+    if not ctx.with_debug_symbols:
+        shprint(sh.Command(env['STRIP'].split()[0]), '--strip-unneeded',
+                library, _env=env)
+
+    with open(join(site_packages_dir,
+                   PYMODULES_FINDER_MODULE + '.py'), 'w') as fileh:
+        fileh.write(PYMODULES_FINDER_TEMPLATE.format(
+            library=PYMODULES_LIBRARY,
+            modules='\n'.join('    {!r},'.format(module)
+                              for module in biglinked)))
+
+
+def get_library_index(libdirs):
+    '''Returns the path of the library found first in ``libdirs`` for each
+    library name, i.e. ``foo`` for ``libfoo.so``, ``foo.so`` or
+    ``libfoo.a``, in that order of precedence in each dir.'''
+    index = {}
+    for libdir in libdirs:
+        try:
+            filenames = os.listdir(libdir)
+        except OSError:
+            continue
+        dir_index = {}
+        for filename in filenames:
+            if filename.startswith('lib') and filename.endswith('.so'):
+                dir_index.setdefault(filename[3:-3], join(libdir, filename))
+        for filename in filenames:
+            if filename.endswith('.so'):
+                dir_index.setdefault(filename[:-3], join(libdir, filename))
+        for filename in filenames:
+            if filename.startswith('lib') and filename.endswith('.a'):
+                dir_index.setdefault(filename[3:-2], join(libdir, filename))
+        for lib, path in dir_index.items():
+            index.setdefault(lib, path)
+    return index
 
 
 def copylibs_function(soname, objs_paths, extra_link_dirs=None, env=None):
@@ -967,8 +1756,8 @@ def copylibs_function(soname, objs_paths, extra_link_dirs=None, env=None):
         extra_link_dirs = []
     print('objs_paths are', objs_paths)
 
-    re_needso = re.compile(r'^.*\(NEEDED\)\s+Shared library: \[lib(.*)\.so\]\s*$')
-    blacklist_libs = (
+    re_needso = re.compile(r'^lib(.*)\.so$')
+    blacklist_libs = {
         'c',
         'stdc++',
         'dl',
@@ -988,16 +1777,11 @@ def copylibs_function(soname, objs_paths, extra_link_dirs=None, env=None):
         'SDL2_ttf',
         'SDL2_image',
         'SDL2_mixer',
-    )
-    found_libs = []
+    }
+    found_libs = set()
     sofiles = []
-    if env and 'READELF' in env:
-        readelf = env['READELF']
-    elif 'READELF' in os.environ:
-        readelf = os.environ['READELF']
-    else:
-        readelf = sh.which('readelf').strip()
-    readelf = sh.Command(readelf).bake('-d')
+    # the libraries in the dirs of each .dirs file, by name
+    library_indexes = {}
 
     dest = dirname(soname)
 
@@ -1014,82 +1798,61 @@ def copylibs_function(soname, objs_paths, extra_link_dirs=None, env=None):
 
             with open(fn) as f:
                 libs = f.read().strip().split(' ')
-                needed_libs = [lib for lib in libs
+                needed_libs = [lib for lib in dict.fromkeys(libs)
                                if lib and
                                lib not in blacklist_libs and
                                lib not in found_libs]
 
+            with open(dirfn) as f:
+                # don't need to copy from dest to dest!
+                libdirs = tuple(libdir for libdir in f.read().split()
+                                if libdir != dest)
+            if libdirs not in library_indexes:
+                library_indexes[libdirs] = get_library_index(libdirs)
+            library_index = library_indexes[libdirs]
+
             while needed_libs:
                 print('need libs:\n\t' + '\n\t'.join(needed_libs))
 
-                start_needed_libs = needed_libs[:]
                 found_sofiles = []
+                missing_libs = []
+                for lib in needed_libs:
+                    if lib in found_libs:
+                        continue
+
+                    if lib.endswith('.a'):
+                        found_libs.add(lib)
+                        continue
+
+                    libpath = library_index.get(lib)
+                    if libpath is None:
+                        missing_libs.append(lib)
+                    elif libpath.endswith('.so'):
+                        print('found', lib, 'in', dirname(libpath))
+                        found_sofiles.append(libpath)
+                        found_libs.add(lib)
+                    else:
+                        print('found', lib, '(static) in', dirname(libpath))
+                        found_libs.add(lib)
 
-                with open(dirfn) as f:
-                    libdirs = f.read().split()
-                    for libdir in libdirs:
-                        if not needed_libs:
-                            break
-
-                        if libdir == dest:
-                            # don't need to copy from dest to dest!
-                            continue
-
-                        libdir = libdir.strip()
-                        print('scanning', libdir)
-                        for lib in needed_libs[:]:
-                            if lib in found_libs:
-                                continue
-
-                            if lib.endswith('.a'):
-                                needed_libs.remove(lib)
-                                found_libs.append(lib)
-                                continue
-
-                            lib_a = 'lib' + lib + '.a'
-                            libpath_a = join(libdir, lib_a)
-                            lib_so = 'lib' + lib + '.so'
-                            libpath_so = join(libdir, lib_so)
-                            plain_so = lib + '.so'
-                            plainpath_so = join(libdir, plain_so)
-
-                            sopath = None
-                            if exists(libpath_so):
-                                sopath = libpath_so
-                            elif exists(plainpath_so):
-                                sopath = plainpath_so
-
-                            if sopath:
-                                print('found', lib, 'in', libdir)
-                                found_sofiles.append(sopath)
-                                needed_libs.remove(lib)
-                                found_libs.append(lib)
-                                continue
-
-                            if exists(libpath_a):
-                                print('found', lib, '(static) in', libdir)
-                                needed_libs.remove(lib)
-                                found_libs.append(lib)
-                                continue
+                if len(missing_libs) == len(needed_libs):
+                    raise RuntimeError(
+                            'Failed to locate needed libraries!\n\t' +
+                            '\n\t'.join(needed_libs))
 
+                needed_libs = missing_libs
                 for sofile in found_sofiles:
                     print('scanning dependencies for', sofile)
-                    out = readelf(sofile)
-                    for line in out.splitlines():
-                        needso = re_needso.match(line)
+                    for needed in read_elf_file(sofile).needed:
+                        needso = re_needso.match(needed)
                         if needso:
                             lib = needso.group(1)
                             if (lib not in needed_libs
                                     and lib not in found_libs
                                     and lib not in blacklist_libs):
-                                needed_libs.append(needso.group(1))
+                                needed_libs.append(lib)
 
                 sofiles += found_sofiles
 
-                if needed_libs == start_needed_libs:
-                    raise RuntimeError(
-                            'Failed to locate needed libraries!\n\t' +
-                            '\n\t'.join(needed_libs))
-
     print('Copying libraries')
     shprint(sh.cp, *sofiles, dest)
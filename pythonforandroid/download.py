@@ -0,0 +1,413 @@
+"""
+Helpers to fetch and verify recipe sources.
+
+Downloads are written to a ``.part`` file next to their target and resumed
+with HTTP ``Range`` requests if they get interrupted, either by a network
+error (they are retried a few times) or because p4a itself was stopped.
+The progress of all the downloads running at the same time is shown in a
+single status line.
+
+The digests of downloaded files are computed in a single streaming pass,
+and recorded in a ``.digests-<filename>`` file next to them, so unchanged
+files don't have to be hashed again on later builds.
+
+If ``$P4A_DOWNLOAD_STORE`` is set, verified downloads are also kept in that
+directory, indexed by their digests, and shared by all the storage dirs
+(and users) pointing to it. Files are hardlinked (or cloned) from there
+instead of being downloaded again.
+
+Git repositories are kept as bare mirrors in a shared directory
+(``$P4A_GIT_MIRRORS``), so that the clones of each storage dir only have
+to fetch objects locally.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from contextlib import contextmanager
+from os import environ, makedirs, replace, stat, unlink
+from os.path import basename, dirname, exists, getsize, isfile, join
+from sys import stdout
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import hashlib
+import json
+import threading
+import time
+
+from appdirs import user_cache_dir
+import sh
+
+from pythonforandroid.logger import debug, info, shprint, warning
+from pythonforandroid.util import clone_file
+
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_DOWNLOAD_JOBS = 4
+'''How many recipes are downloaded at the same time by default.'''
+
+DOWNLOAD_STORE_VARIABLE = 'P4A_DOWNLOAD_STORE'
+
+STORE_ALGORITHMS = ('sha512', 'blake2b', 'sha256', 'sha1', 'md5')
+'''The digests usable to index the download store, preferred first.'''
+
+GIT_MIRRORS_VARIABLE = 'P4A_GIT_MIRRORS'
+
+GIT_SHALLOW_VARIABLE = 'P4A_GIT_SHALLOW'
+
+USER_AGENT = 'Wget/1.0'
+# jqueryui.com returns a 403 w/ the default user agent
+# Mozilla/5.0 doesnt handle redirection for liblzma
+
+
+def format_size(num_bytes):
+    '''Returns a human readable representation of a size in bytes.'''
+    for unit in ('B', 'KB', 'MB'):
+        if num_bytes < 1024:
+            return '{:.1f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024.
+    return '{:.1f} GB'.format(num_bytes)
+
+
+class DownloadProgress:
+    '''Aggregates the progress of all the running downloads into a single
+    status line. Safe to use from several threads.'''
+
+    refresh_interval = 0.2
+
+    def __init__(self, stream=stdout):
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._downloads = {}
+        self._last_render = 0
+
+    def update(self, url, downloaded, total=None):
+        '''Records that ``downloaded`` bytes out of ``total`` (if known)
+        have been fetched from ``url``.'''
+        with self._lock:
+            self._downloads[url] = (downloaded, total)
+            now = time.monotonic()
+            if now - self._last_render >= self.refresh_interval:
+                self._last_render = now
+                self._render()
+
+    def finish(self, url):
+        '''Removes a completed (or failed) download from the display.'''
+        with self._lock:
+            self._downloads.pop(url, None)
+            self._render()
+
+    @property
+    def status(self):
+        '''The text of the status line for the running downloads.'''
+        downloaded = sum(done for done, _ in self._downloads.values())
+        totals = [total for _, total in self._downloads.values()]
+        status = '- Download {} file{}: {}'.format(
+            len(totals), '' if len(totals) == 1 else 's',
+            format_size(downloaded))
+        if totals and None not in totals and sum(totals) > 0:
+            status += ' of {} ({:.2f}%)'.format(
+                format_size(sum(totals)), downloaded * 100. / sum(totals))
+        return status
+
+    def _render(self):
+        if "CI" in environ:
+            return
+        if self._downloads:
+            self.stream.write('{:<79}\r'.format(self.status))
+        else:
+            self.stream.write('{:<79}\r'.format(''))
+        self.stream.flush()
+
+
+download_progress = DownloadProgress()
+'''The status line shared by all the downloads.'''
+
+
+def _read_validator(partial):
+    try:
+        with open(partial + '.validator') as fileh:
+            return fileh.read().strip() or None
+    except OSError:
+        return None
+
+
+def _write_validator(partial, validator):
+    if validator:
+        with open(partial + '.validator', 'w') as fileh:
+            fileh.write(validator)
+    elif exists(partial + '.validator'):
+        unlink(partial + '.validator')
+
+
+def _fetch(url, partial, progress):
+    '''(internal) Fetches ``url`` into ``partial``, continuing from the
+    bytes already present in ``partial`` if the server allows it.'''
+    offset = getsize(partial) if exists(partial) else 0
+    request = Request(url, headers={'User-agent': USER_AGENT})
+    validator = _read_validator(partial)
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+        if validator:
+            # the server answers with the whole file if it has changed
+            request.add_header('If-Range', validator)
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code == 416:
+            # Our partial file can't be continued, start over
+            unlink(partial)
+        raise
+
+    with response:
+        if offset and response.status != 206:
+            offset = 0
+        if not offset:
+            _write_validator(partial, response.headers.get('ETag') or
+                             response.headers.get('Last-Modified'))
+        length = response.headers.get('Content-Length')
+        total = int(length) + offset if length is not None else None
+
+        with open(partial, 'ab' if offset else 'wb') as fileh:
+            downloaded = offset
+            progress.update(url, downloaded, total)
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fileh.write(chunk)
+                downloaded += len(chunk)
+                progress.update(url, downloaded, total)
+
+    if total is not None and downloaded < total:
+        raise OSError('Download of {} interrupted after {} of {} '
+                      'bytes'.format(url, downloaded, total))
+
+
+def fetch_url(url, target, attempts=5, progress=None):
+    '''Downloads ``url`` to the file ``target``.
+
+    The data is first written to ``target + '.part'``, which is renamed to
+    ``target`` once complete. If a partial download exists, it is resumed
+    with an HTTP ``Range`` request. On network errors the download is
+    retried (and resumed) up to ``attempts`` times, waiting a bit longer
+    before each new attempt.
+    '''
+    if progress is None:
+        progress = download_progress
+    partial = target + '.part'
+    attempt = 0
+    seconds = 1
+    try:
+        while True:
+            try:
+                _fetch(url, partial, progress)
+            except (OSError, HTTPException) as e:
+                attempt += 1
+                if attempt >= attempts:
+                    raise
+                warning('Download of {} failed: {}; retrying in {} '
+                        'second(s)...'.format(url, e, seconds))
+                time.sleep(seconds)
+                seconds *= 2
+                continue
+            break
+    finally:
+        progress.finish(url)
+
+    replace(partial, target)
+    _write_validator(partial, None)
+    return target
+
+
+def download_recipes(recipes, jobs=DEFAULT_DOWNLOAD_JOBS):
+    '''Downloads the sources of all the given recipes (see
+    :meth:`~pythonforandroid.recipe.Recipe.download_if_necessary`),
+    running up to ``jobs`` downloads at the same time.
+    '''
+    if jobs <= 1:
+        for recipe in recipes:
+            recipe.download_if_necessary()
+        return
+    with ThreadPoolExecutor(max_workers=jobs,
+                            thread_name_prefix='p4a-download') as executor:
+        futures = [executor.submit(recipe.download_if_necessary)
+                   for recipe in recipes]
+    # re-raises the first error, if any
+    for future in futures:
+        future.result()
+
+
+def file_digests(filename, algs):
+    '''Returns a dict with the hex digest of ``filename`` for each of the
+    given hashlib algorithm names, reading the file only once and in
+    chunks.'''
+    hashes = {alg: getattr(hashlib, alg)() for alg in algs}
+    with open(filename, 'rb') as fileh:
+        while True:
+            chunk = fileh.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            for digest in hashes.values():
+                digest.update(chunk)
+    return {alg: digest.hexdigest() for alg, digest in hashes.items()}
+
+
+def get_digests_record_filename(filename):
+    '''Returns the path of the file recording the digests of
+    ``filename``.'''
+    return join(dirname(filename), '.digests-{}'.format(basename(filename)))
+
+
+def cached_file_digests(filename, algs):
+    '''Same as :func:`file_digests`, but reuses the digests recorded
+    for ``filename`` as long as its size and modification time are
+    unchanged. Newly computed digests are added to the record.'''
+    record_filename = get_digests_record_filename(filename)
+    file_stat = stat(filename)
+    key = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns}
+
+    digests = {}
+    try:
+        with open(record_filename) as fileh:
+            record = json.load(fileh)
+        if all(record.get(name) == value for name, value in key.items()):
+            digests = record.get('digests', {})
+    except (OSError, ValueError):
+        pass
+
+    missing_algs = [alg for alg in algs if alg not in digests]
+    if missing_algs:
+        digests.update(file_digests(filename, missing_algs))
+        record = dict(key, digests=digests)
+        # write then rename, so that a concurrent reader never sees a
+        # partially written record
+        with open(record_filename + '.tmp', 'w') as fileh:
+            json.dump(record, fileh)
+        replace(record_filename + '.tmp', record_filename)
+    return {alg: digests[alg] for alg in algs}
+
+
+def get_download_store():
+    '''Returns the directory of the shared download store, or None if it
+    is not enabled.'''
+    return environ.get(DOWNLOAD_STORE_VARIABLE) or None
+
+
+def get_store_filename(store, alg, digest):
+    '''Returns where the file with the given digest is kept in
+    ``store``.'''
+    return join(store, alg, digest[:2], digest)
+
+
+def _store_keys(expected_digests):
+    return [(alg, expected_digests[alg].lower())
+            for alg in STORE_ALGORITHMS if alg in expected_digests]
+
+
+def fetch_from_store(target, expected_digests, store=None):
+    '''Creates ``target`` from the download store if it holds a file
+    with one of the ``expected_digests``. Returns whether it did.
+
+    The caller is still responsible for checking the digests of
+    ``target``, as the store may be shared with other users.
+    '''
+    store = store or get_download_store()
+    if store is None:
+        return False
+    for alg, digest in _store_keys(expected_digests):
+        store_filename = get_store_filename(store, alg, digest)
+        if isfile(store_filename):
+            debug('Using {} from the download store'.format(store_filename))
+            clone_file(store_filename, target)
+            return True
+    return False
+
+
+def add_to_store(filename, expected_digests, store=None):
+    '''Adds the (already verified) file ``filename`` to the download
+    store, indexed by each of its ``expected_digests``.'''
+    store = store or get_download_store()
+    if store is None:
+        return
+    for alg, digest in _store_keys(expected_digests):
+        store_filename = get_store_filename(store, alg, digest)
+        if isfile(store_filename):
+            continue
+        try:
+            makedirs(dirname(store_filename), exist_ok=True)
+            clone_file(filename, store_filename)
+        except OSError as e:
+            # the store is only an optimisation, never fail the build
+            warning('Could not add {} to the download store: {}'.format(
+                filename, e))
+
+
+def get_git_mirrors_dir():
+    '''Returns the directory holding the shared git mirrors.'''
+    return (environ.get(GIT_MIRRORS_VARIABLE) or
+            join(user_cache_dir('python-for-android'), 'git-mirrors'))
+
+
+def use_shallow_git_clones():
+    '''Returns whether git sources should be cloned with only the
+    revision to build, as asked by ``$P4A_GIT_SHALLOW``.'''
+    return environ.get(GIT_SHALLOW_VARIABLE, '0').lower() not in (
+        '', '0', 'false', 'no')
+
+
+def get_git_mirror_path(url, mirrors_dir=None):
+    '''Returns where the bare mirror of the git repository ``url`` is
+    kept.'''
+    name = basename(url.rstrip('/'))
+    if name.endswith('.git'):
+        name = name[:-4]
+    return join(mirrors_dir or get_git_mirrors_dir(), '{}-{}.git'.format(
+        name, hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]))
+
+
+@contextmanager
+def _locked(filename):
+    '''Holds an exclusive lock on ``filename`` (created if needed),
+    shared with other processes.'''
+    import fcntl
+    with open(filename, 'a') as fileh:
+        fcntl.flock(fileh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fileh, fcntl.LOCK_UN)
+
+
+def update_git_mirror(url, mirrors_dir=None):
+    '''Creates or updates the bare mirror of the git repository ``url``,
+    with all its branches and tags, and returns its path.
+
+    If the mirror can't be updated (e.g. when offline), the existing one is
+    used as is.
+    '''
+    mirror = get_git_mirror_path(url, mirrors_dir)
+    makedirs(dirname(mirror), exist_ok=True)
+    with _locked(mirror + '.lock'):
+        if not exists(mirror):
+            info('Creating the git mirror of {}'.format(url))
+            temp_mirror = mirror + '.tmp'
+            if exists(temp_mirror):
+                shprint(sh.rm, '-rf', temp_mirror)
+            shprint(sh.git, 'clone', '--bare', url, temp_mirror)
+            # like --mirror, but without the other refs some hosts have
+            # (e.g. the pull requests on GitHub)
+            shprint(sh.git, 'config', 'remote.origin.fetch',
+                    '+refs/heads/*:refs/heads/*', _cwd=temp_mirror)
+            replace(temp_mirror, mirror)
+        else:
+            info('Updating the git mirror of {}'.format(url))
+            try:
+                shprint(sh.git, 'fetch', '--prune', '--tags', 'origin',
+                        _cwd=mirror)
+            except sh.ErrorReturnCode as e:
+                warning('Could not update the git mirror of {}, using it '
+                        'as is: {}'.format(url, e))
+    return mirror
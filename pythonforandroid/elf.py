@@ -0,0 +1,192 @@
+"""
+Reader of the dynamic section of ELF shared libraries.
+
+Finding the libraries a shared library needs (its ``NEEDED`` entries) or
+whether it still has a symbol table used to take a ``readelf`` process
+per library. Only a few headers of the file are needed for that, so they
+are read here instead, for 32 and 64-bit libraries of either endianness.
+
+The results are kept by path, size and modification time of the file, so
+a library is only read once per build.
+"""
+
+from collections import namedtuple
+import os
+import struct
+
+
+ELF_MAGIC = b'\x7fELF'
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+
+SHT_SYMTAB = 2
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+
+# the struct formats of the headers after e_ident, of the program headers,
+# section headers and dynamic entries, by ELF class
+HEADER_FORMATS = {
+    ELFCLASS32: 'HHIIIIIHHHHHH',
+    ELFCLASS64: 'HHIQQQIHHHHHH',
+}
+PROGRAM_HEADER_FORMATS = {
+    # p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags,
+    # p_align
+    ELFCLASS32: 'IIIIIIII',
+    # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz,
+    # p_align
+    ELFCLASS64: 'IIQQQQQQ',
+}
+SECTION_HEADER_FORMATS = {
+    ELFCLASS32: 'IIIIIIIIII',
+    ELFCLASS64: 'IIQQQQIIQQ',
+}
+DYNAMIC_FORMATS = {
+    ELFCLASS32: 'iI',
+    ELFCLASS64: 'qQ',
+}
+
+# the ELF files read by this process, by path
+_elf_files = {}
+
+
+ElfFile = namedtuple('ElfFile', [
+    'path', 'bits', 'little_endian', 'machine', 'needed', 'soname',
+    'has_symtab'])
+ElfFile.__doc__ = '''The headers of an ELF file: ``bits`` is 32 or 64,
+``needed`` the names of the libraries it needs (e.g. ``libc.so``),
+``soname`` its own name if set, and ``has_symtab`` whether it still has
+a symbol table, i.e. whether it's not stripped.'''
+
+
+def _read_struct(fileh, byte_order, fmt, offset, count=1):
+    size = struct.calcsize(byte_order + fmt)
+    fileh.seek(offset)
+    data = fileh.read(size * count)
+    if len(data) < size * count:
+        raise ValueError('Truncated ELF file: {}'.format(fileh.name))
+    return [struct.unpack_from(byte_order + fmt, data, index * size)
+            for index in range(count)]
+
+
+def _read_string(fileh, offset):
+    fileh.seek(offset)
+    data = b''
+    while b'\0' not in data:
+        chunk = fileh.read(64)
+        if not chunk:
+            break
+        data += chunk
+    return data.partition(b'\0')[0].decode('utf-8', 'replace')
+
+
+def _read_elf_file(path):
+    with open(path, 'rb') as fileh:
+        ident = fileh.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ValueError('Not an ELF file: {}'.format(path))
+        elf_class, data_encoding = ident[4], ident[5]
+        if elf_class not in HEADER_FORMATS or data_encoding not in (
+                ELFDATA2LSB, ELFDATA2MSB):
+            raise ValueError('Unsupported ELF file: {}'.format(path))
+        byte_order = '<' if data_encoding == ELFDATA2LSB else '>'
+        (_, machine, _, _, phoff, shoff, _, _, phentsize, phnum, shentsize,
+         shnum, _) = _read_struct(
+             fileh, byte_order, HEADER_FORMATS[elf_class], 16)[0]
+
+        # the dynamic section, and where the file is loaded to find its
+        # string table
+        segments = []
+        dynamic = None
+        for index in range(phnum):
+            header = _read_struct(
+                fileh, byte_order, PROGRAM_HEADER_FORMATS[elf_class],
+                phoff + index * phentsize)[0]
+            if elf_class == ELFCLASS32:
+                p_type, p_offset, p_vaddr, _, p_filesz = header[:5]
+            else:
+                p_type, _, p_offset, p_vaddr, _, p_filesz = header[:6]
+            if p_type == PT_LOAD:
+                segments.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+
+        needed_offsets = []
+        soname_offset = None
+        strtab = None
+        if dynamic is not None:
+            dynamic_format = DYNAMIC_FORMATS[elf_class]
+            entry_size = struct.calcsize(byte_order + dynamic_format)
+            entries = _read_struct(
+                fileh, byte_order, dynamic_format, dynamic[0],
+                dynamic[1] // entry_size)
+            for tag, value in entries:
+                if tag == DT_NULL:
+                    break
+                elif tag == DT_NEEDED:
+                    needed_offsets.append(value)
+                elif tag == DT_SONAME:
+                    soname_offset = value
+                elif tag == DT_STRTAB:
+                    strtab = value
+        for vaddr, offset, filesz in segments:
+            if strtab is not None and vaddr <= strtab < vaddr + filesz:
+                strtab_offset = strtab - vaddr + offset
+                break
+        else:
+            if needed_offsets or soname_offset is not None:
+                raise ValueError(
+                    'No string table in ELF file: {}'.format(path))
+            strtab_offset = 0
+
+        has_symtab = any(
+            header[1] == SHT_SYMTAB for header in (
+                _read_struct(fileh, byte_order,
+                             SECTION_HEADER_FORMATS[elf_class],
+                             shoff + index * shentsize)[0]
+                for index in range(shnum if shoff else 0)))
+
+        return ElfFile(
+            path=path,
+            bits=32 if elf_class == ELFCLASS32 else 64,
+            little_endian=data_encoding == ELFDATA2LSB,
+            machine=machine,
+            needed=[_read_string(fileh, strtab_offset + offset)
+                    for offset in needed_offsets],
+            soname=(None if soname_offset is None else
+                    _read_string(fileh, strtab_offset + soname_offset)),
+            has_symtab=has_symtab,
+        )
+
+
+def read_elf_file(path):
+    '''Returns the :class:`ElfFile` of the ELF file ``path``, reading it
+    only if it changed since it was last read.
+
+    Raises ValueError if it's not an ELF file.'''
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    cached = _elf_files.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    elf_file = _read_elf_file(path)
+    _elf_files[path] = (key, elf_file)
+    return elf_file
+
+
+def is_elf_file(path):
+    '''Returns whether ``path`` is an ELF file.'''
+    try:
+        read_elf_file(path)
+    except (OSError, ValueError):
+        return False
+    return True
@@ -0,0 +1,210 @@
+"""
+Fingerprints of the inputs of recipe builds.
+
+Each recipe build records, per arch, a fingerprint of everything it was
+built from, so that a recipe is rebuilt when one of them changes, instead
+of only when its outputs are missing:
+
+- the *source* fingerprint covers the recipe version and url, the digest
+  of its download and the files of the recipe dir (module and patches).
+  When it changes, the unpacked sources are discarded before unpacking.
+- the *build* fingerprint adds the environment the recipe builds with,
+  the NDK and API levels, and the build fingerprints of the recipes it
+  depends on, so that their dependents get rebuilt as well. When it
+  changes, the recipe is built again from freshly unpacked sources.
+
+The fingerprints are recorded by build dir, so that the recipes built
+once for all the archs (e.g. hostpython3) are only built once.
+"""
+
+from os import environ, makedirs, replace
+from os.path import dirname, exists, isfile, join, pardir, relpath
+import hashlib
+import json
+import shutil
+
+from pythonforandroid import __version__
+from pythonforandroid.download import cached_file_digests
+from pythonforandroid.graph import fix_deplist
+from pythonforandroid.logger import debug, info
+from pythonforandroid.recipe import Recipe
+from pythonforandroid.util import walk_valid_filens
+
+
+def _digest(data):
+    return hashlib.sha256(json.dumps(
+        data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def is_arch_independent(recipe):
+    '''Returns whether ``recipe`` is built once for all the archs, i.e.
+    whether its build dir doesn't depend on the arch (e.g. hostpython3).'''
+    return (recipe.get_build_container_dir('armeabi-v7a') ==
+            recipe.get_build_container_dir('arm64-v8a'))
+
+
+def get_fingerprint_filename(recipe, arch):
+    '''Returns the file where the fingerprints of the last build of
+    ``recipe`` for ``arch`` are recorded, which depends on its build dir
+    (so on the arch, NDK API and recipe choices, when it does).'''
+    ctx = recipe.ctx
+    build_dir = recipe.get_build_container_dir(arch.arch)
+    name = relpath(build_dir, ctx.build_dir)
+    if name.startswith(pardir):
+        name = hashlib.sha256(build_dir.encode('utf-8')).hexdigest()
+    return join(ctx.build_dir, 'fingerprints', name + '.json')
+
+
+def read_fingerprints(recipe, arch):
+    '''Returns the recorded fingerprints of ``recipe`` for ``arch``, as a
+    dict with the ``source`` and ``build`` keys, or an empty dict.'''
+    try:
+        with open(get_fingerprint_filename(recipe, arch)) as fileh:
+            return json.load(fileh)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_fingerprints(recipe, arch, source, build):
+    '''Records the fingerprints of a successful build of ``recipe``.'''
+    filename = get_fingerprint_filename(recipe, arch)
+    makedirs(dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'w') as fileh:
+        json.dump({'source': source, 'build': build}, fileh)
+    replace(filename + '.tmp', filename)
+
+
+def get_recipe_files_digest(recipe):
+    '''Returns a digest of all the files of the recipe dir: the recipe
+    module itself, its patches and any other file it uses.'''
+    recipe_dir = recipe.get_recipe_dir()
+    digest = hashlib.sha256()
+    filenames = walk_valid_filens(recipe_dir, ['__pycache__'], ['*.pyc'])
+    for filename in sorted(filenames):
+        digest.update(relpath(filename, recipe_dir).encode('utf-8') + b'\0')
+        with open(filename, 'rb') as fileh:
+            digest.update(fileh.read())
+    return digest.hexdigest()
+
+
+def get_source_fingerprint(recipe, arch):
+    '''Returns the fingerprint of the sources ``recipe`` is built from.'''
+    data = {
+        'p4a': __version__,
+        'version': recipe.version,
+        'recipe_files': get_recipe_files_digest(recipe),
+        'user_dir': environ.get('P4A_{}_DIR'.format(recipe.name.lower())),
+    }
+    if recipe.url is not None:
+        url, filename, expected_digests = recipe.get_download_info()
+        data['url'] = url
+        data['digests'] = expected_digests
+        download = join(recipe.ctx.packages_path, recipe.name, filename)
+        if isfile(download):
+            data['download'] = cached_file_digests(
+                download, ['sha256'])['sha256']
+    return _digest(data)
+
+
+def get_recipe_dependencies(recipe):
+    '''Returns the names of the recipes of the current build order
+    ``recipe`` depends on, optionally or not.'''
+    build_order = recipe.ctx.recipe_build_order or []
+    dependencies = set()
+    for dep_tuple in fix_deplist(recipe.depends or []) + fix_deplist(
+            recipe.opt_depends or []):
+        dependencies.update(dep for dep in dep_tuple if dep in build_order)
+    dependencies.discard(recipe.name)
+    return sorted(dependencies)
+
+
+def get_build_env(recipe, arch):
+    '''Returns the part of the recipe environment that is specific to the
+    build (i.e. differs from our own environment), without ``PATH``.'''
+    env = recipe.get_recipe_env(arch)
+    return {
+        key: value for key, value in env.items()
+        if key != 'PATH' and environ.get(key) != value
+    }
+
+
+def get_build_fingerprint(recipe, arch, source_fingerprint):
+    '''Returns the fingerprint of all the inputs of the build of
+    ``recipe`` for ``arch``. The recipes it depends on must have been
+    built already.'''
+    ctx = recipe.ctx
+    dependencies = {}
+    for name in get_recipe_dependencies(recipe):
+        dependency = Recipe.get_recipe(name, ctx)
+        dependencies[name] = read_fingerprints(dependency, arch).get('build')
+    data = {
+        'source': source_fingerprint,
+        'dependencies': dependencies,
+    }
+    if not is_arch_independent(recipe):
+        # what the recipes built for the host don't build with
+        data.update({
+            'arch': arch.arch,
+            'ndk_api': ctx.ndk_api,
+            'android_api': getattr(ctx, '_android_api', None),
+            'env': get_build_env(recipe, arch),
+        })
+    return _digest(data)
+
+
+def discard_outdated_sources(recipe, arch):
+    '''Deletes the unpacked sources of ``recipe`` for ``arch`` if they
+    were unpacked from different sources than the current ones (e.g. an
+    older version, or other patches), so that they get unpacked again.
+
+    Only the sources unpacked by p4a itself in its build dir are
+    discarded, never the ones living e.g. in the bootstrap.
+    '''
+    build_dir = recipe.get_build_dir(arch.arch)
+    other_builds = join(recipe.ctx.build_dir, 'other_builds')
+    if (recipe.url is None or not exists(build_dir) or
+            not build_dir.startswith(other_builds)):
+        return
+    recorded = read_fingerprints(recipe, arch).get('source')
+    if recorded == get_source_fingerprint(recipe, arch):
+        return
+    info('The sources of {} for {} changed, unpacking them again'.format(
+        recipe.name, arch.arch))
+    shutil.rmtree(build_dir)
+
+
+def discard_outdated_build(recipe, arch, source_fingerprint,
+                           build_fingerprint):
+    '''Deletes the build dir of ``recipe`` for ``arch`` if it was last
+    built from the same sources but other inputs (e.g. other flags, NDK
+    or dependencies) than those giving ``build_fingerprint``, so that it
+    gets built again from fresh sources rather than in the tree of its
+    last build. Returns whether it did, in which case the sources must
+    be unpacked (and prebuilt) again.
+
+    Sources that changed were already unpacked again by
+    :func:`discard_outdated_sources`, and only the sources unpacked by
+    p4a itself are discarded.
+    '''
+    build_dir = recipe.get_build_dir(arch.arch)
+    other_builds = join(recipe.ctx.build_dir, 'other_builds')
+    if (recipe.url is None or not exists(build_dir) or
+            not build_dir.startswith(other_builds)):
+        return False
+    recorded = read_fingerprints(recipe, arch)
+    if (recorded.get('build') in (None, build_fingerprint) or
+            recorded.get('source') != source_fingerprint):
+        return False
+    info('{} for {} was built with other flags or dependencies, building '
+         'it again from fresh sources'.format(recipe.name, arch.arch))
+    shutil.rmtree(build_dir)
+    return True
+
+
+def is_build_outdated(recipe, arch, build_fingerprint):
+    '''Returns whether ``recipe`` was last built for ``arch`` from other
+    inputs than those giving ``build_fingerprint``.'''
+    recorded = read_fingerprints(recipe, arch).get('build')
+    if recorded is None:
+        debug('No build fingerprint recorded for {}'.format(recipe.name))
+    return recorded != build_fingerprint
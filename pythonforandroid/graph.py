@@ -1,8 +1,15 @@
-from copy import deepcopy
+from collections import namedtuple
+from os.path import join
+import hashlib
+import heapq
+import json
 from itertools import product
 
+from pythonforandroid import __version__
 from pythonforandroid.logger import info
-from pythonforandroid.recipe import Recipe
+from pythonforandroid.probes import ProbeCache
+from pythonforandroid.recipeindex import (
+    get_metadata, get_recipe_index, get_recipe_metadata)
 from pythonforandroid.bootstrap import Bootstrap
 from pythonforandroid.util import BuildInterruptingException
 
@@ -29,7 +36,7 @@ class RecipeOrder(dict):
     def conflicts(self):
         for name in self.keys():
             try:
-                recipe = Recipe.get_recipe(name, self.ctx)
+                recipe = get_recipe_metadata(name, self.ctx)
                 conflicts = [dep.lower() for dep in recipe.conflicts]
             except ValueError:
                 conflicts = []
@@ -52,95 +59,109 @@ def get_dependency_tuple_list_for_recipe(recipe, blacklist=None):
         # Turn all dependencies into tuples so that product will work
         dependencies = fix_deplist(recipe.depends)
 
-        # Filter out blacklisted items and turn lowercase:
+        # Filter out blacklisted items, keeping the order of the
+        # alternatives:
         dependencies = [
-            tuple(set(deptuple) - blacklist)
+            tuple(dep for dep in deptuple if dep not in blacklist)
             for deptuple in dependencies
-            if tuple(set(deptuple) - blacklist)
+            if set(deptuple) - blacklist
         ]
     return dependencies
 
 
-def recursively_collect_orders(
-        name, ctx, all_inputs, orders=None, blacklist=None
-        ):
-    '''For each possible recipe ordering, try to add the new recipe name
-    to that order. Recursively do the same thing with all the
-    dependencies of each recipe.
+def _sort_topologically(graph):
+    '''Yields the level and name of each item of the dependency graph
+    dict, in topological order, level by level and sorted by name in each
+    level. An item's level is the length of its longest chain of
+    dependencies.
 
+    This is Kahn's algorithm, the items whose dependencies have all been
+    yielded being kept in a heap by level and name.
     '''
-    name = name.lower()
-    if orders is None:
-        orders = []
-    if blacklist is None:
-        blacklist = set()
-    try:
-        recipe = Recipe.get_recipe(name, ctx)
-        dependencies = get_dependency_tuple_list_for_recipe(
-            recipe, blacklist=blacklist
-        )
-
-        # handle opt_depends: these impose requirements on the build
-        # order only if already present in the list of recipes to build
-        dependencies.extend(fix_deplist(
-            [[d] for d in recipe.get_opt_depends_in_list(all_inputs)
-             if d.lower() not in blacklist]
-        ))
-
-        if recipe.conflicts is None:
-            conflicts = []
-        else:
-            conflicts = [dep.lower() for dep in recipe.conflicts]
-    except ValueError:
-        # The recipe does not exist, so we assume it can be installed
-        # via pip with no extra dependencies
-        dependencies = []
-        conflicts = []
+    dependents = {name: [] for name in graph}
+    indegrees = {}
+    for name, deps in graph.items():
+        deps = set(deps)
+        indegrees[name] = len(deps)
+        for dep in deps:
+            if dep not in dependents:
+                raise ValueError(
+                    '{} depends on {}, which is not in the dependency '
+                    'graph'.format(name, dep))
+            dependents[dep].append(name)
+    ready = [(0, name) for name, indegree in indegrees.items()
+             if not indegree]
+    heapq.heapify(ready)
+    while ready:
+        level, name = heapq.heappop(ready)
+        yield level, name
+        for dependent in dependents[name]:
+            indegrees[dependent] -= 1
+            if not indegrees[dependent]:
+                # the last dependency yielded has the highest level
+                heapq.heappush(ready, (level + 1, dependent))
+
+    remaining = {name for name, indegree in indegrees.items() if indegree}
+    if remaining:
+        # each remaining item depends on another one, so following those
+        # dependencies ends up in a cycle
+        path = {}
+        name = min(remaining)
+        while name not in path:
+            path[name] = len(path)
+            name = min(set(graph[name]) & remaining)
+        cycle = list(path)[path[name]:] + [name]
+        raise ValueError('Dependency cycle detected: {}'.format(
+            ' -> '.join(cycle)))
 
-    new_orders = []
-    # for each existing recipe order, see if we can add the new recipe name
-    for order in orders:
-        if name in order:
-            new_orders.append(deepcopy(order))
-            continue
-        if order.conflicts():
-            continue
-        if any([conflict in order for conflict in conflicts]):
-            continue
-
-        for dependency_set in product(*dependencies):
-            new_order = deepcopy(order)
-            new_order[name] = set(dependency_set)
 
-            dependency_new_orders = [new_order]
-            for dependency in dependency_set:
-                dependency_new_orders = recursively_collect_orders(
-                    dependency, ctx, all_inputs, dependency_new_orders,
-                    blacklist=blacklist
-                )
+def find_order(graph):
+    '''
+    Do a topological sort on the dependency graph dict.
 
-            new_orders.extend(dependency_new_orders)
+    Items are yielded once all their dependencies have been, and those
+    available at the same time are sorted for predictable order. Raises
+    ValueError naming the items of a dependency cycle, if any.
+    '''
+    for _, name in _sort_topologically(graph):
+        yield name
 
-    return new_orders
 
+def find_levels(graph):
+    '''Returns the items of the dependency graph dict grouped in sorted
+    lists, each item depending only on items of the previous lists. The
+    items of a list can thus be processed in parallel once the previous
+    lists have been.
 
-def find_order(graph):
+    Raises ValueError naming the items of a dependency cycle, if any.
     '''
-    Do a topological sort on the dependency graph dict.
+    levels = []
+    for level, name in _sort_topologically(graph):
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(name)
+    return levels
+
+
+def get_build_graph(ctx, build_order):
+    '''Returns a :class:`RecipeOrder` mapping each recipe of an already
+    resolved ``build_order`` to the set of recipes it has to be built
+    after.
+
+    Only recipes appearing earlier in ``build_order`` are taken into
+    account, so the resulting graph is always acyclic and any
+    topological sort of it is a valid build order.
     '''
-    while graph:
-        # Find all items without a parent
-        leftmost = [name for name, dep in graph.items() if not dep]
-        if not leftmost:
-            raise ValueError('Dependency cycle detected! %s' % graph)
-        # If there is more than one, sort them for predictable order
-        leftmost.sort()
-        for result in leftmost:
-            # Yield and remove them from the graph
-            yield result
-            graph.pop(result)
-            for bset in graph.values():
-                bset.discard(result)
+    graph = RecipeOrder(ctx)
+    for index, name in enumerate(build_order):
+        earlier = set(build_order[:index])
+        recipe = get_recipe_metadata(name, ctx)
+        dependencies = set()
+        for dep_tuple in fix_deplist(recipe.depends or []) + fix_deplist(
+                recipe.opt_depends or []):
+            dependencies.update(dep for dep in dep_tuple if dep in earlier)
+        graph[name] = dependencies
+    return graph
 
 
 def obvious_conflict_checker(ctx, name_tuples, blacklist=None):
@@ -173,7 +194,7 @@ def obvious_conflict_checker(ctx, name_tuples, blacklist=None):
             recipe_dependencies = []
             try:
                 # Get recipe to add and who's ultimately adding it:
-                recipe = Recipe.get_recipe(name, ctx)
+                recipe = get_recipe_metadata(name, ctx)
                 recipe_conflicts = {c.lower() for c in recipe.conflicts}
                 recipe_dependencies = get_dependency_tuple_list_for_recipe(
                     recipe, blacklist=blacklist
@@ -198,7 +219,7 @@ def obvious_conflict_checker(ctx, name_tuples, blacklist=None):
                     # (remember this function only catches obvious issues)
                     continue
                 try:
-                    dep_recipe = Recipe.get_recipe(dep_tuple_list[0], ctx)
+                    dep_recipe = get_recipe_metadata(dep_tuple_list[0], ctx)
                 except ValueError:
                     continue
                 conflicts = [c.lower() for c in dep_recipe.conflicts]
@@ -240,11 +261,260 @@ def obvious_conflict_checker(ctx, name_tuples, blacklist=None):
     return None
 
 
+# where the results of get_recipe_order_and_bootstrap() are recorded, in the
+# storage dir
+RESOLUTIONS_FILENAME = 'resolutions.json'
+
+
+ResolverState = namedtuple('ResolverState', [
+    'selected', 'excluded', 'graph', 'graph_hash', 'pending', 'inputs',
+    'path'])
+ResolverState.__doc__ = '''A partial choice of recipes: ``selected`` maps
+each chosen recipe to the recipe which depends on it (None for the
+requirements), ``excluded`` maps the recipes they conflict with to one of
+them, ``graph`` maps the recipes whose dependencies were chosen to those
+(``graph_hash`` being a hash of it), ``pending`` lists the recipes whose
+dependencies are still to be chosen, ``inputs`` is the chosen requirements
+and ``path`` is the index of each choice made so far.'''
+
+
+class DependencyResolver:
+    '''Chooses a recipe in each tuple of alternative dependencies of the
+    requirements ``names`` (as returned by :func:`fix_deplist`) and of their
+    recipes, so that none of the chosen recipes conflict with each other and
+    they can be ordered.
+
+    The choices are explored depth first, in the order the dependencies are
+    declared, backtracking on conflicts and dependency cycles. The states
+    that led nowhere are remembered, and so are the sets of recipes that
+    can't be built together (see :meth:`learn`), so they aren't explored
+    again.
+    '''
+
+    # how many of the dead ends met are explained on failure
+    max_reasons = 10
+
+    def __init__(self, ctx, names, blacklist=None):
+        self.ctx = ctx
+        self.names = names
+        self.blacklist = blacklist or set()
+        self.recipes = {}
+        self.reachable = {}
+        self.nogoods = {}
+        self.reasons = []
+
+    def get_recipe(self, name):
+        '''Returns the dependency tuples, the conflicts and the optional
+        dependencies of the recipe ``name``.'''
+        if name not in self.recipes:
+            try:
+                recipe = get_recipe_metadata(name, self.ctx)
+            except ValueError:
+                # The recipe does not exist, so we assume it can be
+                # installed via pip with no extra dependencies
+                self.recipes[name] = ([], set(), [])
+            else:
+                self.recipes[name] = (
+                    get_dependency_tuple_list_for_recipe(
+                        recipe, blacklist=self.blacklist),
+                    {dep.lower() for dep in recipe.conflicts or []},
+                    [dep.lower() for dep in recipe.opt_depends or []
+                     if dep.lower() not in self.blacklist])
+        return self.recipes[name]
+
+    def get_reachable(self, name):
+        '''Returns the recipes that ``name`` may depend on, directly or
+        not, whatever the choices.'''
+        if name not in self.reachable:
+            reachable = {name}
+            todo = [name]
+            while todo:
+                for dep_tuple in self.get_recipe(todo.pop())[0]:
+                    todo.extend(dep for dep in dep_tuple
+                                if dep not in reachable)
+                    reachable.update(dep_tuple)
+            self.reachable[name] = reachable
+        return self.reachable[name]
+
+    def explain(self, reason):
+        if reason not in self.reasons and len(self.reasons) < self.max_reasons:
+            self.reasons.append(reason)
+
+    @staticmethod
+    def describe(selected, name):
+        '''Returns the chain of dependencies which selected ``name``.'''
+        names = [name]
+        while selected.get(names[0]) is not None:
+            names.insert(0, selected[names[0]])
+        return ' -> '.join(names)
+
+    def learn(self, name, culprits):
+        '''Remembers that ``name`` can't be built along with all the
+        ``culprits``, because each choice of its dependencies conflicts with
+        one of them.
+
+        The dependencies of a selected recipe are always chosen at some
+        point, so no state in which all of these are selected is explored
+        again, and any recipe which can't be selected because of it is
+        learned from in turn.'''
+        nogood = frozenset(culprits | {name})
+        for member in nogood:
+            self.nogoods.setdefault(member, []).append(nogood)
+
+    def select(self, state, name, new):
+        '''Returns the selected and excluded recipes once the recipes
+        ``new`` are selected as dependencies of ``name``, or else None and
+        the already selected recipes to blame.'''
+        selected = dict(state.selected)
+        excluded = dict(state.excluded)
+        for dep in new:
+            selected[dep] = name
+            conflicts = self.get_recipe(dep)[1]
+            other = excluded.get(dep) or next(
+                (other for other in conflicts if other in selected), None)
+            if other is not None:
+                self.explain('{} conflicts with {}'.format(
+                    self.describe(selected, dep),
+                    self.describe(selected, other)))
+                return None, {other} - set(new)
+            for nogood in self.nogoods.get(dep, ()):
+                if nogood <= selected.keys():
+                    self.explain("{} can't be built along with {}".format(
+                        self.describe(selected, dep),
+                        ', '.join(sorted(nogood - {dep}))))
+                    return None, nogood - set(new)
+            excluded.update((other, dep) for other in conflicts)
+        return selected, excluded
+
+    def find_cycle(self, state, name, choice):
+        '''Returns whether depending on the recipes ``choice`` would make
+        ``name`` depend on itself.'''
+        for dep in choice:
+            paths = [[name, dep]]
+            seen = set()
+            while paths:
+                path = paths.pop()
+                if path[-1] == name:
+                    self.explain('dependency cycle: {}'.format(
+                        ' -> '.join(path)))
+                    return True
+                seen.add(path[-1])
+                paths.extend(path + [next_dep]
+                             for next_dep in state.graph.get(path[-1], ())
+                             if next_dep not in seen)
+        return False
+
+    def expand(self, state):
+        '''Yields the states resulting from each choice of the dependencies
+        of the first pending recipe of ``state`` (or of the requirements,
+        for the initial state).'''
+        name = state.pending[0]
+        if name is None:
+            dependencies = self.names
+        else:
+            dependencies, _, opt_depends = self.get_recipe(name)
+            # opt_depends impose requirements on the build order only if
+            # already present in the list of recipes to build
+            dependencies = dependencies + [
+                (dep,) for dep in opt_depends if dep in state.inputs]
+        culprits = set()
+        for index, choice in enumerate(product(*dependencies)):
+            choice = tuple(dict.fromkeys(choice))
+            new = [dep for dep in choice if dep not in state.selected]
+            selected, excluded = self.select(state, name, new)
+            if selected is None:
+                if culprits is not None:
+                    culprits |= excluded
+                continue
+            # whether a cycle appears depends on the other choices, so it
+            # isn't learned from
+            culprits = None
+            if name is not None and self.find_cycle(state, name, choice):
+                continue
+
+            graph = dict(state.graph)
+            graph_hash = state.graph_hash
+            if name is not None:
+                graph[name] = set(choice)
+                graph_hash ^= hash((name, choice))
+            # the dependencies are chosen depth first
+            front = tuple(dep for dep in choice if dep not in graph)
+            pending = front + tuple(
+                dep for dep in state.pending[1:] if dep not in front)
+            yield ResolverState(
+                selected, excluded, graph, graph_hash, pending,
+                frozenset(choice) if name is None else state.inputs,
+                state.path + (index,))
+        if culprits is not None and name is not None:
+            self.learn(name, culprits)
+
+    def may_select(self, state, required):
+        '''Returns whether the ``required`` recipes may still all be
+        selected from ``state``.'''
+        for name in required - state.selected.keys():
+            if name in state.excluded or any(
+                    other in state.selected
+                    for other in self.get_recipe(name)[1]):
+                return False
+            if not any(name in self.get_reachable(pending)
+                       for pending in state.pending):
+                return False
+        return True
+
+    def search(self, required=frozenset()):
+        '''Returns the first complete state in which all the ``required``
+        recipes are selected, or None.'''
+        # the graphs of the states that led nowhere, by graph hash, pending
+        # recipes and requirements
+        failed = {}
+        initial_state = ResolverState(
+            {}, {}, {}, 0, (None,), frozenset(), ())
+        stack = [(None, None, self.expand(initial_state))]
+        while stack:
+            key, graph, states = stack[-1]
+            state = next(states, None)
+            if state is None:
+                failed.setdefault(key, []).append(graph)
+                stack.pop()
+                continue
+            if not state.pending:
+                if required <= state.selected.keys():
+                    return state
+                continue
+            key = (state.graph_hash, state.pending, state.inputs)
+            if state.graph in failed.get(key, ()) or (
+                    not self.may_select(state, required)):
+                continue
+            stack.append((key, state.graph, self.expand(state)))
+        return None
+
+    def resolve(self):
+        '''Returns the chosen recipes in build order, preferring the choices
+        including python3 and SDL2, then those coming first.
+
+        Raises :class:`~pythonforandroid.util.BuildInterruptingException`
+        explaining why if there's no valid choice.'''
+        best = self.search({'python3', 'sdl2'})
+        if best is None:
+            states = [self.search({'python3'}), self.search({'sdl2'})]
+            best = min((state for state in states if state is not None),
+                       key=lambda state: state.path, default=None)
+        if best is None:
+            best = self.search()
+        if best is None:
+            raise BuildInterruptingException(
+                'Didn\'t find any valid dependency graphs. '
+                'This means that some of your '
+                'requirements pull in conflicting dependencies:\n' +
+                '\n'.join(self.reasons))
+        return list(find_order(best.graph))
+
+
 def get_recipe_order_and_bootstrap(ctx, names, bs=None, blacklist=None):
     # Get set of recipe/dependency names, clean up and add bootstrap deps:
-    names = set(names)
+    names = list(names)
     if bs is not None and bs.recipe_depends:
-        names = names.union(set(bs.recipe_depends))
+        names += bs.recipe_depends
     names = fix_deplist([
         ([name] if not isinstance(name, (list, tuple)) else name)
         for name in names
@@ -260,59 +530,73 @@ def get_recipe_order_and_bootstrap(ctx, names, bs=None, blacklist=None):
         cleaned_up_tuple = tuple([
             item for item in name if item not in blacklist
         ])
-        if cleaned_up_tuple:
+        if cleaned_up_tuple and cleaned_up_tuple not in names:
             names.append(cleaned_up_tuple)
 
+    # The result is recorded, and reused as long as the recipes it may
+    # depend on don't change
+    resolutions = ProbeCache()
+    key = None
+    if ctx.storage_dir:
+        resolutions = ProbeCache(join(ctx.storage_dir, RESOLUTIONS_FILENAME))
+        key = get_resolution_key(ctx, names, bs)
+    recipes, python_modules, bs_name = resolutions.get(
+        'recipe order for {}'.format(json.dumps(
+            [names, sorted(blacklist), bs.name if bs is not None else None])),
+        key,
+        lambda: _get_recipe_order_and_bootstrap(ctx, names, bs, blacklist))
+    resolutions.save()
+    get_recipe_index(ctx).save()
+    if bs is None:
+        bs = Bootstrap.get_bootstrap(bs_name, ctx)
+    return recipes, python_modules, bs
+
+
+def get_resolution_key(ctx, names, bs=None):
+    '''Returns a digest of the metadata of all the recipes (and of the
+    bootstraps, if ``bs`` is None) the resolution of the requirements
+    ``names`` may depend on, whatever the choices made.'''
+    bootstraps = [bs] if bs is not None else [
+        Bootstrap.get_bootstrap(name, ctx)
+        for name in sorted(Bootstrap.all_bootstraps())]
+    todo = [name for name_tuple in names for name in name_tuple]
+    for bootstrap in bootstraps:
+        todo += [name for name_tuple in fix_deplist(bootstrap.recipe_depends)
+                 for name in name_tuple]
+    metadata = {}
+    while todo:
+        name = todo.pop()
+        if name in metadata:
+            continue
+        try:
+            recipe = get_recipe_metadata(name, ctx)
+        except ValueError:
+            # a pip package, unless a recipe with that name gets added
+            metadata[name] = None
+            continue
+        metadata[name] = get_metadata(recipe)
+        todo += [dep for dep_tuple in fix_deplist(
+                     list(recipe.depends or []) +
+                     list(recipe.opt_depends or []))
+                 for dep in dep_tuple]
+    return hashlib.sha256(json.dumps([
+        __version__,
+        [[bootstrap.name, sorted(map(str, bootstrap.recipe_depends)),
+          bootstrap.can_be_chosen_automatically]
+         for bootstrap in bootstraps],
+        sorted(metadata.items()),
+    ], default=str).encode('utf-8')).hexdigest()
+
+
+def _get_recipe_order_and_bootstrap(ctx, names, bs, blacklist):
     # Do check for obvious conflicts (that would trigger in any order, and
     # without comitting to any specific choice in a multi-choice tuple of
     # dependencies):
     obvious_conflict_checker(ctx, names, blacklist=blacklist)
     # If we get here, no obvious conflicts!
 
-    # get all possible order graphs, as names may include tuples/lists
-    # of alternative dependencies
-    possible_orders = []
-    for name_set in product(*names):
-        new_possible_orders = [RecipeOrder(ctx)]
-        for name in name_set:
-            new_possible_orders = recursively_collect_orders(
-                name, ctx, name_set, orders=new_possible_orders,
-                blacklist=blacklist
-            )
-        possible_orders.extend(new_possible_orders)
-
-    # turn each order graph into a linear list if possible
-    orders = []
-    for possible_order in possible_orders:
-        try:
-            order = find_order(possible_order)
-        except ValueError:  # a circular dependency was found
-            info('Circular dependency found in graph {}, skipping it.'.format(
-                possible_order))
-            continue
-        orders.append(list(order))
-
-    # prefer python3 and SDL2 if available
-    orders = sorted(orders,
-                    key=lambda order: -('python3' in order) - ('sdl2' in order))
-
-    if not orders:
-        raise BuildInterruptingException(
-            'Didn\'t find any valid dependency graphs. '
-            'This means that some of your '
-            'requirements pull in conflicting dependencies.')
-
-    # It would be better to check against possible orders other
-    # than the first one, but in practice clashes will be rare,
-    # and can be resolved by specifying more parameters
-    chosen_order = orders[0]
-    if len(orders) > 1:
-        info('Found multiple valid dependency orders:')
-        for order in orders:
-            info('    {}'.format(order))
-        info('Using the first of these: {}'.format(chosen_order))
-    else:
-        info('Found a single valid recipe set: {}'.format(chosen_order))
+    chosen_order = DependencyResolver(ctx, names, blacklist).resolve()
+    info('Found a valid recipe set: {}'.format(chosen_order))
 
     if bs is None:
         bs = Bootstrap.get_bootstrap_from_recipes(chosen_order, ctx)
@@ -330,7 +614,7 @@ def get_recipe_order_and_bootstrap(ctx, names, bs=None, blacklist=None):
         python_modules = []
         for name in chosen_order:
             try:
-                recipe = Recipe.get_recipe(name, ctx)
+                recipe = get_recipe_metadata(name, ctx)
                 python_modules += recipe.python_depends
             except ValueError:
                 python_modules.append(name)
@@ -338,4 +622,4 @@ def get_recipe_order_and_bootstrap(ctx, names, bs=None, blacklist=None):
                 recipes.append(name)
 
     python_modules = list(set(python_modules))
-    return recipes, python_modules, bs
+    return recipes, python_modules, bs.name
@@ -7,6 +7,8 @@ from math import log10
 from collections import defaultdict
 from colorama import Style as Colo_Style, Fore as Colo_Fore
 
+from pythonforandroid.timing import timed
+
 
 # monkey patch to show full output
 sh.ErrorReturnCode.truncate_cap = 999999
@@ -131,6 +133,12 @@ def get_console_width():
 def shprint(command, *args, **kwargs):
     '''Runs the command (which should be an sh.Command instance), while
     logging the output.'''
+    name = ' '.join([str(command).split('/')[-1]] + [str(arg) for arg in args[:1]])
+    with timed(shorten_string(name, 80), 'command'):
+        return _shprint(command, *args, **kwargs)
+
+
+def _shprint(command, *args, **kwargs):
     kwargs["_iter"] = True
     kwargs["_out_bufsize"] = 1
     kwargs["_err_to_out"] = True
@@ -0,0 +1,124 @@
+"""
+Cache of the probes of the build environment.
+
+:meth:`~pythonforandroid.build.Context.prepare_build_environment` probes
+the Android SDK and NDK (e.g. the API levels the SDK provides, which runs
+the slow ``avdmanager`` tool) and the host tools (ccache, cython...) on
+each p4a invocation. Their results are recorded in the storage dir, along
+with the state of what they depend on (e.g. the SDK dir and the
+modification times of its subdirs, or the ``PATH``), and reused by the
+next invocations as long as that state doesn't change.
+"""
+
+from os import makedirs, replace, stat
+from os.path import dirname, join, realpath
+import json
+
+from pythonforandroid.logger import debug
+
+
+PROBES_FILENAME = 'probes.json'
+
+
+def get_dir_state(directory, subdirs=()):
+    '''Returns the real path and modification time of ``directory`` and
+    those of its ``subdirs``, or None if it doesn't exist.
+
+    Installing or removing e.g. an SDK platform changes the modification
+    time of the ``platforms`` subdir, so it makes a good probe key.
+    '''
+    try:
+        state = [realpath(directory), stat(directory).st_mtime_ns]
+    except OSError:
+        return None
+    for subdir in subdirs:
+        try:
+            state.append(stat(join(directory, subdir)).st_mtime_ns)
+        except OSError:
+            state.append(None)
+    return state
+
+
+def get_path_state(path):
+    '''Returns the entries of ``path`` (a ``PATH``-like string) without
+    duplicates, in order, each with its modification time (or None if it
+    doesn't exist).
+
+    Installing or removing a tool in one of them changes its modification
+    time, so the probes of the host tools are run again.
+    '''
+    entries = []
+    for entry in path.split(':'):
+        if entry not in entries:
+            entries.append(entry)
+    state = []
+    for entry in entries:
+        try:
+            state.append([entry, stat(entry).st_mtime_ns])
+        except OSError:
+            state.append([entry, None])
+    return state
+
+
+class ProbeCache:
+    '''The results of the probes, recorded in ``filename`` (or only kept in
+    memory if it's None).'''
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.probes = self._load()
+        # the names of the probes run since the cache was loaded
+        self.changed = set()
+
+    def _load(self):
+        if self.filename is None:
+            return {}
+        try:
+            with open(self.filename) as fileh:
+                probes = json.load(fileh)
+        except (OSError, ValueError):
+            return {}
+        return probes if isinstance(probes, dict) else {}
+
+    def get(self, name, key, probe, keep=None, valid=None):
+        '''Returns the result of ``probe()``, or the recorded result of the
+        probe ``name`` if it was run with the same ``key`` and, if given,
+        ``valid(result)`` is True (e.g. the tool it found still exists).
+
+        The result is recorded unless ``key`` is None or ``keep(result)``
+        is False, e.g. to probe again for a tool that was missing. Keys and
+        results must be serializable to JSON.
+        '''
+        if key is not None:
+            # compare keys the way they are read back, e.g. lists for tuples
+            key = json.loads(json.dumps(key))
+            entry = self.probes.get(name)
+            if (entry is not None and entry['key'] == key and
+                    (valid is None or valid(entry['value']))):
+                debug('Reusing the result of the {} probe'.format(name))
+                return entry['value']
+        value = probe()
+        if key is not None and (keep is None or keep(value)):
+            self.probes[name] = {'key': key, 'value': value}
+            self.changed.add(name)
+        return value
+
+    def save(self):
+        '''Records the results of the probes run since this cache was
+        loaded, along with those recorded in the meantime by other caches
+        on the same file (e.g. by a nested resolution).'''
+        if self.filename is None or not self.changed:
+            return
+        probes = self._load()
+        probes.update((name, self.probes[name]) for name in self.changed)
+        self.probes = probes
+        try:
+            makedirs(dirname(self.filename), exist_ok=True)
+            with open(self.filename + '.tmp', 'w') as fileh:
+                json.dump(self.probes, fileh, indent=1)
+            replace(self.filename + '.tmp', self.filename)
+        except OSError as e:
+            debug('Could not record the probes in {}: {}'.format(
+                self.filename, e))
+            return
+        self.changed = set()
@@ -33,7 +33,10 @@
 """
 
 
+import concurrent.futures
 import functools
+import hashlib
+import json
 import os
 import shutil
 import subprocess
@@ -41,6 +44,7 @@ import sys
 import tarfile
 import tempfile
 import textwrap
+import threading
 import time
 import zipfile
 from io import open  # needed for python 2
@@ -48,6 +52,9 @@ from urllib.parse import unquote as urlunquote
 from urllib.parse import urlparse
 
 import toml
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+from packaging.version import InvalidVersion, Version
 from pep517.envbuild import BuildEnvironment
 from pep517.wrappers import Pep517HookCaller
 
@@ -564,6 +571,103 @@ def parse_as_folder_reference(dep):
     return None
 
 
+# The environment markers of the dependencies are evaluated for Android,
+# which Python reports as Linux. The other markers (e.g. python_version)
+# are evaluated for the host:
+ANDROID_MARKER_ENVIRONMENT = {
+    "os_name": "posix",
+    "sys_platform": "linux",
+    "platform_system": "Linux",
+}
+
+
+def _parse_requirement(dependency):
+    try:
+        return Requirement(dependency)
+    except InvalidRequirement:
+        return None
+
+
+def get_find_links_folders():
+    """ Returns the local folders pip looks for packages in, as set with
+        --find-links in the PIP_FIND_LINKS environment variable.
+    """
+    folders = []
+    for link in os.environ.get("PIP_FIND_LINKS", "").split():
+        folder = parse_as_folder_reference(link)
+        if folder is not None and os.path.isdir(folder):
+            folders.append(folder)
+    return folders
+
+
+def find_local_wheel(dependency):
+    """ Returns the path of the local wheel the given dependency refers
+        to, or of the newest matching wheel found in a --find-links
+        folder (see get_find_links_folders()).
+
+        Returns None if there is no such wheel.
+    """
+    path = parse_as_folder_reference(dependency)
+    if path is not None:
+        if path.endswith(".whl") and os.path.isfile(path):
+            return path
+        return None
+    requirement = _parse_requirement(dependency)
+    if requirement is None or requirement.url or (
+            requirement.marker is not None and
+            not requirement.marker.evaluate(
+                dict(ANDROID_MARKER_ENVIRONMENT, extra=""))):
+        return None
+    name = canonicalize_name(requirement.name)
+    wheels = dict()
+    for folder in get_find_links_folders():
+        for filename in sorted(os.listdir(folder)):
+            # {name}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+            parts = filename[:-len(".whl")].split("-")
+            if not filename.endswith(".whl") or len(parts) not in (5, 6) \
+                    or canonicalize_name(parts[0]) != name:
+                continue
+            try:
+                version = Version(parts[1])
+            except InvalidVersion:
+                continue
+            wheels.setdefault(version, os.path.join(folder, filename))
+    versions = list(requirement.specifier.filter(wheels))
+    if len(versions) == 0:
+        return None
+    return wheels[max(versions)]
+
+
+def read_wheel_metadata(wheel):
+    """ Returns the contents of the METADATA file of the given wheel,
+        without extracting the rest of it.
+    """
+    with zipfile.ZipFile(wheel) as f:
+        for name in f.namelist():
+            folder, _, filename = name.partition("/")
+            if folder.endswith(".dist-info") and filename == "METADATA":
+                return f.read(name).decode("utf-8").replace("\r\n", "\n")
+    raise ValueError("no METADATA file found in wheel: " + str(wheel))
+
+
+def get_android_dependencies(requirements, extras=()):
+    """ Returns the given Requires-Dist entries that apply on Android
+        when installing the given extras, without their environment
+        markers.
+    """
+    dependencies = []
+    for entry in requirements:
+        requirement = _parse_requirement(entry)
+        if requirement is None or requirement.marker is None:
+            dependencies.append(entry)
+            continue
+        if any(requirement.marker.evaluate(
+                    dict(ANDROID_MARKER_ENVIRONMENT, extra=extra)
+                ) for extra in [""] + sorted(extras)):
+            dependencies.append(entry.rpartition(";")[0].strip())
+    return dependencies
+
+
 def _extract_info_from_package(dependency,
                                extract_type=None,
                                debug=False,
@@ -580,23 +684,33 @@ def _extract_info_from_package(dependency,
               "extract_type={} include_build_requirements={}".format(
                   extract_type, include_build_requirements,
               ))
+    wheel = find_local_wheel(dependency)
     output_folder = tempfile.mkdtemp(prefix="pythonpackage-metafolder-")
     try:
-        extract_metainfo_files_from_package(
-            dependency, output_folder, debug=debug
-        )
+        if wheel is not None:
+            # Fast path: read the metadata straight from the wheel
+            if debug:
+                print("_extract_info_from_package: reading metadata "
+                      "of local wheel: {}".format(wheel))
+            metadata_source_type = "wheel"
+            metadata = read_wheel_metadata(wheel)
+        else:
+            extract_metainfo_files_from_package(
+                dependency, output_folder, debug=debug
+            )
 
-        # Extract the type of data source we used to get the metadata:
-        with open(os.path.join(output_folder,
-                               "metadata_source"), "r") as f:
-            metadata_source_type = f.read().strip()
+            # Extract the type of data source we used to get the metadata:
+            with open(os.path.join(output_folder,
+                                   "metadata_source"), "r") as f:
+                metadata_source_type = f.read().strip()
 
-        # Extract main METADATA file:
-        with open(os.path.join(output_folder, "METADATA"),
-                  "r", encoding="utf-8"
-                 ) as f:
-            # Get metadata and cut away description (is after 2 linebreaks)
-            metadata_entries = f.read().partition("\n\n")[0].splitlines()
+            # Extract main METADATA file:
+            with open(os.path.join(output_folder, "METADATA"),
+                      "r", encoding="utf-8"
+                     ) as f:
+                metadata = f.read()
+        # Get metadata and cut away description (is after 2 linebreaks)
+        metadata_entries = metadata.partition("\n\n")[0].splitlines()
 
         if extract_type == "name":
             name = None
@@ -636,37 +750,171 @@ def _extract_info_from_package(dependency,
                 # add setuptools as default build system.
                 requirements.append("setuptools")
 
-            # Add requirements from metadata:
-            requirements += [
+            # Add requirements from metadata that apply on Android:
+            requirement = _parse_requirement(dependency)
+            requirements += get_android_dependencies([
                 entry.rpartition("Requires-Dist:")[2].strip()
                 for entry in metadata_entries
                 if entry.startswith("Requires-Dist")
-            ]
+            ], extras=requirement.extras if requirement is not None else ())
 
             return list(set(requirements))  # remove duplicates
     finally:
         shutil.rmtree(output_folder)
 
 
-package_name_cache = dict()
+# The file the metadata cache is recorded in, see enable_metadata_cache()
+METADATA_CACHE_FILENAME = "pythonpackage-cache.json"
+
+# Environment variables setting how long (in seconds) the recorded metadata
+# is reused, and how many entries are kept at most:
+METADATA_CACHE_TTL_VARIABLE = "P4A_PYTHONPACKAGE_CACHE_TTL"
+METADATA_CACHE_SIZE_VARIABLE = "P4A_PYTHONPACKAGE_CACHE_SIZE"
+
+# Environment variable setting how many packages get_package_dependencies()
+# examines at once:
+DEPENDENCIES_JOBS_VARIABLE = "P4A_PYTHONPACKAGE_JOBS"
+
+
+class MetadataCache(object):
+    """ Cache of the package info obtained by _extract_info_from_package(),
+        kept in memory and, if a filename is given, recorded in that file
+        to be reused by later runs.
+
+        Entries expire ttl seconds after they were obtained, and only the
+        max_entries most recently used ones are kept.
+    """
+
+    def __init__(self, filename=None, ttl=600.0, max_entries=1000):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> [time obtained, time last used, value]
+        self.entries = {}
+        if filename is None:
+            return
+        try:
+            with open(filename, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, key, obtain):
+        """ Returns the value recorded for key, or else the result of
+            obtain(), which gets recorded.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] + self.ttl > now:
+                entry[1] = now
+                return entry[2]
+        value = obtain()
+        with self.lock:
+            self.entries[key] = [now, now, value]
+            self._evict(now)
+            self._save()
+        return value
+
+    def _evict(self, now):
+        for key in [key for key, entry in self.entries.items()
+                    if entry[0] + self.ttl <= now]:
+            del self.entries[key]
+        if len(self.entries) > self.max_entries:
+            by_last_use = sorted(self.entries,
+                                 key=lambda key: self.entries[key][1])
+            for key in by_last_use[:len(self.entries) - self.max_entries]:
+                del self.entries[key]
+
+    def _save(self):
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(self.filename + ".tmp", self.filename)
+        except OSError:
+            pass  # the cache is only an optimization
+
+
+metadata_cache = MetadataCache()
+
+
+def enable_metadata_cache(folder):
+    """ Records the package info obtained from now on in the given folder,
+        and reuses what was recorded there before.
+
+        The info is reused for P4A_PYTHONPACKAGE_CACHE_TTL seconds (a day
+        by default), and at most P4A_PYTHONPACKAGE_CACHE_SIZE entries
+        (1000 by default) are kept.
+    """
+    global metadata_cache
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    metadata_cache = MetadataCache(
+        os.path.join(folder, METADATA_CACHE_FILENAME),
+        ttl=float(os.environ.get(METADATA_CACHE_TTL_VARIABLE, 24 * 3600)),
+        max_entries=int(os.environ.get(METADATA_CACHE_SIZE_VARIABLE, 1000)),
+    )
+
+
+def _get_folder_hash(folder):
+    """ Returns a hash of the files defining the package in the given
+        folder, or of the given file (e.g. a local wheel or sdist), to
+        notice when its name or dependencies may change.
+    """
+    digest = hashlib.sha256()
+    if os.path.isfile(folder):
+        with open(folder, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    for filename in ("setup.py", "pyproject.toml", "setup.cfg"):
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            digest.update(filename.encode("utf-8") + b"\0")
+            with open(path, "rb") as f:
+                digest.update(f.read())
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _get_info_from_package(dependency,
+                           extract_type=None,
+                           debug=False,
+                           include_build_requirements=False
+                           ):
+    """ Like _extract_info_from_package(), but reusing the info of the
+        metadata cache. Info about local folders and files is reused only
+        as long as the files defining the package don't change.
+    """
+    folder = parse_as_folder_reference(dependency)
+    key = json.dumps([
+        dependency, extract_type, include_build_requirements,
+        None if folder is None else os.path.abspath(folder),
+        None if folder is None else _get_folder_hash(folder),
+    ])
+    return metadata_cache.get(key, lambda: _extract_info_from_package(
+        dependency, extract_type=extract_type, debug=debug,
+        include_build_requirements=include_build_requirements,
+    ))
 
 
 def get_package_name(dependency,
                      use_cache=True):
-    def timestamp():
-        try:
-            return time.monotonic()
-        except AttributeError:
-            return time.time()  # Python 2.
-    try:
-        value = package_name_cache[dependency]
-        if value[0] + 600.0 > timestamp() and use_cache:
-            return value[1]
-    except KeyError:
-        pass
-    result = _extract_info_from_package(dependency, extract_type="name")
-    package_name_cache[dependency] = (timestamp(), result)
-    return result
+    if not use_cache:
+        return _extract_info_from_package(dependency, extract_type="name")
+    return _get_info_from_package(dependency, extract_type="name")
+
+
+def _get_package_dependencies_jobs():
+    """ Returns how many packages get_package_dependencies() examines at
+        once, as set in P4A_PYTHONPACKAGE_JOBS.
+    """
+    return max(1, int(os.environ.get(
+        DEPENDENCIES_JOBS_VARIABLE, min(8, os.cpu_count() or 1)
+    )))
 
 
 def get_package_dependencies(package,
@@ -676,71 +924,102 @@ def get_package_dependencies(package,
     """ Obtain the dependencies from a package. Please note this
         function is possibly SLOW, especially if you enable
         the recursive mode.
+
+        In recursive mode, the packages of each level of dependencies
+        are examined concurrently, by up to P4A_PYTHONPACKAGE_JOBS
+        threads.
     """
     packages_processed = set()
     package_queue = [package]
     reqs = set()
     reqs_as_names = set()
-    while len(package_queue) > 0:
-        current_queue = package_queue
-        package_queue = []
-        for package_dep in current_queue:
-            new_reqs = set()
-            if verbose:
+    # Every dependency seen so far -> its package name (or the error
+    # obtaining it), so that it is never resolved twice:
+    dep_names = dict()
+
+    def resolve_names(deps, pool):
+        deps = [dep for dep in dict.fromkeys(deps) if dep not in dep_names]
+        if verbose:
+            for dep in deps:
                 print("get_package_dependencies: resolving dependency "
-                      f"to package name: {package_dep}")
-            package = get_package_name(package_dep)
-            if package.lower() in packages_processed:
-                continue
-            if verbose:
-                print("get_package_dependencies: "
-                      "processing package: {}".format(package))
-                print("get_package_dependencies: "
-                      "Packages seen so far: {}".format(
-                          packages_processed
-                      ))
-            packages_processed.add(package.lower())
-
-            # Use our regular folder processing to examine:
-            new_reqs = new_reqs.union(_extract_info_from_package(
-                package_dep, extract_type="dependencies",
-                debug=verbose,
-                include_build_requirements=include_build_requirements,
-            ))
-
-            # Process new requirements:
-            if verbose:
-                print('get_package_dependencies: collected '
-                      "deps of '{}': {}".format(
-                          package_dep, str(new_reqs),
-                      ))
-            for new_req in new_reqs:
-                try:
-                    req_name = get_package_name(new_req)
-                except ValueError as e:
-                    if new_req.find(";") >= 0:
-                        # Conditional dep where condition isn't met?
-                        # --> ignore it
-                        continue
-                    if verbose:
-                        print("get_package_dependencies: " +
-                              "unexpected failure to get name " +
-                              "of '" + str(new_req) + "': " +
-                              str(e))
-                    raise RuntimeError(
-                        "failed to get " +
-                        "name of dependency: " + str(e)
-                    )
-                if req_name.lower() in reqs_as_names:
+                      f"to package name: {dep}")
+
+        def resolve_name(dep):
+            try:
+                return get_package_name(dep)
+            except ValueError as e:
+                return e
+        dep_names.update(zip(deps, pool.map(resolve_name, deps)))
+
+    def get_dependencies(package_dep):
+        # Use our regular folder processing to examine:
+        return set(_get_info_from_package(
+            package_dep, extract_type="dependencies",
+            debug=verbose,
+            include_build_requirements=include_build_requirements,
+        ))
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=_get_package_dependencies_jobs()) as pool:
+        while len(package_queue) > 0:
+            current_queue = package_queue
+            package_queue = []
+            resolve_names(current_queue, pool)
+            level = []
+            for package_dep in current_queue:
+                package = dep_names[package_dep]
+                if isinstance(package, ValueError):
+                    raise package
+                if package.lower() in packages_processed:
                     continue
-                if req_name.lower() not in packages_processed:
-                    package_queue.append(new_req)
-                reqs.add(new_req)
-                reqs_as_names.add(req_name.lower())
+                if verbose:
+                    print("get_package_dependencies: "
+                          "processing package: {}".format(package))
+                    print("get_package_dependencies: "
+                          "Packages seen so far: {}".format(
+                              packages_processed
+                          ))
+                packages_processed.add(package.lower())
+                level.append(package_dep)
+
+            levels_reqs = list(pool.map(get_dependencies, level))
+            resolve_names(
+                [new_req for new_reqs in levels_reqs
+                 for new_req in sorted(new_reqs)],
+                pool
+            )
+            for package_dep, new_reqs in zip(level, levels_reqs):
+                # Process new requirements:
+                if verbose:
+                    print('get_package_dependencies: collected '
+                          "deps of '{}': {}".format(
+                              package_dep, str(new_reqs),
+                          ))
+                for new_req in sorted(new_reqs):
+                    req_name = dep_names[new_req]
+                    if isinstance(req_name, ValueError):
+                        if new_req.find(";") >= 0:
+                            # Conditional dep where condition isn't met?
+                            # --> ignore it
+                            continue
+                        if verbose:
+                            print("get_package_dependencies: " +
+                                  "unexpected failure to get name " +
+                                  "of '" + str(new_req) + "': " +
+                                  str(req_name))
+                        raise RuntimeError(
+                            "failed to get " +
+                            "name of dependency: " + str(req_name)
+                        )
+                    if req_name.lower() in reqs_as_names:
+                        continue
+                    if req_name.lower() not in packages_processed:
+                        package_queue.append(new_req)
+                    reqs.add(new_req)
+                    reqs_as_names.add(req_name.lower())
 
             # Bail out here if we're not scanning recursively:
             if not recursive:
-                package_queue[:] = []  # wipe queue
                 break
     if verbose:
         print("get_package_dependencies: returning result: {}".format(reqs))
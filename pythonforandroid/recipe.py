@@ -9,26 +9,24 @@ from re import match
 import sh
 import shutil
 import fnmatch
-import urllib.request
-from urllib.request import urlretrieve
-from os import listdir, unlink, environ, mkdir, curdir, walk
-from sys import stdout
-import time
+from os import listdir, unlink, environ, curdir, rename, stat, walk
 try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
+from pythonforandroid.archive import extract_archive, is_archive
+from pythonforandroid.download import (
+    add_to_store, cached_file_digests, fetch_from_store, fetch_url,
+    file_digests, get_digests_record_filename, update_git_mirror,
+    use_shallow_git_clones,
+)
 from pythonforandroid.logger import (logger, info, warning, debug, shprint, info_main)
-from pythonforandroid.util import (current_directory, ensure_dir,
+from pythonforandroid.util import (current_directory, copy_tree, ensure_dir,
                                    BuildInterruptingException)
+from pythonforandroid.timing import timed
 from pythonforandroid.util import load_source as import_recipe
 
 
-url_opener = urllib.request.build_opener()
-url_orig_headers = url_opener.addheaders
-urllib.request.install_opener(url_opener)
-
-
 class RecipeMeta(type):
     def __new__(cls, name, bases, dct):
         if name != 'Recipe':
@@ -95,6 +93,23 @@ class Recipe(with_metaclass(RecipeMeta)):
     string patch file and a callable, which will receive the kwargs `arch` and
     `recipe`, which should return True if the patch should be applied.'''
 
+    prepatch_sources = None
+    '''Whether the :attr:`patches` may be applied only once, to the pristine
+    source tree shared by all the archs, before :meth:`prebuild_arch`
+    runs. By default (None) this is only done if the recipe doesn't
+    override :meth:`prebuild_arch`, which may change the sources before
+    they get patched.'''
+
+    build_in_parallel = True
+    '''Whether the recipe may be built at the same time as other recipes,
+    with ``--jobs``. Such builds run in forked processes, which only send
+    back the changes of the plain (str, int, float, bool or None)
+    attributes of the build context and of the recipe, and of the
+    environment variables. A recipe whose build keeps any other state
+    (e.g. a list or another object set on the context, or changed in
+    place) must set this to False, to be built on its own in the main
+    process.'''
+
     python_depends = []
     '''A list of pure-Python packages that this package requires. These
     packages will NOT be available at build time, but will be added to the
@@ -194,59 +209,49 @@ class Recipe(with_metaclass(RecipeMeta)):
 
         parsed_url = urlparse(url)
         if parsed_url.scheme in ('http', 'https'):
-            def report_hook(index, blksize, size):
-                if size <= 0:
-                    progression = '{0} bytes'.format(index * blksize)
-                else:
-                    progression = '{0:.2f}%'.format(
-                        index * blksize * 100. / float(size))
-                if "CI" not in environ:
-                    stdout.write('- Download {}\r'.format(progression))
-                    stdout.flush()
-
             if exists(target):
                 unlink(target)
 
-            # Download item with multiple attempts (for bad connections):
-            attempts = 0
-            seconds = 1
-            while True:
-                try:
-                    # jqueryui.com returns a 403 w/ the default user agent
-                    # Mozilla/5.0 doesnt handle redirection for liblzma
-                    url_opener.addheaders = [('User-agent', 'Wget/1.0')]
-                    urlretrieve(url, target, report_hook)
-                except OSError as e:
-                    attempts += 1
-                    if attempts >= 5:
-                        raise
-                    stdout.write('Download failed: {}; retrying in {} second(s)...'.format(e, seconds))
-                    time.sleep(seconds)
-                    seconds *= 2
-                    continue
-                finally:
-                    url_opener.addheaders = url_orig_headers
-                break
-            return target
+            # Download item with multiple attempts (for bad connections),
+            # resuming any partial download
+            return fetch_url(url, target)
         elif parsed_url.scheme in ('git', 'git+file', 'git+ssh', 'git+http', 'git+https'):
-            if isdir(target):
-                with current_directory(target):
-                    shprint(sh.git, 'fetch', '--tags', '--recurse-submodules')
-                    if self.version:
-                        shprint(sh.git, 'checkout', self.version)
-                    branch = sh.git('branch', '--show-current')
-                    if branch:
-                        shprint(sh.git, 'pull')
-                        shprint(sh.git, 'pull', '--recurse-submodules')
-                    shprint(sh.git, 'submodule', 'update', '--recursive')
+            if url.startswith('git+'):
+                url = url[4:]
+            # All the objects are fetched once into a mirror shared by the
+            # storage dirs, the clones below only copy them locally.
+            # Note: `_cwd` instead of `current_directory`, as downloads may
+            # run concurrently in several threads
+            mirror = update_git_mirror(url)
+            if use_shallow_git_clones():
+                if not isdir(target):
+                    shprint(sh.git, 'init', '--quiet', target)
+                    shprint(sh.git, 'remote', 'add', 'origin', url,
+                            _cwd=target)
+                shprint(sh.git, 'fetch', '--depth', '1', 'file://' + mirror,
+                        self.version or 'HEAD', _cwd=target)
+                shprint(sh.git, 'checkout', '--force', 'FETCH_HEAD',
+                        _cwd=target)
+                shprint(sh.git, 'submodule', 'update', '--init',
+                        '--recursive', '--depth', '1', _cwd=target)
+            elif isdir(target):
+                shprint(sh.git, 'fetch', '--tags', '--prune', mirror,
+                        '+refs/heads/*:refs/remotes/origin/*', _cwd=target)
+                if self.version:
+                    shprint(sh.git, 'checkout', self.version, _cwd=target)
+                branch = sh.git('branch', '--show-current', _cwd=target)
+                if branch:
+                    shprint(sh.git, 'merge', '--ff-only', '@{upstream}',
+                            _cwd=target)
+                shprint(sh.git, 'submodule', 'update', '--init',
+                        '--recursive', _cwd=target)
             else:
-                if url.startswith('git+'):
-                    url = url[4:]
-                shprint(sh.git, 'clone', '--recursive', url, target)
+                shprint(sh.git, 'clone', '--recursive', '--reference', mirror,
+                        '--dissociate', url, target)
                 if self.version:
-                    with current_directory(target):
-                        shprint(sh.git, 'checkout', self.version)
-                        shprint(sh.git, 'submodule', 'update', '--recursive')
+                    shprint(sh.git, 'checkout', self.version, _cwd=target)
+                    shprint(sh.git, 'submodule', 'update', '--recursive',
+                            _cwd=target)
             return target
 
     def apply_patch(self, filename, arch, build_dir=None):
@@ -359,13 +364,58 @@ class Recipe(with_metaclass(RecipeMeta)):
             info('P4A_{}_DIR is set, skipping download for {}'.format(
                 self.name, self.name))
             return
-        self.download()
+        with timed('download', recipe=self.name):
+            self.download()
 
     def download(self):
         if self.url is None:
             info('Skipping {} download as no URL is set'.format(self.name))
             return
 
+        url, filename, expected_digests = self.get_download_info()
+
+        # Note: we don't change the current directory here, as several
+        # recipes may be downloaded at the same time from different threads
+        package_dir = join(self.ctx.packages_path, self.name)
+        ensure_dir(package_dir)
+        target = join(package_dir, filename)
+
+        do_download = True
+        marker_filename = join(package_dir, '.mark-{}'.format(filename))
+        if exists(target) and isfile(target):
+            if not exists(marker_filename):
+                shprint(sh.rm, target)
+            else:
+                self.check_digests(target, expected_digests)
+                do_download = False
+
+        # If we got this far, we will download
+        if do_download:
+            debug('Downloading {} from {}'.format(self.name, url))
+
+            shprint(sh.rm, '-f', marker_filename,
+                    get_digests_record_filename(target))
+            if fetch_from_store(target, expected_digests):
+                info('{} found in the download store'.format(self.name))
+            else:
+                self.download_file(
+                    self.versioned_url, filename, cwd=package_dir)
+            shprint(sh.touch, marker_filename)
+
+            if exists(target) and isfile(target):
+                self.check_digests(target, expected_digests)
+                add_to_store(target, expected_digests)
+        else:
+            add_to_store(target, expected_digests)
+            info('{} download already cached, skipping'.format(self.name))
+
+    def get_download_info(self):
+        '''(internal) Returns the url to download the recipe from, without
+        any digest fragment, the name of the downloaded file and a dict
+        of the digests it is expected to have (algorithm name to hex
+        digest), given either by the recipe attributes (e.g.
+        :attr:`md5sum`) or by an url fragment like ``#sha256=...``.
+        '''
         url = self.versioned_url
         expected_digests = {}
         for alg in set(hashlib.algorithms_guaranteed) | set(('md5', 'sha512', 'blake2b')):
@@ -380,51 +430,28 @@ class Recipe(with_metaclass(RecipeMeta)):
                 expected_digest = ma.group(2)
             if expected_digest:
                 expected_digests[alg] = expected_digest
+        return url, basename(url), expected_digests
 
-        shprint(sh.mkdir, '-p', join(self.ctx.packages_path, self.name))
+    def check_digests(self, filename, expected_digests):
+        '''(internal) Checks that ``filename`` matches all the
+        ``expected_digests`` (a dict of algorithm name to hex digest),
+        raising a :class:`ValueError` if not.
 
-        with current_directory(join(self.ctx.packages_path, self.name)):
-            filename = shprint(sh.basename, url).stdout[:-1].decode('utf-8')
-
-            do_download = True
-            marker_filename = '.mark-{}'.format(filename)
-            if exists(filename) and isfile(filename):
-                if not exists(marker_filename):
-                    shprint(sh.rm, filename)
-                else:
-                    for alg, expected_digest in expected_digests.items():
-                        current_digest = algsum(alg, filename)
-                        if current_digest != expected_digest:
-                            debug('* Generated {}sum: {}'.format(alg,
-                                                                 current_digest))
-                            debug('* Expected {}sum: {}'.format(alg,
-                                                                expected_digest))
-                            raise ValueError(
-                                ('Generated {0}sum does not match expected {0}sum '
-                                 'for {1} recipe').format(alg, self.name))
-                    do_download = False
-
-            # If we got this far, we will download
-            if do_download:
-                debug('Downloading {} from {}'.format(self.name, url))
-
-                shprint(sh.rm, '-f', marker_filename)
-                self.download_file(self.versioned_url, filename)
-                shprint(sh.touch, marker_filename)
-
-                if exists(filename) and isfile(filename):
-                    for alg, expected_digest in expected_digests.items():
-                        current_digest = algsum(alg, filename)
-                        if current_digest != expected_digest:
-                            debug('* Generated {}sum: {}'.format(alg,
-                                                                 current_digest))
-                            debug('* Expected {}sum: {}'.format(alg,
-                                                                expected_digest))
-                            raise ValueError(
-                                ('Generated {0}sum does not match expected {0}sum '
-                                 'for {1} recipe').format(alg, self.name))
-            else:
-                info('{} download already cached, skipping'.format(self.name))
+        All the digests are computed in a single pass over the file, and
+        are recorded next to it so that an unchanged file is not hashed
+        again by later builds.
+        '''
+        if not expected_digests:
+            return
+        current_digests = cached_file_digests(filename, expected_digests)
+        for alg, expected_digest in expected_digests.items():
+            current_digest = current_digests[alg]
+            if current_digest != expected_digest:
+                debug('* Generated {}sum: {}'.format(alg, current_digest))
+                debug('* Expected {}sum: {}'.format(alg, expected_digest))
+                raise ValueError(
+                    ('Generated {0}sum does not match expected {0}sum '
+                     'for {1} recipe').format(alg, self.name))
 
     def unpack(self, arch):
         info_main('Unpacking {} for {}'.format(self.name, arch))
@@ -448,58 +475,94 @@ class Recipe(with_metaclass(RecipeMeta)):
             info('Skipping {} unpack as no URL is set'.format(self.name))
             return
 
-        filename = shprint(
-            sh.basename, self.versioned_url).stdout[:-1].decode('utf-8')
-        ma = match(u'^(.+)#[a-z0-9_]{3,}=([0-9a-f]{32,})$', filename)
-        if ma:                  # fragmented URL?
-            filename = ma.group(1)
-
-        with current_directory(build_dir):
-            directory_name = self.get_build_dir(arch)
-
-            if not exists(directory_name) or not isdir(directory_name):
-                extraction_filename = join(
-                    self.ctx.packages_path, self.name, filename)
-                if isfile(extraction_filename):
-                    if extraction_filename.endswith('.zip'):
-                        try:
-                            sh.unzip(extraction_filename)
-                        except (sh.ErrorReturnCode_1, sh.ErrorReturnCode_2):
-                            # return code 1 means unzipping had
-                            # warnings but did complete,
-                            # apparently happens sometimes with
-                            # github zips
-                            pass
-                        import zipfile
-                        fileh = zipfile.ZipFile(extraction_filename, 'r')
-                        root_directory = fileh.filelist[0].filename.split('/')[0]
-                        if root_directory != basename(directory_name):
-                            shprint(sh.mv, root_directory, directory_name)
-                    elif extraction_filename.endswith(
-                            ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')):
-                        sh.tar('xf', extraction_filename)
-                        root_directory = sh.tar('tf', extraction_filename).stdout.decode(
-                                'utf-8').split('\n')[0].split('/')[0]
-                        if root_directory != basename(directory_name):
-                            shprint(sh.mv, root_directory, directory_name)
-                    else:
-                        raise Exception(
-                            'Could not extract {} download, it must be .zip, '
-                            '.tar.gz or .tar.bz2 or .tar.xz'.format(extraction_filename))
-                elif isdir(extraction_filename):
-                    mkdir(directory_name)
-                    for entry in listdir(extraction_filename):
-                        if entry not in ('.git',):
-                            shprint(sh.cp, '-Rv',
-                                    join(extraction_filename, entry),
-                                    directory_name)
-                else:
+        _, filename, expected_digests = self.get_download_info()
+
+        directory_name = self.get_build_dir(arch)
+
+        if not exists(directory_name) or not isdir(directory_name):
+            extraction_filename = join(
+                self.ctx.packages_path, self.name, filename)
+            if not exists(extraction_filename) and expected_digests:
+                # the download may have been removed from the storage
+                # dir, but still be available from the download store
+                ensure_dir(dirname(extraction_filename))
+                if fetch_from_store(extraction_filename, expected_digests):
+                    self.check_digests(
+                        extraction_filename, expected_digests)
+                    shprint(sh.touch, join(
+                        dirname(extraction_filename),
+                        '.mark-{}'.format(filename)))
+            if isfile(extraction_filename):
+                if not is_archive(extraction_filename):
                     raise Exception(
-                        'Given path is neither a file nor a directory: {}'
-                        .format(extraction_filename))
-
+                        'Could not extract {} download, it must be .zip, '
+                        '.tar.gz or .tar.bz2 or .tar.xz'.format(extraction_filename))
+                source_dir = self.get_pristine_source_dir(
+                    arch, extraction_filename)
+                info('Copying {} sources to {}'.format(
+                    self.name, directory_name))
+                copy_tree(source_dir, directory_name, reflink=True)
+            elif isdir(extraction_filename):
+                info('Copying {}'.format(extraction_filename))
+                copy_tree(extraction_filename, directory_name,
+                          exclude=('.git',))
             else:
-                info('{} is already unpacked, skipping'.format(self.name))
+                raise Exception(
+                    'Given path is neither a file nor a directory: {}'
+                    .format(extraction_filename))
+
+        else:
+            info('{} is already unpacked, skipping'.format(self.name))
+
+    def get_pristine_source_dir(self, arch, extraction_filename):
+        '''(internal) Returns a source tree extracted from the archive
+        ``extraction_filename``, to be copied to the build dir of the given
+        arch name. It is extracted only once and shared by all the archs.
+
+        If :attr:`prepatch_sources` allows it, the patches for this arch
+        are already applied to it (and it contains the ``.patched``
+        marker). There is one such tree per version, archive and set of
+        patches.
+        '''
+        arch = ([a for a in self.ctx.archs if a.arch == arch] or [None])[0]
+        prepatch = self.prepatch_sources
+        if prepatch is None:
+            prepatch = (
+                type(self).prebuild_arch is Recipe.prebuild_arch and
+                (arch is None or not hasattr(
+                    self, 'prebuild_{}'.format(arch.arch.replace('-', '_')))))
+        prepatch = bool(prepatch and self.patches and arch is not None)
+        patches = self.get_patches(arch) if prepatch else []
+
+        archive_stat = stat(extraction_filename)
+        key = hashlib.sha1(repr((
+            self.version, basename(extraction_filename),
+            archive_stat.st_size, archive_stat.st_mtime_ns, prepatch,
+            patches)).encode('utf-8'))
+        for patch in patches:
+            with open(join(self.get_recipe_dir(), patch), 'rb') as fileh:
+                key.update(fileh.read())
+        source_dir = join(self.ctx.build_dir, 'other_builds',
+                          self.get_dir_name(), 'sources', key.hexdigest()[:16])
+
+        if exists(source_dir):
+            info('{} sources already extracted, reusing them'.format(
+                self.name))
+            return source_dir
+
+        info('Extracting {}'.format(extraction_filename))
+        temp_dir = source_dir + '.tmp'
+        if exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        extract_archive(extraction_filename, temp_dir)
+        if prepatch:
+            info_main('Applying patches for {}[{}]'.format(
+                self.name, arch.arch))
+            for patch in patches:
+                self.apply_patch(patch, arch.arch, build_dir=temp_dir)
+            shprint(sh.touch, join(temp_dir, '.patched'))
+        rename(temp_dir, source_dir)
+        return source_dir
 
     def get_recipe_env(self, arch=None, with_flags_in_cc=True):
         """Return the env specialized for the recipe
@@ -551,18 +614,23 @@ class Recipe(with_metaclass(RecipeMeta)):
                 return
 
             build_dir = build_dir if build_dir else self.get_build_dir(arch.arch)
-            for patch in self.patches:
-                if isinstance(patch, (tuple, list)):
-                    patch, patch_check = patch
-                    if not patch_check(arch=arch, recipe=self):
-                        continue
-
-                self.apply_patch(
-                        patch.format(version=self.version, arch=arch.arch),
-                        arch.arch, build_dir=build_dir)
+            for patch in self.get_patches(arch):
+                self.apply_patch(patch, arch.arch, build_dir=build_dir)
 
             shprint(sh.touch, join(build_dir, '.patched'))
 
+    def get_patches(self, arch):
+        '''Returns the filenames (relative to the recipe dir) of the
+        :attr:`patches` to apply for the given Arch.'''
+        patches = []
+        for patch in self.patches:
+            if isinstance(patch, (tuple, list)):
+                patch, patch_check = patch
+                if not patch_check(arch=arch, recipe=self):
+                    continue
+            patches.append(patch.format(version=self.version, arch=arch.arch))
+        return patches
+
     def should_build(self, arch):
         '''Should perform any necessary test and return True only if it needs
         building again. Per default we implement a library test, in case that
@@ -583,6 +651,14 @@ class Recipe(with_metaclass(RecipeMeta)):
         if hasattr(self, build):
             getattr(self, build)()
 
+    def postrestore_arch(self, arch):
+        '''Run instead of :meth:`build_arch` when the outputs of the build
+        were restored from the artifact cache (see
+        :mod:`pythonforandroid.artifacts`). Recipes whose build also sets
+        up the build context (e.g. ``ctx.hostpython``) must do it here
+        too, as only files are restored. Does nothing by default.'''
+        pass
+
     def install_libraries(self, arch):
         '''This method is always called after `build_arch`. In case that we
         detect a library recipe, defined by the class attribute
@@ -984,6 +1060,14 @@ class PythonRecipe(Recipe):
             if self.install_in_hostpython:
                 self.install_hostpython_package(arch)
 
+    def postrestore_arch(self, arch):
+        '''Installs the restored module in the hostpython build dir, if
+        asked, as only the outputs for the target are restored.'''
+        super().postrestore_arch(arch)
+        if self.install_in_hostpython:
+            with current_directory(self.get_build_dir(arch.arch)):
+                self.install_hostpython_package(arch)
+
     def get_hostrecipe_env(self, arch):
         env = environ.copy()
         env['PYTHONPATH'] = join(dirname(self.real_hostpython_location), 'Lib', 'site-packages')
@@ -1140,6 +1224,10 @@ class CythonRecipe(PythonRecipe):
                                 arch.arch)))
 
         env['LDSHARED'] = env['CC'] + ' -shared'
+        if self.ctx.biglink:
+            # Link each extension to a relocatable object file instead,
+            # they all get linked into libpymodules.so by biglink
+            env['LDSHARED'] = join(self.ctx.root_dir, 'tools', 'liblink.sh')
         # shprint(sh.whereis, env['LDSHARED'], _env=env)
         env['LIBLINK'] = 'NOTNONE'
         env['NDKPLATFORM'] = self.ctx.ndk_sysroot  # FIXME?
@@ -1206,7 +1294,4 @@ class TargetPythonRecipe(Recipe):
 def algsum(alg, filen):
     '''Calculate the digest of a file.
     '''
-    with open(filen, 'rb') as fileh:
-        digest = getattr(hashlib, alg)(fileh.read())
-
-    return digest.hexdigest()
+    return file_digests(filen, [alg])[alg]
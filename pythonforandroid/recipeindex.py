@@ -0,0 +1,322 @@
+"""
+Index of the static metadata of the recipes.
+
+Resolving the dependency graph or listing the recipes only needs a few
+class attributes of each recipe (``depends``, ``conflicts``,
+``opt_depends``, ``python_depends``, ``site_packages_name`` and
+``version``), but importing each recipe module to read them is slow. These
+attributes are usually literals, so they are read from the source of the
+recipe instead, and the module is only imported when they can't be (e.g.
+the recipe class overrides ``__init__`` or inherits from another recipe).
+
+The metadata is recorded in the storage dir along with the modification
+time of the recipe file it was read from, and reused by the next
+invocations as long as the file doesn't change.
+"""
+
+from os import listdir, makedirs, replace, stat
+from os.path import basename, dirname, exists, join
+import ast
+import hashlib
+import json
+import types
+
+from pythonforandroid import __version__
+from pythonforandroid import recipe as recipe_module
+from pythonforandroid.logger import debug
+from pythonforandroid.recipe import Recipe
+
+
+INDEX_FILENAME = 'recipe-index.json'
+
+METADATA_ATTRIBUTES = (
+    'depends', 'conflicts', 'opt_depends', 'python_depends',
+    'site_packages_name', 'version')
+
+# the modules the recipes import their base classes from
+BASE_MODULES = ('pythonforandroid.recipe', 'pythonforandroid.toolchain')
+
+# the indexes loaded by this process, by recipe dirs and index file
+_indexes = {}
+
+
+class RecipeMetadata:
+    '''The static metadata of a recipe, with the same attributes as the
+    :class:`~pythonforandroid.recipe.Recipe` it describes.'''
+
+    def __init__(self, name, depends=None, conflicts=None, opt_depends=None,
+                 python_depends=None, site_packages_name=None, version=None):
+        self.name = name
+        self.depends = depends or []
+        self.conflicts = conflicts or []
+        self.opt_depends = opt_depends or []
+        self.python_depends = python_depends or []
+        self.site_packages_name = site_packages_name
+        self._version = version
+
+    @property
+    def version(self):
+        return Recipe.version.fget(self)
+
+    def get_opt_depends_in_list(self, recipes):
+        return Recipe.get_opt_depends_in_list(self, recipes)
+
+    @classmethod
+    def from_dict(cls, name, data):
+        # JSON turns the tuples of alternative dependencies into lists
+        data = dict(data)
+        data['depends'] = [
+            tuple(dep) if isinstance(dep, list) else dep
+            for dep in data['depends']]
+        return cls(name, **data)
+
+
+def get_metadata(recipe):
+    '''Returns the metadata of ``recipe`` (a recipe instance) as a dict.'''
+    return {
+        'depends': list(recipe.depends or []),
+        'conflicts': list(recipe.conflicts or []),
+        'opt_depends': list(recipe.opt_depends or []),
+        'python_depends': list(recipe.python_depends or []),
+        'site_packages_name': getattr(recipe, 'site_packages_name', None),
+        'version': recipe._version,
+    }
+
+
+def _get_base_classes(tree):
+    '''Returns the classes the module ``tree`` imports from the p4a
+    modules defining the base recipe classes, by local name.'''
+    bases = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ImportFrom) or (
+                node.module not in BASE_MODULES):
+            continue
+        for alias in node.names:
+            base = getattr(recipe_module, alias.name, None)
+            if isinstance(base, type):
+                bases[alias.asname or alias.name] = base
+    return bases
+
+
+def _get_recipe_class_name(tree):
+    '''Returns the name of the class of the module level ``recipe``
+    instance of ``tree``, if it's created without arguments.'''
+    class_name = None
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or not any(
+                isinstance(target, ast.Name) and target.id == 'recipe'
+                for target in node.targets):
+            continue
+        call = node.value
+        if (isinstance(call, ast.Call) and isinstance(call.func, ast.Name)
+                and not call.args and not call.keywords):
+            class_name = call.func.id
+        else:
+            class_name = None
+    return class_name
+
+
+def _assigns_metadata(node):
+    '''Returns whether the statement ``node`` may assign a metadata
+    attribute, as a name or as an attribute of any object.'''
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Store):
+            name = child.id
+        elif (isinstance(child, ast.Attribute) and
+                isinstance(child.ctx, ast.Store)):
+            name = child.attr
+        else:
+            continue
+        if name in METADATA_ATTRIBUTES:
+            return True
+    return False
+
+
+def _get_class_attributes(node):
+    '''Returns the metadata attributes the class ``node`` defines, or None
+    if they aren't all literals.'''
+    attributes = {}
+    for statement in node.body:
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if (statement.name == '__init__' or
+                    statement.name in METADATA_ATTRIBUTES):
+                return None
+            continue
+        if not _assigns_metadata(statement):
+            continue
+        if not (isinstance(statement, ast.Assign) and
+                len(statement.targets) == 1 and
+                isinstance(statement.targets[0], ast.Name)):
+            return None
+        try:
+            attributes[statement.targets[0].id] = ast.literal_eval(
+                statement.value)
+        except (TypeError, ValueError):
+            return None
+    return attributes
+
+
+def read_metadata(name, recipe_file):
+    '''Returns the metadata of the recipe ``name`` read from the source of
+    ``recipe_file``, or None if it can't be known without importing it.'''
+    with open(recipe_file) as fileh:
+        tree = ast.parse(fileh.read(), recipe_file)
+    class_nodes = {node.name: node for node in tree.body
+                   if isinstance(node, ast.ClassDef)}
+    if any(_assigns_metadata(node) for node in tree.body if not isinstance(
+            node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef))):
+        # e.g. the recipe instance is modified after its creation
+        return None
+    bases = _get_base_classes(tree)
+    classes = {}
+
+    def get_class(class_name):
+        # builds a stand-in for the class with only its metadata attributes
+        if class_name in bases:
+            return bases[class_name]
+        if class_name in classes:
+            return classes[class_name]
+        node = class_nodes.get(class_name)
+        if node is None or node.keywords or node.decorator_list or not all(
+                isinstance(base, ast.Name) for base in node.bases):
+            return None
+        attributes = _get_class_attributes(node)
+        if attributes is None:
+            return None
+        class_bases = []
+        for base in node.bases:
+            class_bases.append(get_class(base.id))
+            if class_bases[-1] is None:
+                return None
+        attributes['__module__'] = 'pythonforandroid.recipes.' + name
+        classes[class_name] = types.new_class(
+            class_name, tuple(class_bases),
+            exec_body=lambda namespace: namespace.update(attributes))
+        return classes[class_name]
+
+    recipe_class = get_class(_get_recipe_class_name(tree))
+    if recipe_class is None or recipe_class in bases.values() or (
+            not issubclass(recipe_class, Recipe)):
+        return None
+    # instantiate it, as the base classes may adjust the metadata, e.g.
+    # PythonRecipe makes sure the recipe depends on python3
+    return get_metadata(recipe_class())
+
+
+def find_recipe_files(ctx):
+    '''Returns the ``__init__.py`` of each recipe of ``ctx``, by lowercase
+    recipe name, in the same order of precedence as
+    :meth:`~pythonforandroid.recipe.Recipe.get_recipe`.'''
+    recipe_files = {}
+    for recipes_dir in Recipe.recipe_dirs(ctx):
+        if not exists(recipes_dir):
+            continue
+        for subfolder in listdir(recipes_dir):
+            recipe_file = join(recipes_dir, subfolder, '__init__.py')
+            if subfolder.lower() not in recipe_files and exists(recipe_file):
+                recipe_files[subfolder.lower()] = recipe_file
+    return recipe_files
+
+
+def _get_file_key(filename):
+    file_stat = stat(filename)
+    return [file_stat.st_mtime_ns, file_stat.st_size]
+
+
+class RecipeIndex:
+    '''The metadata of the recipes of ``ctx``, recorded in ``filename`` (or
+    only kept in memory if it's None).'''
+
+    def __init__(self, ctx, filename=None):
+        self.ctx = ctx
+        self.filename = filename
+        self.recipe_files = find_recipe_files(ctx)
+        # the metadata read by importing a recipe may come from other
+        # recipes (e.g. its base class), so it's keyed on all of them
+        self.recipes_key = hashlib.sha256(json.dumps([
+            [recipe_file] + _get_file_key(recipe_file)
+            for recipe_file in sorted(self.recipe_files.values())
+        ]).encode('utf-8')).hexdigest()
+        # the defaults of the metadata come from the base recipe classes
+        self.version = [__version__] + _get_file_key(recipe_module.__file__)
+        self.entries = {}
+        self.changed = False
+        self.metadata = {}
+        if filename is None:
+            return
+        try:
+            with open(filename) as fileh:
+                index = json.load(fileh)
+        except (OSError, ValueError):
+            return
+        if index.get('version') == self.version:
+            self.entries = index['recipes']
+
+    def get(self, name):
+        '''Returns the :class:`RecipeMetadata` of the recipe ``name``.
+
+        Raises ValueError if there's no such recipe.'''
+        name = name.lower()
+        if name in self.metadata:
+            return self.metadata[name]
+        recipe_file = self.recipe_files.get(name)
+        if recipe_file is None:
+            raise ValueError('Recipe does not exist: {}'.format(name))
+        recipe_name = basename(dirname(recipe_file))
+
+        file_key = _get_file_key(recipe_file)
+        entry = self.entries.get(recipe_file)
+        if entry is None or entry['key'] not in (
+                file_key, ['import', self.recipes_key]):
+            data = read_metadata(recipe_name, recipe_file)
+            key = file_key
+            if data is None:
+                debug('Importing recipe {} to read its metadata'.format(
+                    recipe_name))
+                data = get_metadata(Recipe.get_recipe(name, self.ctx))
+                key = ['import', self.recipes_key]
+            # compare the metadata the way it's read back, e.g. lists for
+            # tuples
+            entry = json.loads(json.dumps(
+                {'key': key, 'metadata': data}, default=str))
+            self.entries[recipe_file] = entry
+            self.changed = True
+        metadata = RecipeMetadata.from_dict(recipe_name, entry['metadata'])
+        self.metadata[name] = metadata
+        return metadata
+
+    def save(self):
+        '''Records the metadata read since this index was loaded.'''
+        if self.filename is None or not self.changed:
+            return
+        try:
+            makedirs(dirname(self.filename), exist_ok=True)
+            with open(self.filename + '.tmp', 'w') as fileh:
+                json.dump({'version': self.version, 'recipes': self.entries},
+                          fileh, indent=1)
+            replace(self.filename + '.tmp', self.filename)
+        except OSError as e:
+            debug('Could not record the recipe index in {}: {}'.format(
+                self.filename, e))
+            return
+        self.changed = False
+
+
+def get_recipe_index(ctx):
+    '''Returns the :class:`RecipeIndex` of the recipes of ``ctx``, loading
+    it on first use.'''
+    filename = None
+    if ctx.storage_dir:
+        filename = join(ctx.storage_dir, INDEX_FILENAME)
+    key = (tuple(Recipe.recipe_dirs(ctx)), filename)
+    if key not in _indexes:
+        _indexes[key] = RecipeIndex(ctx, filename)
+    return _indexes[key]
+
+
+def get_recipe_metadata(name, ctx):
+    '''Returns the metadata of the recipe ``name``, with the same
+    attributes as :meth:`Recipe.get_recipe(name, ctx)
+    <pythonforandroid.recipe.Recipe.get_recipe>` but without importing it
+    when possible. Raises ValueError if there's no such recipe.'''
+    return get_recipe_index(ctx).get(name)
@@ -125,5 +125,8 @@ class HostPython3Recipe(Recipe):
 
         self.ctx.hostpython = self.python_exe
 
+    def postrestore_arch(self, arch):
+        self.ctx.hostpython = self.python_exe
+
 
 recipe = HostPython3Recipe()
@@ -80,6 +80,10 @@ class Python3Recipe(TargetPythonRecipe):
             ("patches/py3.8.1_fix_cortex_a8.patch", version_starts_with("3.9"))
         ]
 
+    # prebuild_arch only registers the recipe in the context, the patches
+    # can be applied once to the sources shared by all the archs
+    prepatch_sources = True
+
     depends = ['hostpython3', 'sqlite3', 'openssl', 'libffi']
     # those optional depends allow us to build python compression modules:
     #   - _bz2.so
@@ -195,9 +199,10 @@ class Python3Recipe(TargetPythonRecipe):
         env['CC'] = arch.get_clang_exe(with_target=True)
 
         env['PATH'] = (
-            '{hostpython_dir}:{old_path}').format(
+            '{hostpython_dir}:{clang_path}:{old_path}').format(
                 hostpython_dir=self.get_recipe(
                     'host' + self.name, self.ctx).get_path_to_python(),
+                clang_path=arch.clang_path,
                 old_path=env['PATH'])
 
         env['CFLAGS'] = ' '.join(
@@ -209,7 +214,7 @@ class Python3Recipe(TargetPythonRecipe):
         )
 
         env['LDFLAGS'] = env.get('LDFLAGS', '')
-        if sh.which('lld') is not None:
+        if sh.which('lld', env['PATH'].split(':')) is not None:
             # Note: The -L. is to fix a bug in python 3.7.
             # https://bugs.freebsd.org/bugzilla/show_bug.cgi?id=234409
             env['LDFLAGS'] += ' -L. -fuse-ld=lld'
@@ -0,0 +1,180 @@
+"""
+Timing of the build.
+
+The phases of the build (download, unpack, prebuild, build... of each
+recipe for each arch, then biglink, bundle creation, gradle...) and each
+command run with :func:`~pythonforandroid.logger.shprint` are recorded
+with their wall and CPU time. At the end of each p4a command building a
+dist or a package, the records are written under ``<storage_dir>/timings``,
+as a summary in JSON and as a trace in the Chrome ``trace_event`` format,
+which can be opened with ``chrome://tracing`` or https://ui.perfetto.dev.
+Only the timings of the last ``$P4A_TIMINGS_KEEP`` (by default 20)
+commands are kept.
+"""
+
+from contextlib import contextmanager
+from os import environ, getpid, listdir, makedirs, remove, replace, times
+from os.path import join
+import json
+import threading
+import time
+
+
+TIMINGS_KEEP_VARIABLE = 'P4A_TIMINGS_KEEP'
+DEFAULT_TIMINGS_KEEP = 20
+
+
+# all the records of this process, see timed()
+_records = []
+
+# the recipe and arch of the phase each thread is in, if any
+_current = threading.local()
+
+# when this process (or the one that forked it) started
+_start = time.time()
+
+
+def get_records():
+    '''Returns the list of timing records of this process.'''
+    return _records
+
+
+def _cpu_times():
+    process_times = times()
+    return (time.thread_time(),
+            process_times.children_user + process_times.children_system)
+
+
+@contextmanager
+def timed(name, category='phase', recipe=None, arch=None):
+    '''Records the time spent in the ``with`` block as ``name``, for the
+    given recipe and arch, if any. When nested, the recipe and arch
+    default to those of the enclosing block.
+
+    Besides the wall time, the record holds the CPU time of the thread
+    running the block, and that of the subprocesses which finished
+    meanwhile (those of other threads included).
+    '''
+    parent = getattr(_current, 'context', (None, None))
+    context = _current.context = (recipe or parent[0], arch or parent[1])
+    start = time.time()
+    start_cpu, start_children_cpu = _cpu_times()
+    try:
+        yield
+    finally:
+        end_cpu, end_children_cpu = _cpu_times()
+        _records.append({
+            'name': name,
+            'category': category,
+            'recipe': context[0],
+            'arch': context[1],
+            'start': start - _start,
+            'wall': time.time() - start,
+            'cpu': end_cpu - start_cpu,
+            'children_cpu': end_children_cpu - start_children_cpu,
+            'pid': getpid(),
+            # get_native_id is only there since python 3.8
+            'tid': getattr(
+                threading, 'get_native_id', threading.get_ident)(),
+        })
+        _current.context = parent
+
+
+def summarize(records):
+    '''Returns the wall and CPU times of the phases of ``records``, by
+    recipe (``None`` for the phases of the whole build), arch and phase
+    name.'''
+    summary = {}
+    for record in records:
+        if record['category'] != 'phase':
+            continue
+        phases = summary.setdefault(
+            str(record['recipe']), {}).setdefault(str(record['arch']), {})
+        phase = phases.setdefault(
+            record['name'], {'wall': 0, 'cpu': 0, 'count': 0})
+        phase['wall'] += record['wall']
+        phase['cpu'] += record['cpu'] + record['children_cpu']
+        phase['count'] += 1
+    return summary
+
+
+def to_trace_events(records):
+    '''Converts ``records`` to Chrome trace events.'''
+    events = []
+    for record in records:
+        name = record['name']
+        if record['category'] == 'phase' and record['recipe']:
+            name = '{} {}'.format(name, record['recipe'])
+        events.append({
+            'name': name,
+            'cat': record['category'],
+            'ph': 'X',
+            'ts': int(record['start'] * 1e6),
+            'dur': int(record['wall'] * 1e6),
+            'pid': record['pid'],
+            'tid': record['tid'],
+            'args': {
+                key: record[key]
+                for key in ('recipe', 'arch', 'cpu', 'children_cpu')
+                if record[key] is not None
+            },
+        })
+    return events
+
+
+def _write_json(data, filename):
+    with open(filename + '.tmp', 'w') as fileh:
+        json.dump(data, fileh, indent=1, default=str)
+    replace(filename + '.tmp', filename)
+
+
+def get_timings_keep():
+    '''Returns how many commands the timings are kept for, from
+    ``$P4A_TIMINGS_KEEP``.'''
+    try:
+        return max(int(environ[TIMINGS_KEEP_VARIABLE]), 0)
+    except (KeyError, ValueError):
+        return DEFAULT_TIMINGS_KEEP
+
+
+def prune_timings(timings_dir, keep):
+    '''Deletes the timings of all but the last ``keep`` commands from
+    ``timings_dir``.'''
+    summaries = sorted(
+        filename for filename in listdir(timings_dir)
+        if filename.endswith('.json') and
+        not filename.endswith('.trace.json'))
+    for summary in summaries[:max(len(summaries) - keep, 0)]:
+        for filename in (summary, summary[:-len('.json')] + '.trace.json'):
+            try:
+                remove(join(timings_dir, filename))
+            except FileNotFoundError:
+                pass
+
+
+def write_timings(storage_dir, command):
+    '''Writes the records of this process to ``<storage_dir>/timings``,
+    named after the p4a ``command`` and the time this process started,
+    and forgets them. The timings of older commands are pruned (see
+    :func:`get_timings_keep`). Returns the path of the summary, or None if
+    nothing was recorded.'''
+    if not _records:
+        return None
+    timings_dir = join(storage_dir, 'timings')
+    makedirs(timings_dir, exist_ok=True)
+    filename = join(timings_dir, '{}-{}'.format(
+        time.strftime('%Y%m%d-%H%M%S', time.localtime(_start)), command))
+    _write_json({
+        'command': command,
+        'start': _start,
+        'wall': time.time() - _start,
+        'phases': summarize(_records),
+        'records': _records,
+    }, filename + '.json')
+    _write_json({
+        'traceEvents': to_trace_events(_records),
+        'displayTimeUnit': 'ms',
+    }, filename + '.trace.json')
+    del _records[:]
+    prune_timings(timings_dir, get_timings_keep())
+    return filename + '.json'
@@ -8,7 +8,8 @@ This module defines the entry point for command line and programmatic use.
 
 from os import environ
 from pythonforandroid import __version__
-from pythonforandroid.pythonpackage import get_dep_names_of_package
+from pythonforandroid.pythonpackage import (
+    enable_metadata_cache, get_dep_names_of_package)
 from pythonforandroid.recommendations import (
     RECOMMENDED_NDK_API, RECOMMENDED_TARGET_API, print_recommendations)
 from pythonforandroid.util import BuildInterruptingException, load_source
@@ -86,6 +87,7 @@ import logging
 from distutils.version import LooseVersion
 
 from pythonforandroid.recipe import Recipe
+from pythonforandroid.recipeindex import get_recipe_index
 from pythonforandroid.logger import (logger, info, warning, setup_color,
                                      Out_Style, Out_Fore,
                                      info_notify, info_main, shprint)
@@ -94,6 +96,8 @@ from pythonforandroid.bootstrap import Bootstrap
 from pythonforandroid.distribution import Distribution, pretty_log_dists
 from pythonforandroid.graph import get_recipe_order_and_bootstrap
 from pythonforandroid.build import Context, build_recipes
+from pythonforandroid.download import DEFAULT_DOWNLOAD_JOBS
+from pythonforandroid.timing import timed, write_timings
 
 user_dir = dirname(realpath(os.path.curdir))
 toolchain_dir = dirname(__file__)
@@ -150,6 +154,8 @@ def require_prebuilt_dist(func):
                         'so one will be built.')
             build_dist_from_args(ctx, dist, args)
         func(self, args, **kw)
+    # the timings of the commands building something are recorded
+    wrapper_func.records_timings = True
     return wrapper_func
 
 
@@ -214,7 +220,8 @@ def build_dist_from_args(ctx, dist, args):
                   ),
                  )
 
-    ctx.bootstrap.assemble_distribution()
+    with timed('bundle'):
+        ctx.bootstrap.assemble_distribution()
 
     info_main('# Your distribution was created successfully, exiting.')
     info('Dist can be found at (for now) {}'
@@ -396,6 +403,25 @@ class ToolchainCL:
             description='Copy libraries instead of using biglink (Android 4.3+)'
         )
 
+        add_boolean_option(
+            generic_parser, ['biglink'],
+            default=False,
+            description=('Link the extension modules of the recipes into a '
+                         'single libpymodules.so, so that importing them '
+                         'loads one library instead of one per module')
+        )
+
+        generic_parser.add_argument(
+            '--jobs', dest='jobs', type=int, default=1,
+            help=('How many recipes may be built at the same time, as far '
+                  'as their dependencies allow it (default: 1)'))
+
+        generic_parser.add_argument(
+            '--download-jobs', dest='download_jobs', type=int,
+            default=DEFAULT_DOWNLOAD_JOBS,
+            help=('How many recipe sources may be downloaded at the same '
+                  'time (default: {})'.format(DEFAULT_DOWNLOAD_JOBS)))
+
         self._read_configuration()
 
         subparsers = parser.add_subparsers(dest='subparser_name',
@@ -664,6 +690,7 @@ class ToolchainCL:
                     getattr(args, "use_setup_py", False)):
                 try:
                     info("Analyzing package dependencies. MAY TAKE A WHILE.")
+                    enable_metadata_cache(expanduser(args.storage_dir))
                     # Get all the dependencies corresponding to a recipe:
                     dependencies = [
                         dep.lower() for dep in
@@ -719,13 +746,30 @@ class ToolchainCL:
 
         self.ctx.local_recipes = args.local_recipes
         self.ctx.copy_libs = args.copy_libs
+        self.ctx.biglink = args.biglink
+        self.ctx.jobs = max(args.jobs, 1)
+        self.ctx.download_jobs = max(args.download_jobs, 1)
 
         self.ctx.activity_class_name = args.activity_class_name
         self.ctx.service_class_name = args.service_class_name
 
         # Each subparser corresponds to a method
         command = args.subparser_name.replace('-', '_')
-        getattr(self, command)(args)
+        method = getattr(self, command)
+        try:
+            method(args)
+        finally:
+            if getattr(method, 'records_timings', False):
+                self._write_timings(command)
+
+    def _write_timings(self, command):
+        try:
+            timings = write_timings(self.ctx.storage_dir, command)
+        except OSError as e:
+            warning('Could not write the build timings: {}'.format(e))
+        else:
+            if timings is not None:
+                info('Build timings written to {}'.format(timings))
 
     @staticmethod
     def warn_on_carriage_return_args(args):
@@ -813,16 +857,19 @@ class ToolchainCL:
         if args.compact:
             print(" ".join(set(Recipe.list_recipes(ctx))))
         else:
+            index = get_recipe_index(ctx)
             for name in sorted(Recipe.list_recipes(ctx)):
                 try:
-                    recipe = Recipe.get_recipe(name, ctx)
+                    recipe = index.get(name)
                 except (IOError, ValueError):
                     warning('Recipe "{}" could not be loaded'.format(name))
+                    continue
                 except SyntaxError:
                     import traceback
                     traceback.print_exc()
                     warning(('Recipe "{}" could not be loaded due to a '
                              'syntax error').format(name))
+                    continue
                 version = str(recipe.version)
                 print('{Fore.BLUE}{Style.BRIGHT}{recipe.name:<12} '
                       '{Style.RESET_ALL}{Fore.LIGHTBLUE_EX}'
@@ -839,6 +886,7 @@ class ToolchainCL:
                     print('    {Fore.YELLOW}optional depends: '
                           '{recipe.opt_depends}{Fore.RESET}'
                           .format(recipe=recipe, Fore=Out_Fore))
+            index.save()
 
     def bootstraps(self, _args):
         """List all the bootstraps available to build with."""
@@ -1045,9 +1093,11 @@ class ToolchainCL:
             self.hook("before_apk_build")
             os.environ["ANDROID_API"] = str(self.ctx.android_api)
             build = load_source('build', join(dist.dist_dir, 'build.py'))
-            build_args = build.parse_args_and_make_package(
-                args.unknown_args
-            )
+            build.make_tar = timed('make_tar')(build.make_tar)
+            with timed('make_package'):
+                build_args = build.parse_args_and_make_package(
+                    args.unknown_args
+                )
 
             self.hook("after_apk_build")
             self.hook("before_apk_assemble")
@@ -1093,8 +1143,9 @@ class ToolchainCL:
             else:
                 raise BuildInterruptingException(
                     "Unknown build mode {} for apk()".format(args.build_mode))
-            output = shprint(gradlew, gradle_task, _tail=20,
-                             _critical=True, _env=env)
+            with timed('gradle'):
+                output = shprint(gradlew, gradle_task, _tail=20,
+                                 _critical=True, _env=env)
         return output, build_args
 
     def _finish_package(self, args, output, build_args, package_type, output_dir):
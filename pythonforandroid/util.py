@@ -1,6 +1,6 @@
 import contextlib
-from os.path import exists, join
-from os import getcwd, chdir, makedirs, walk, uname
+from os.path import basename, dirname, exists, join
+from os import getcwd, chdir, link, makedirs, replace, unlink, walk, uname
 import shutil
 from fnmatch import fnmatch
 from tempfile import mkdtemp
@@ -44,6 +44,96 @@ def ensure_dir(filename):
         makedirs(filename)
 
 
+FICLONE = 0x40049409
+'''The Linux ``ioctl`` request to share the data of a file with another
+one, on filesystems supporting it (btrfs, xfs, ...).'''
+
+
+def reflink_file(source, target):
+    '''Creates ``target`` as a copy-on-write clone of ``source``. Raises
+    an :class:`OSError` if the filesystem (or platform) can't do it.'''
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            unlink(target)
+            raise
+    shutil.copystat(source, target)
+
+
+def clone_file(source, target, hardlink=True):
+    '''Makes ``target`` hold the content of ``source`` using the cheapest
+    available way: a hardlink (unless ``hardlink`` is False, e.g. because
+    one of the files may be modified in place), then a copy-on-write clone,
+    and finally a plain copy.
+
+    The file is created in a private temporary directory next to
+    ``target`` and atomically renamed to it, so that concurrent readers
+    never see it half-written and concurrent writers of the same content
+    don't conflict.
+    '''
+    temp_dir = mkdtemp(prefix='.tmp-', dir=dirname(target) or '.')
+    temp_target = join(temp_dir, basename(target))
+    try:
+        if hardlink:
+            try:
+                link(source, temp_target)
+                replace(temp_target, target)
+                return
+            except OSError:
+                # e.g. different filesystems, or a file owned by
+                # someone else with fs.protected_hardlinks
+                pass
+        try:
+            reflink_file(source, temp_target)
+        except (OSError, ImportError):
+            shutil.copy2(source, temp_target)
+        replace(temp_target, target)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def copy_tree(source, target, exclude=(), reflink=False):
+    '''Copies the directory ``source`` to ``target`` (which must not
+    exist), keeping symlinks and file metadata like ``cp -a`` does. The
+    top level entries of ``source`` named in ``exclude`` are skipped.
+
+    With ``reflink``, files are cloned (copy-on-write) instead of copied
+    when the filesystem supports it.
+
+    The tree is first copied in a private temporary directory next to
+    ``target``, then renamed, so an interrupted copy never leaves a partial
+    ``target`` behind.
+    '''
+    def ignore(dirn, names):
+        if dirn == source:
+            return [name for name in names if name in exclude]
+        return []
+
+    can_reflink = [reflink]
+
+    def copy_function(src, dst):
+        if can_reflink[0]:
+            try:
+                reflink_file(src, dst)
+                return dst
+            except (OSError, ImportError):
+                # not supported here, don't try again for every file
+                can_reflink[0] = False
+        return shutil.copy2(src, dst)
+
+    temp_dir = mkdtemp(prefix='.tmp-', dir=dirname(target) or '.')
+    temp_target = join(temp_dir, basename(target))
+    try:
+        shutil.copytree(source, temp_target, symlinks=True, ignore=ignore,
+                        copy_function=copy_function)
+        replace(temp_target, target)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
 def walk_valid_filens(base_dir, invalid_dir_names, invalid_file_patterns):
     """Recursively walks all the files and directories in ``dirn``,
     ignoring directories that match any pattern in ``invalid_dirns``
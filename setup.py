@@ -22,9 +22,9 @@ data_files = []
 install_reqs = [
     'appdirs', 'colorama>=0.3.3', 'jinja2', 'six',
     'enum34; python_version<"3.4"', 'sh>=1.10; sys_platform!="nt"',
-    'pep517<0.7.0', 'toml',
+    'pep517<0.7.0', 'toml', 'packaging',
 ]
-# (pep517 and toml are used by pythonpackage.py)
+# (pep517, toml and packaging are used by pythonpackage.py)
 
 
 # By specifying every file manually, package_data will be able to
@@ -0,0 +1,126 @@
+import io
+import os
+import stat
+import tarfile
+import unittest
+import zipfile
+
+import pytest
+from backports import tempfile
+
+from pythonforandroid.archive import extract_archive, is_archive
+
+
+def add_tar_file(tar, name, data=b'', mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    tar.addfile(info, io.BytesIO(data))
+
+
+class TestExtractArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.target = os.path.join(self.temp_dir.name, 'build', 'foo')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def path(self, *names):
+        return os.path.join(self.temp_dir.name, *names)
+
+    def read(self, name):
+        with open(os.path.join(self.target, name), 'rb') as fileh:
+            return fileh.read()
+
+    def test_is_archive(self):
+        assert is_archive('Python-3.7.4.tgz')
+        assert is_archive('master.zip')
+        assert not is_archive('Python-3.7.4.tar.lz')
+
+    def test_extract_tar(self):
+        archive = self.path('foo-1.0.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            info = tarfile.TarInfo('foo-1.0')
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+            add_tar_file(tar, 'foo-1.0/setup.py', b'setup()')
+            add_tar_file(tar, 'foo-1.0/bin/configure', b'#!/bin/sh', 0o755)
+            info = tarfile.TarInfo('foo-1.0/bin/configure.sh')
+            info.type = tarfile.LNKTYPE
+            info.linkname = 'foo-1.0/bin/configure'
+            info.mode = 0o755
+            tar.addfile(info)
+        extract_archive(archive, self.target)
+        assert sorted(os.listdir(self.target)) == ['bin', 'setup.py']
+        assert self.read('setup.py') == b'setup()'
+        assert os.access(os.path.join(self.target, 'bin', 'configure'),
+                         os.X_OK)
+        assert os.path.samefile(
+            os.path.join(self.target, 'bin', 'configure'),
+            os.path.join(self.target, 'bin', 'configure.sh'))
+        # nothing else is left in the parent directory
+        assert os.listdir(self.path('build')) == ['foo']
+
+    def test_extract_tar_without_root_directory(self):
+        archive = self.path('foo.tar.bz2')
+        with tarfile.open(archive, 'w:bz2') as tar:
+            add_tar_file(tar, 'setup.py', b'setup()')
+            add_tar_file(tar, 'src/foo.c', b'int foo;')
+        extract_archive(archive, self.target)
+        assert sorted(os.listdir(self.target)) == ['setup.py', 'src']
+
+    def test_extract_tar_read_only_directory(self):
+        archive = self.path('foo-1.0.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            info = tarfile.TarInfo('foo-1.0/src')
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o555
+            info.mtime = 1000000000
+            tar.addfile(info)
+            add_tar_file(tar, 'foo-1.0/src/foo.c', b'int foo;')
+        extract_archive(archive, self.target)
+        src_dir = os.path.join(self.target, 'src')
+        try:
+            assert self.read('src/foo.c') == b'int foo;'
+            # the attributes of the directory are set once it is filled
+            assert stat.S_IMODE(os.stat(src_dir).st_mode) == 0o555
+            assert os.stat(src_dir).st_mtime == 1000000000
+        finally:
+            os.chmod(src_dir, 0o755)
+
+    def test_extract_zip(self):
+        archive = self.path('master.zip')
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('foo-master/', '')
+            zip_file.writestr('foo-master/setup.py', 'setup()')
+            info = zipfile.ZipInfo('foo-master/configure')
+            info.external_attr = (stat.S_IFREG | 0o755) << 16
+            zip_file.writestr(info, '#!/bin/sh')
+            info = zipfile.ZipInfo('foo-master/configure.sh')
+            info.external_attr = (stat.S_IFLNK | 0o777) << 16
+            zip_file.writestr(info, 'configure')
+        extract_archive(archive, self.target)
+        assert sorted(os.listdir(self.target)) == [
+            'configure', 'configure.sh', 'setup.py']
+        assert self.read('setup.py') == b'setup()'
+        assert os.access(os.path.join(self.target, 'configure'), os.X_OK)
+        assert os.readlink(
+            os.path.join(self.target, 'configure.sh')) == 'configure'
+
+    def test_extract_zip_outside_target(self):
+        archive = self.path('evil.zip')
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('foo/setup.py', 'setup()')
+            zip_file.writestr('../../evil.py', 'evil')
+        with pytest.raises(ValueError):
+            extract_archive(archive, self.target)
+        # the partial extraction is removed
+        assert not os.path.exists(self.target)
+        assert os.listdir(self.path('build')) == []
+
+    def test_extract_unknown_format(self):
+        with pytest.raises(ValueError):
+            extract_archive(self.path('foo.rar'), self.target)
@@ -143,7 +143,7 @@ class TestArchARM(ArchSetUpBaseClass, unittest.TestCase):
                 "{ndk_dir}/toolchains/llvm*".format(ndk_dir=self.ctx._ndk_dir),
             )
         mock_find_executable.assert_called_once_with(
-            self.expected_compiler, path=environ["PATH"]
+            self.expected_compiler, path=env["PATH"]
         )
 
         # check gcc compilers
@@ -164,6 +164,25 @@ class TestArchARM(ArchSetUpBaseClass, unittest.TestCase):
         # check that cflags are in gcc
         self.assertIn(env["CFLAGS"], env["CC"])
 
+        # the NDK is added to the PATH of the env, not to our own
+        self.assertEqual(
+            env["PATH"],
+            "{}:{}".format(os.path.dirname(self.expected_compiler),
+                           environ["PATH"]),
+        )
+
+        # the env is cached, and each call gets its own copy
+        env["CFLAGS"] += " -O3"
+        self.assertEqual(arch.get_env(), dict(env, CFLAGS=env["CFLAGS"][:-4]))
+        self.assertEqual(mock_glob.call_count, 4)
+        self.assertEqual(mock_find_executable.call_count, 1)
+        arch.extra_global_link_paths.append("/opt/libs")
+        self.assertIn("-L'/opt/libs'", arch.get_env()["LDFLAGS"])
+        self.assertEqual(mock_find_executable.call_count, 2)
+        arch.invalidate_env()
+        arch.get_env()
+        self.assertEqual(mock_find_executable.call_count, 3)
+
         # check that flags aren't in gcc and also check ccache
         self.ctx.ccache = "/usr/bin/ccache"
         env = arch.get_env(with_flags_in_cc=False)
@@ -230,7 +249,7 @@ class TestArchARMv7a(ArchSetUpBaseClass, unittest.TestCase):
                 "{ndk_dir}/toolchains/llvm*".format(ndk_dir=self.ctx._ndk_dir),
             )
         mock_find_executable.assert_called_once_with(
-            self.expected_compiler, path=environ["PATH"]
+            self.expected_compiler, path=env["PATH"]
         )
 
         # check clang
@@ -301,7 +320,7 @@ class TestArchX86(ArchSetUpBaseClass, unittest.TestCase):
                 "{ndk_dir}/toolchains/llvm*".format(ndk_dir=self.ctx._ndk_dir),
             )
         mock_find_executable.assert_called_once_with(
-            self.expected_compiler, path=environ["PATH"]
+            self.expected_compiler, path=env["PATH"]
         )
 
         # For x86 we expect some extra cflags in our `environment`
@@ -356,7 +375,7 @@ class TestArchX86_64(ArchSetUpBaseClass, unittest.TestCase):
                 "{ndk_dir}/toolchains/llvm*".format(ndk_dir=self.ctx._ndk_dir),
             )
         mock_find_executable.assert_called_once_with(
-            self.expected_compiler, path=environ["PATH"]
+            self.expected_compiler, path=env["PATH"]
         )
 
         # For x86_64 we expect some extra cflags in our `environment`
@@ -411,7 +430,7 @@ class TestArchAArch64(ArchSetUpBaseClass, unittest.TestCase):
                 "{ndk_dir}/toolchains/llvm*".format(ndk_dir=self.ctx._ndk_dir),
             )
         mock_find_executable.assert_called_once_with(
-            self.expected_compiler, path=environ["PATH"]
+            self.expected_compiler, path=env["PATH"]
         )
 
         # For x86_64 we expect to find an extra key in`environment`
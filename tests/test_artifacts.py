@@ -0,0 +1,205 @@
+import os
+import tarfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from backports import tempfile
+
+from pythonforandroid.artifacts import (
+    DirectoryArtifactCache, HTTPArtifactCache, get_artifact_cache,
+    pack_changes, restore_recipe_artifact, snapshot_dirs,
+    store_recipe_artifact, unpack_changes,
+)
+
+
+class ArtifactRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves and stores the artifacts of `self.server.files` with GET and
+    PUT requests.
+    """
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        length = int(self.headers['Content-Length'])
+        self.server.files[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestArtifactCaches(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.artifact = os.path.join(self.temp_dir.name, 'artifact.tar.gz')
+        with open(self.artifact, 'wb') as fileh:
+            fileh.write(os.urandom(12345))
+        self.fetched = os.path.join(self.temp_dir.name, 'fetched.tar.gz')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def check_cache(self, cache):
+        assert not cache.fetch('key.tar.gz', self.fetched)
+        cache.store('key.tar.gz', self.artifact)
+        assert cache.fetch('key.tar.gz', self.fetched)
+        with open(self.artifact, 'rb') as fileh:
+            expected = fileh.read()
+        with open(self.fetched, 'rb') as fileh:
+            assert fileh.read() == expected
+
+    def test_directory_cache(self):
+        self.check_cache(DirectoryArtifactCache(
+            os.path.join(self.temp_dir.name, 'cache')))
+
+    def test_http_cache(self):
+        server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), ArtifactRequestHandler)
+        server.files = {}
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            self.check_cache(HTTPArtifactCache(
+                'http://127.0.0.1:{}/p4a/'.format(server.server_address[1])))
+            assert list(server.files) == ['/p4a/key.tar.gz']
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_get_artifact_cache(self):
+        with mock.patch.dict(os.environ, {'P4A_ARTIFACT_CACHE': ''}):
+            assert get_artifact_cache() is None
+        with mock.patch.dict(os.environ, {'P4A_ARTIFACT_CACHE': '/cache'}):
+            assert isinstance(get_artifact_cache(), DirectoryArtifactCache)
+        with mock.patch.dict(os.environ, {
+                'P4A_ARTIFACT_CACHE': 'https://example.com/cache'}):
+            assert isinstance(get_artifact_cache(), HTTPArtifactCache)
+
+
+class TestPackChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dirs = {
+            name: os.path.join(self.temp_dir.name, 'before', name)
+            for name in ('build', 'libs')
+        }
+        self.write('build', 'configure', 'unchanged')
+        self.write('build', 'Makefile', 'before')
+        self.write('libs', 'libother.so', 'another recipe')
+        self.tarball = os.path.join(self.temp_dir.name, 'changes.tar.gz')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, path, content, dirs=None):
+        filename = os.path.join((dirs or self.dirs)[name], path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as fileh:
+            fileh.write(content)
+
+    def test_pack_changes(self):
+        snapshot = snapshot_dirs(self.dirs)
+        self.write('build', 'Makefile', 'after the build')
+        self.write('build', 'src/lib.o', 'object')
+        self.write('libs', 'libdummy.so', 'library')
+        os.link(os.path.join(self.dirs['libs'], 'libdummy.so'),
+                os.path.join(self.dirs['build'], 'libdummy.so'))
+        assert pack_changes(self.dirs, snapshot, self.tarball) == 4
+        with tarfile.open(self.tarball) as tar:
+            assert sorted(tar.getnames()) == [
+                'build/Makefile', 'build/libdummy.so', 'build/src/lib.o',
+                'libs/libdummy.so']
+            # files sharing an inode are stored as regular files
+            assert all(member.isfile() for member in tar)
+
+        restored_dirs = {
+            name: os.path.join(self.temp_dir.name, 'restored', name)
+            for name in self.dirs
+        }
+        self.write('libs', 'libother.so', 'another recipe', restored_dirs)
+        unpack_changes(restored_dirs, self.tarball)
+        assert snapshot_dirs(restored_dirs)['libs'].keys() == {
+            'libdummy.so', 'libother.so'}
+        with open(os.path.join(restored_dirs['build'], 'src/lib.o')) as fileh:
+            assert fileh.read() == 'object'
+
+    def test_unpack_unexpected_dir(self):
+        with tarfile.open(self.tarball, 'w:gz') as tar:
+            tar.add(self.dirs['build'], 'other/dir')
+        with self.assertRaises(ValueError):
+            unpack_changes(self.dirs, self.tarball)
+
+
+class TestRecipeArtifacts(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dirs = {
+            name: os.path.join(self.temp_dir.name, name)
+            for name in ('build', 'objects', 'libs', 'python-installs')
+        }
+        for directory in self.dirs.values():
+            os.makedirs(directory)
+        patcher = mock.patch(
+            'pythonforandroid.artifacts.get_output_dirs',
+            return_value=self.dirs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = DirectoryArtifactCache(
+            os.path.join(self.temp_dir.name, 'cache'))
+        self.recipe = mock.Mock()
+        self.recipe.name = 'dummy'
+        self.recipe.get_dir_name.return_value = 'dummy'
+        self.arch = mock.Mock(arch='arm64-v8a')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_store_and_restore(self):
+        assert not restore_recipe_artifact(
+            self.cache, self.recipe, self.arch, 'fingerprint')
+        snapshot = snapshot_dirs(self.dirs)
+        library = os.path.join(self.dirs['libs'], 'libdummy.so')
+        with open(library, 'w') as fileh:
+            fileh.write('library')
+        with mock.patch('pythonforandroid.artifacts.info'):
+            store_recipe_artifact(
+                self.cache, self.recipe, self.arch, 'fingerprint', snapshot)
+        assert os.listdir(self.cache.directory) == [
+            'dummy-arm64-v8a-fingerprint.tar.gz']
+
+        os.unlink(library)
+        with mock.patch('pythonforandroid.artifacts.info'):
+            assert restore_recipe_artifact(
+                self.cache, self.recipe, self.arch, 'fingerprint')
+        assert os.path.exists(library)
+        assert not restore_recipe_artifact(
+            self.cache, self.recipe, self.arch, 'other-fingerprint')
+
+    def test_restore_error(self):
+        os.makedirs(self.cache.directory)
+        with open(os.path.join(self.cache.directory,
+                               'dummy-arm64-v8a-fingerprint.tar.gz'),
+                  'w') as fileh:
+            fileh.write('not a tarball')
+        # a broken artifact is reported, and the recipe gets built
+        with mock.patch('pythonforandroid.artifacts.warning') as m_warning:
+            assert not restore_recipe_artifact(
+                self.cache, self.recipe, self.arch, 'fingerprint')
+        assert m_warning.call_count == 1
@@ -190,8 +190,9 @@ class TestBootstrapBasic(BaseClassSetupBootstrap, unittest.TestCase):
         get_bootstraps_from_recipes` returns the expected values
         """
 
-        import pythonforandroid.recipe
-        original_get_recipe = pythonforandroid.recipe.Recipe.get_recipe
+        import pythonforandroid.bootstrap
+        original_get_recipe_metadata = (
+            pythonforandroid.bootstrap.get_recipe_metadata)
 
         # Test that SDL2 works with kivy:
         recipes_sdl2 = {"sdl2", "python3", "kivy"}
@@ -210,17 +211,16 @@ class TestBootstrapBasic(BaseClassSetupBootstrap, unittest.TestCase):
         )
         self.assertEqual(bs.name, "sdl2")
 
-        with mock.patch("pythonforandroid.recipe.Recipe.get_recipe") as \
-                mock_get_recipe:
+        with mock.patch(
+                "pythonforandroid.bootstrap.get_recipe_metadata") as \
+                mock_get_recipe_metadata:
             # Test that something conflicting with sdl2 won't give sdl2:
             def _add_sdl2_conflicting_recipe(name, ctx):
                 if name == "conflictswithsdl2":
-                    if name not in pythonforandroid.recipe.Recipe.recipes:
-                        pythonforandroid.recipe.Recipe.recipes[name] = (
-                            get_fake_recipe("sdl2", conflicts=["sdl2"])
-                        )
-                return original_get_recipe(name, ctx)
-            mock_get_recipe.side_effect = _add_sdl2_conflicting_recipe
+                    return get_fake_recipe("sdl2", conflicts=["sdl2"])
+                return original_get_recipe_metadata(name, ctx)
+            mock_get_recipe_metadata.side_effect = (
+                _add_sdl2_conflicting_recipe)
             recipes_with_sdl2_conflict = {"python3", "conflictswithsdl2"}
             bs = Bootstrap.get_bootstrap_from_recipes(
                 recipes_with_sdl2_conflict, self.ctx
@@ -549,7 +549,11 @@ class GenericBootstrapTest(BaseClassSetupBootstrap):
             mock_find_executable.call_args[0][0],
             mock_find_executable.return_value,
         )
-        mock_sh_command.assert_called_once_with("arm-linux-androideabi-strip")
+        # the strip command is looked up in the PATH of the build env
+        mock_sh_command.assert_called_once_with(
+            "arm-linux-androideabi-strip",
+            search_paths=arch.get_env()["PATH"].split(":"),
+        )
         # check that the other mocks we made are actually called
         mock_ensure_dir.assert_called()
         mock_sh_print.assert_called()
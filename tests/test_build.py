@@ -1,10 +1,27 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import types
 import unittest
 from unittest import mock
 
 import jinja2
+import pytest
+import sh
 
-from pythonforandroid.build import run_pymodules_install
+from pythonforandroid import timing
+from pythonforandroid.build import (
+    Context, biglink_function, biglink_modules, build_recipe, build_recipes_in_parallel,
+    copylibs_function,
+    ensure_pip_venv,
+    get_extension_module_name, get_pure_wheels, remove_biglinked_modules,
+    run_pymodules_install, run_setuppy_install,
+)
 from pythonforandroid.archs import ArchARMv7_a, ArchAarch_64
+from pythonforandroid.recipe import PythonRecipe, Recipe
+from pythonforandroid.util import BuildInterruptingException
 
 
 class TestBuildBasic(unittest.TestCase):
@@ -37,6 +54,7 @@ class TestBuildBasic(unittest.TestCase):
                 mock.patch('pythonforandroid.build.open'),\
                 mock.patch('pythonforandroid.build.shprint'),\
                 mock.patch('pythonforandroid.build.current_directory'),\
+                mock.patch('pythonforandroid.build.ensure_pip_venv'), \
                 mock.patch('pythonforandroid.build.CythonRecipe') as m_CythonRecipe, \
                 mock.patch('pythonforandroid.build.project_has_setup_py') as m_project_has_setup_py, \
                 mock.patch('pythonforandroid.build.run_setuppy_install'):
@@ -54,6 +72,804 @@ class TestBuildBasic(unittest.TestCase):
             assert m_CythonRecipe().strip_object_files.called is True
 
 
+class TestPipVenv(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.ctx = mock.Mock()
+        self.ctx.build_dir = self.temp_dir.name
+        self.ctx.hostpython = '/path/to/hostpython3'
+        self.venv_dir = os.path.join(self.temp_dir.name, 'venv')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def ensure_pip_venv(self):
+        def shprint(command, *args, **kwargs):
+            if args[:2] == ('-m', 'venv'):
+                os.makedirs(os.path.join(
+                    args[2], 'lib', 'python3.8', 'site-packages', 'pip'))
+        with mock.patch('sh.Command') as m_command, \
+                mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.shprint',
+                           side_effect=shprint) as m_shprint:
+            m_command.return_value.return_value = '3.8.9 (default)\n'
+            ensure_pip_venv(self.ctx)
+        return m_shprint.call_args_list
+
+    def test_ensure_pip_venv(self):
+        calls = self.ensure_pip_venv()
+        assert calls[0][0][1:] == ('-m', 'venv', self.venv_dir)
+        assert calls[1][0][1:] == ('install', 'pip==23.3.2')
+        assert calls[2][0][1:] == ('install', 'Cython==0.29.36')
+        # the venv is reused...
+        assert self.ensure_pip_venv() == []
+        # ...until the pinned versions change
+        with mock.patch('pythonforandroid.build.VENV_CYTHON_VERSION', '3.0'):
+            assert len(self.ensure_pip_venv()) == 3
+        assert len(self.ensure_pip_venv()) == 3
+        # ...or another version of Cython is asked for
+        with mock.patch.dict(os.environ, {'P4A_VENV_CYTHON_VERSION': '3.0.7'}):
+            calls = self.ensure_pip_venv()
+            assert calls[2][0][1:] == ('install', 'Cython==3.0.7')
+            assert self.ensure_pip_venv() == []
+        assert len(self.ensure_pip_venv()) == 3
+        # ...or its site-packages is left modified
+        os.mkdir(os.path.join(
+            self.venv_dir, 'lib', 'python3.8', 'site-packages', 'myapp'))
+        assert len(self.ensure_pip_venv()) == 3
+        assert not os.path.exists(os.path.join(
+            self.venv_dir, 'lib', 'python3.8', 'site-packages', 'myapp'))
+
+
+class TestPureWheels(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.ctx = mock.Mock()
+        self.ctx.build_dir = os.path.join(self.temp_dir.name, 'build')
+        self.ctx.python_recipe.major_minor_version_string = '3.8'
+        self.ctx.archs = [ArchARMv7_a(self.ctx), ArchAarch_64(self.ctx)]
+        self.ctx.get_site_packages_dir.side_effect = (
+            lambda arch: os.path.join(self.temp_dir.name, arch.arch))
+        self.ctx.not_has_package.return_value = True
+        os.makedirs(self.ctx.build_dir)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @staticmethod
+    def shprint(command, *args, **kwargs):
+        # fakes pip, with only a pure-Python wheel of mypurepackage
+        if args[0] == 'download':
+            if args[-1] != 'mypurepackage':
+                raise sh.ErrorReturnCode_1('pip download', b'', b'')
+            download_dir = args[args.index('-d') + 1]
+            with open(os.path.join(
+                    download_dir,
+                    'mypurepackage-1.0-py3-none-any.whl'), 'w'):
+                pass
+        elif args[0] == 'install':
+            package_dir = os.path.join(
+                args[args.index('--target') + 1], 'mypurepackage')
+            os.makedirs(package_dir)
+            with open(os.path.join(package_dir, '__init__.py'), 'w'):
+                pass
+
+    def get_pure_wheels(self, modules):
+        with mock.patch('pythonforandroid.build.ensure_pip_venv'), \
+                mock.patch('pythonforandroid.build.info'), \
+                mock.patch('sh.Command'), \
+                mock.patch('pythonforandroid.build.shprint',
+                           side_effect=self.shprint) as m_shprint:
+            pure_wheels = get_pure_wheels(self.ctx, modules)
+        return pure_wheels, [call[0][1] for call in m_shprint.call_args_list]
+
+    def test_get_pure_wheels(self):
+        pure_wheels, commands = self.get_pure_wheels(
+            ['mypurepackage', 'mynativepackage'])
+        install_dir = os.path.join(
+            self.ctx.build_dir, 'pure-installs', 'mypurepackage-1.0-py3-none-any')
+        assert pure_wheels == {'mypurepackage': install_dir}
+        assert commands == ['download', 'install', 'download']
+        assert os.path.exists(os.path.join(
+            self.ctx.build_dir, 'wheelhouse',
+            'mypurepackage-1.0-py3-none-any.whl'))
+        # the wheel is installed only once
+        assert self.get_pure_wheels(['mypurepackage']) == (
+            pure_wheels, ['download'])
+
+    def test_run_pymodules_install_pure_wheels(self):
+        pure_wheels, _ = self.get_pure_wheels(['mypurepackage'])
+        for arch in self.ctx.archs:
+            with mock.patch('pythonforandroid.build.info'), \
+                    mock.patch('pythonforandroid.build.ensure_pip_venv') \
+                    as m_ensure_pip_venv:
+                run_pymodules_install(
+                    self.ctx, arch, ['mypurepackage'], pure_wheels=pure_wheels)
+            # nothing is left to be installed with pip for the arch
+            m_ensure_pip_venv.assert_not_called()
+            installed_file = os.path.join(
+                self.temp_dir.name, arch.arch, 'mypurepackage', '__init__.py')
+            assert os.stat(installed_file).st_ino == os.stat(os.path.join(
+                pure_wheels['mypurepackage'], 'mypurepackage',
+                '__init__.py')).st_ino
+
+
+class TestSetupPyInstall(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.ctx = mock.Mock()
+        self.ctx.build_dir = os.path.join(self.temp_dir.name, 'build')
+        self.site_packages_dir = os.path.join(self.temp_dir.name, 'arm64-v8a')
+        self.ctx.get_site_packages_dir.return_value = self.site_packages_dir
+        self.venv_site_packages_dir = os.path.join(
+            self.ctx.build_dir, 'venv', 'lib', 'python3.8', 'site-packages')
+        self.project_dir = os.path.join(self.temp_dir.name, 'myapp')
+        for directory in (self.venv_site_packages_dir,
+                          os.path.join(self.site_packages_dir, 'kivy'),
+                          self.project_dir):
+            os.makedirs(directory)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def shprint(self, command, *args, **kwargs):
+        # fakes the project install by pip
+        overlay = os.path.join(
+            self.venv_site_packages_dir, 'p4a-site-packages.pth')
+        with open(overlay) as fileh:
+            assert fileh.read().strip() == self.site_packages_dir
+        for directory in ('myapp', 'myapp-1.0.dist-info', 'unrecorded'):
+            os.mkdir(os.path.join(self.venv_site_packages_dir, directory))
+        with open(os.path.join(self.venv_site_packages_dir, 'myapp',
+                               '__init__.py'), 'w'):
+            pass
+        with open(os.path.join(self.venv_site_packages_dir,
+                               'myapp-1.0.dist-info', 'RECORD'), 'w') as f:
+            f.write('myapp/__init__.py,sha256=abc,0\n'
+                    'myapp-1.0.dist-info/RECORD,,\n'
+                    '../../../bin/myapp,sha256=def,10\n')
+
+    def test_run_setuppy_install(self):
+        with mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.subprocess.check_output',
+                           return_value=b'kivy==2.0.0\n'), \
+                mock.patch('pythonforandroid.build.shprint',
+                           side_effect=self.shprint) as m_shprint:
+            run_setuppy_install(self.ctx, self.project_dir, {}, 'arm64-v8a')
+        assert m_shprint.call_count == 1
+        # only the recorded additions are copied back...
+        assert sorted(os.listdir(self.site_packages_dir)) == [
+            'kivy', 'myapp', 'myapp-1.0.dist-info']
+        assert os.listdir(os.path.join(self.site_packages_dir, 'myapp')) == [
+            '__init__.py']
+        # ...and the venv is left as it was
+        assert os.listdir(self.venv_site_packages_dir) == []
+        assert os.listdir(self.project_dir) == []
+
+    def test_run_setuppy_install_unrecorded(self):
+        # e.g. a legacy setup.py install, with an egg-info and no RECORD
+        def shprint(command, *args, **kwargs):
+            for directory in ('myapp', 'myapp-1.0-py3.8.egg-info'):
+                os.mkdir(os.path.join(self.venv_site_packages_dir, directory))
+        with mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.subprocess.check_output',
+                           return_value=b'kivy==2.0.0\n'), \
+                mock.patch('pythonforandroid.build.shprint',
+                           side_effect=shprint):
+            run_setuppy_install(self.ctx, self.project_dir, {}, 'arm64-v8a')
+        # everything the install added is copied back
+        assert sorted(os.listdir(self.site_packages_dir)) == [
+            'kivy', 'myapp', 'myapp-1.0-py3.8.egg-info']
+        assert os.listdir(self.venv_site_packages_dir) == []
+
+    def test_run_setuppy_install_overlay_changed(self):
+        # the failed install doesn't leave the project dir
+        self.addCleanup(os.chdir, os.getcwd())
+
+        def shprint(command, *args, **kwargs):
+            os.rmdir(os.path.join(self.site_packages_dir, 'kivy'))
+        with mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.subprocess.check_output',
+                           return_value=b'kivy==2.0.0\n'), \
+                mock.patch('pythonforandroid.build.shprint',
+                           side_effect=shprint), \
+                pytest.raises(BuildInterruptingException) as e_info:
+            run_setuppy_install(self.ctx, self.project_dir, {}, 'arm64-v8a')
+        assert 'removed kivy' in e_info.value.message
+        assert os.listdir(self.venv_site_packages_dir) == []
+
+
+class TestBiglink(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.objs_dir = os.path.join(self.temp_dir.name, 'objs')
+        os.makedirs(self.objs_dir)
+        self.soname = os.path.join(self.temp_dir.name, 'libpymodules.so')
+        self.write('a.so.o', 'a')
+        self.write('a.so.libs', '-lm -L -lc')
+        self.write('b.so.o', 'b')
+        self.write('b.so.libs', '-lm ')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, filename, data):
+        with open(os.path.join(self.objs_dir, filename), 'w') as fileh:
+            fileh.write(data)
+
+    def biglink(self):
+        def shprint(command, *args, **kwargs):
+            with open(self.soname, 'w'):
+                pass
+        with mock.patch('sh.Command'), \
+                mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.print'), \
+                mock.patch('pythonforandroid.build.shprint',
+                           side_effect=shprint) as m_shprint, \
+                mock.patch('os.listdir',
+                           return_value=sorted(os.listdir(self.objs_dir))):
+            biglink_function(self.soname, [self.objs_dir],
+                             extra_link_dirs=['/ndk/lib'],
+                             env={'CC': 'ccache clang -target arm'})
+        return m_shprint.call_args_list
+
+    def test_biglink_function(self):
+        calls = self.biglink()
+        assert len(calls) == 1
+        response_file = os.path.join(self.objs_dir, '.biglink-args')
+        assert calls[0][0][1:] == ('@' + response_file,)
+        with open(response_file) as fileh:
+            assert fileh.read().split('\n') == [
+                '"-shared"', '"-O3"', '"-o"', '"{}"'.format(self.soname),
+                '"{}"'.format(os.path.join(self.objs_dir, 'a.so.o')),
+                '"-lc"',
+                '"{}"'.format(os.path.join(self.objs_dir, 'b.so.o')),
+                '"-lm"', '"-L/ndk/lib"', '']
+
+    def test_biglink_function_fingerprint(self):
+        self.biglink()
+        # nothing changed, no need to relink
+        assert self.biglink() == []
+        # the objects changed
+        self.write('b.so.o', 'b2')
+        assert len(self.biglink()) == 1
+        # the output is missing
+        os.remove(self.soname)
+        assert len(self.biglink()) == 1
+
+
+class TestBiglinkModules(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.site_packages_dir = os.path.join(self.temp_dir.name, 'site')
+        self.objects_dir = os.path.join(self.temp_dir.name, 'objects_kivy')
+        os.makedirs(self.objects_dir)
+        self.ctx = mock.Mock(
+            recipe_build_order=['kivy'], build_dir=self.temp_dir.name,
+            with_debug_symbols=True)
+        self.ctx.get_site_packages_dir.return_value = self.site_packages_dir
+        self.recipe = mock.Mock()
+        self.recipe.name = 'kivy'
+        self.recipe.get_build_container_dir.return_value = self.temp_dir.name
+        self.arch = mock.Mock(arch='arm64-v8a', ndk_lib_dir=self.temp_dir.name)
+        self.arch.get_env.return_value = {'CC': 'clang'}
+        for module in ('kivy._event', 'kivy.core.buffer',
+                       'kivy.graphics.buffer'):
+            self.add_extension(module)
+        self.write(os.path.join(self.site_packages_dir, 'kivy', 'other.so'),
+                   b'\x7fELF')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, filename, data):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as fileh:
+            fileh.write(data)
+
+    def add_extension(self, module):
+        # what tools/liblink leaves of the extension
+        name = '0123abcd.{}.cpython-38.so'.format(module.rpartition('.')[2])
+        if module == 'kivy.core.buffer':
+            name = 'f00f.' + name
+        self.write(os.path.join(self.objects_dir, name + '.o'), b'')
+        self.write(os.path.join(self.objects_dir, name + '.libs'), b'-lm')
+        self.write(
+            os.path.join(self.site_packages_dir, *module.split('.')) +
+            '.cpython-38.so',
+            b'p4a-liblink ' + name.encode('utf-8') + b'\n')
+
+    def biglink_modules(self):
+        with mock.patch('pythonforandroid.build.Recipe.get_recipe',
+                        return_value=self.recipe), \
+                mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.biglink_function') \
+                as m_biglink_function, \
+                mock.patch('pythonforandroid.build.link_extension') \
+                as m_link_extension:
+            biglink_modules(self.ctx, self.arch)
+        return m_biglink_function, m_link_extension
+
+    def test_get_extension_module_name(self):
+        assert get_extension_module_name(
+            '/site', '/site/kivy/graphics/buffer.cpython-38.so'
+        ) == 'kivy.graphics.buffer'
+        assert get_extension_module_name('/site', '/site/_foo.so') == '_foo'
+
+    def test_biglink_modules(self):
+        m_biglink_function, m_link_extension = self.biglink_modules()
+
+        # the placeholders were replaced by the name of their module
+        assert sorted(
+            filename for root, dirnames, filenames in os.walk(
+                self.site_packages_dir)
+            for filename in filenames) == ['_p4a_pymodules.py', 'other.so']
+        with open(os.path.join(
+                self.objects_dir,
+                '0123abcd._event.cpython-38.so.module')) as fileh:
+            assert fileh.read() == 'kivy._event'
+
+        # PyInit_buffer can only be in the library once
+        m_link_extension.assert_called_once_with(
+            os.path.join(self.objects_dir,
+                         '0123abcd.buffer.cpython-38.so'),
+            os.path.join(self.site_packages_dir, 'kivy', 'graphics',
+                         'buffer.so'),
+            {'CC': 'clang'})
+        library = os.path.join(self.site_packages_dir, 'libpymodules.so')
+        objects_dir = os.path.join(self.temp_dir.name, 'biglink', 'arm64-v8a')
+        assert m_biglink_function.call_args[0] == (library, [objects_dir])
+        assert sorted(os.listdir(objects_dir)) == [
+            'kivy._event.so.libs', 'kivy._event.so.o',
+            'kivy.core.buffer.so.libs', 'kivy.core.buffer.so.o']
+
+        # the generated module imports them from the library
+        spec = importlib.util.spec_from_file_location(
+            '_p4a_pymodules', os.path.join(
+                self.site_packages_dir, '_p4a_pymodules.py'))
+        finder_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(finder_module)
+        finder = finder_module.PyModulesFinder
+        sys.meta_path.remove(finder)
+        spec = finder.find_spec('kivy.core.buffer')
+        assert spec.origin == library
+        assert spec.loader.path == library
+        assert finder.find_spec('kivy.graphics.buffer') is None
+        assert finder.find_spec('kivy.other') is None
+
+        # the modules of the recipes not rebuilt are still known
+        m_biglink_function, m_link_extension = self.biglink_modules()
+        assert m_link_extension.call_count == 1
+        assert sorted(os.listdir(objects_dir)) == [
+            'kivy._event.so.libs', 'kivy._event.so.o',
+            'kivy.core.buffer.so.libs', 'kivy.core.buffer.so.o']
+
+    def test_biglink_modules_dropped(self):
+        self.biglink_modules()
+        # the recipe is installed again without kivy.core.buffer
+        for module in ('kivy._event', 'kivy.graphics.buffer'):
+            self.add_extension(module)
+        m_biglink_function, m_link_extension = self.biglink_modules()
+        assert not os.path.exists(os.path.join(
+            self.objects_dir, 'f00f.0123abcd.buffer.cpython-38.so.module'))
+        # so kivy.graphics.buffer can now be in the library
+        objects_dir = os.path.join(self.temp_dir.name, 'biglink', 'arm64-v8a')
+        assert sorted(os.listdir(objects_dir)) == [
+            'kivy._event.so.libs', 'kivy._event.so.o',
+            'kivy.graphics.buffer.so.libs', 'kivy.graphics.buffer.so.o']
+        m_link_extension.assert_not_called()
+
+    def test_biglink_modules_missing_object(self):
+        os.remove(os.path.join(
+            self.objects_dir, '0123abcd._event.cpython-38.so.o'))
+        with self.assertRaises(BuildInterruptingException):
+            self.biglink_modules()
+
+    def test_remove_biglinked_modules(self):
+        self.biglink_modules()
+        self.write(os.path.join(
+            self.site_packages_dir, 'libpymodules.so'), b'')
+        remove_biglinked_modules(self.ctx, self.arch)
+        assert sorted(os.listdir(self.site_packages_dir)) == ['kivy']
+        # nothing to remove
+        remove_biglinked_modules(self.ctx, self.arch)
+
+
+class TestCopyLibs(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.objs_dir = os.path.join(self.temp_dir.name, 'objs')
+        self.libs_dir = os.path.join(self.temp_dir.name, 'libs')
+        self.dest_dir = os.path.join(self.temp_dir.name, 'dest')
+        for directory in (self.objs_dir, self.libs_dir, self.dest_dir):
+            os.makedirs(directory)
+        for filename in ('libbar.so', 'libbaz.a', 'qux.so', 'libunused.so'):
+            with open(os.path.join(self.libs_dir, filename), 'w'):
+                pass
+        with open(os.path.join(self.objs_dir, 'foo.libs'), 'w') as fileh:
+            fileh.write('bar baz c')
+        with open(os.path.join(self.objs_dir, 'foo.libdirs'), 'w') as fileh:
+            fileh.write(' '.join([self.dest_dir, self.libs_dir]))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def read_elf_file(self, path):
+        needed = {'libbar.so': ['libqux.so', 'libc.so']}
+        return mock.Mock(needed=needed.get(os.path.basename(path), []))
+
+    def copylibs(self):
+        with mock.patch('pythonforandroid.build.read_elf_file',
+                        side_effect=self.read_elf_file), \
+                mock.patch('pythonforandroid.build.print'), \
+                mock.patch('pythonforandroid.build.shprint') as m_shprint:
+            copylibs_function(
+                os.path.join(self.dest_dir, 'libmain.so'), [self.objs_dir])
+        return m_shprint
+
+    def test_copylibs_function(self):
+        m_shprint = self.copylibs()
+        assert m_shprint.call_args[0][1:] == (
+            os.path.join(self.libs_dir, 'libbar.so'),
+            os.path.join(self.libs_dir, 'qux.so'),
+            self.dest_dir)
+
+    def test_copylibs_function_missing(self):
+        os.remove(os.path.join(self.libs_dir, 'qux.so'))
+        with self.assertRaises(RuntimeError) as context:
+            self.copylibs()
+        assert 'Failed to locate needed libraries!\n\tqux' in str(
+            context.exception)
+
+
+class TestBuildRecipe(unittest.TestCase):
+
+    def build_recipe(self, should_build, outdated, cache=None,
+                     restored=False, store_artifact=True, discarded=False):
+        recipe = mock.Mock()
+        recipe.should_build.return_value = should_build
+        with mock.patch.multiple(
+                'pythonforandroid.build', info=mock.DEFAULT,
+                info_main=mock.DEFAULT, get_source_fingerprint=mock.DEFAULT,
+                get_build_fingerprint=mock.Mock(return_value='fingerprint'),
+                write_fingerprints=mock.DEFAULT,
+                discard_outdated_build=mock.Mock(return_value=discarded),
+                unpack_recipe=mock.DEFAULT, prebuild_recipe=mock.DEFAULT,
+                is_build_outdated=mock.Mock(return_value=outdated),
+                get_artifact_cache=mock.Mock(return_value=cache),
+                get_output_dirs=mock.DEFAULT,
+                snapshot_dirs=mock.Mock(return_value={'libs': {}}),
+                restore_recipe_artifact=mock.DEFAULT,
+                store_recipe_artifact=mock.DEFAULT) as mocks:
+            mocks['restore_recipe_artifact'].return_value = restored
+            self.snapshot = build_recipe(
+                recipe, mock.Mock(), store_artifact=store_artifact)
+        self.mocks = mocks
+        assert mocks['write_fingerprints'].call_count == 1
+        assert recipe.install_libraries.call_count == 1
+        return recipe.build_arch.call_count
+
+    def test_build_recipe(self):
+        assert self.build_recipe(should_build=True, outdated=False) == 1
+        # already built, but its inputs changed
+        assert self.build_recipe(should_build=False, outdated=True) == 1
+        assert self.build_recipe(should_build=False, outdated=False) == 0
+        assert self.mocks['unpack_recipe'].call_count == 0
+
+    def test_build_recipe_discarded(self):
+        # built with other flags: built again from fresh sources
+        assert self.build_recipe(
+            should_build=False, outdated=True, discarded=True) == 1
+        assert self.mocks['unpack_recipe'].call_count == 1
+        assert self.mocks['prebuild_recipe'].call_count == 1
+
+    def test_build_recipe_artifact_cache(self):
+        cache = mock.Mock()
+        # restored from the cache instead of building
+        assert self.build_recipe(True, False, cache, restored=True) == 0
+        assert self.mocks['store_recipe_artifact'].call_count == 0
+        # not in the cache, built and stored
+        assert self.build_recipe(True, False, cache) == 1
+        self.mocks['store_recipe_artifact'].assert_called_once_with(
+            cache, mock.ANY, mock.ANY, 'fingerprint', {'libs': {}})
+        assert self.snapshot is None
+        # built, storing it is left to the caller
+        assert self.build_recipe(
+            True, False, cache, store_artifact=False) == 1
+        assert self.mocks['store_recipe_artifact'].call_count == 0
+        assert self.snapshot == {'libs': {}}
+        # up to date, the cache isn't even looked at
+        assert self.build_recipe(False, False, cache) == 0
+        assert self.mocks['restore_recipe_artifact'].call_count == 0
+
+    def test_build_recipe_restored_context(self):
+        # hostpython3 is restored from the cache on a machine that never
+        # built it: python3 still gets the hostpython it sets up
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ctx = Context()
+            ctx.setup_dirs(temp_dir)
+            ctx.ndk_api = 21
+            ctx.recipe_build_order = ['hostpython3', 'python3']
+            arch = ArchAarch_64(ctx)
+            hostpython3 = Recipe.get_recipe('hostpython3', ctx)
+            python3 = Recipe.get_recipe('python3', ctx)
+            hostpythons = []
+
+            def restore(cache, recipe, arch, build_fingerprint):
+                if recipe is not hostpython3:
+                    return False
+                os.makedirs(recipe.get_path_to_python())
+                with open(recipe.python_exe, 'w'):
+                    pass
+                return True
+
+            def build_python3(arch):
+                hostpythons.append(python3.ctx.hostpython)
+            with mock.patch.multiple(
+                    'pythonforandroid.build', info=mock.DEFAULT,
+                    info_main=mock.DEFAULT,
+                    get_source_fingerprint=mock.DEFAULT,
+                    get_build_fingerprint=mock.DEFAULT,
+                    write_fingerprints=mock.DEFAULT,
+                    is_build_outdated=mock.Mock(return_value=False),
+                    get_artifact_cache=mock.Mock(return_value='cache'),
+                    restore_recipe_artifact=mock.Mock(side_effect=restore),
+                    get_output_dirs=mock.DEFAULT,
+                    snapshot_dirs=mock.DEFAULT,
+                    store_recipe_artifact=mock.DEFAULT), \
+                    mock.patch.object(hostpython3, 'ctx', ctx), \
+                    mock.patch.object(python3, 'ctx', ctx), \
+                    mock.patch.object(python3, 'should_build',
+                                      return_value=True), \
+                    mock.patch.object(python3, 'build_arch',
+                                      side_effect=build_python3), \
+                    mock.patch.object(python3, 'install_libraries'):
+                assert not hasattr(ctx, 'hostpython')
+                build_recipe(hostpython3, arch)
+                build_recipe(python3, arch, store_artifact=False)
+        assert hostpythons == [hostpython3.python_exe]
+
+    def test_build_recipe_restored_hostpython_package(self):
+        # cython is restored from the cache: it is installed in the
+        # hostpython again, as that is not part of its outputs
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ctx = Context()
+            ctx.setup_dirs(temp_dir)
+            arch = ArchAarch_64(ctx)
+            ctx.ndk_api = 21
+            cython = Recipe.get_recipe('cython', ctx)
+            assert cython.install_in_hostpython
+            install_dirs = []
+
+            def install_hostpython_package(arch):
+                install_dirs.append(os.getcwd())
+            with mock.patch.multiple(
+                    'pythonforandroid.build', info=mock.DEFAULT,
+                    info_main=mock.DEFAULT,
+                    get_source_fingerprint=mock.DEFAULT,
+                    get_build_fingerprint=mock.DEFAULT,
+                    discard_outdated_build=mock.Mock(return_value=False),
+                    write_fingerprints=mock.DEFAULT,
+                    get_artifact_cache=mock.Mock(return_value='cache'),
+                    restore_recipe_artifact=mock.Mock(return_value=True)), \
+                    mock.patch.object(cython, 'ctx', ctx), \
+                    mock.patch.object(cython, 'should_build',
+                                      return_value=True), \
+                    mock.patch.object(
+                        cython, 'install_hostpython_package',
+                        side_effect=install_hostpython_package), \
+                    mock.patch.object(cython, 'build_arch') as m_build_arch:
+                os.makedirs(cython.get_build_dir(arch.arch))
+                build_recipe(cython, arch)
+            m_build_arch.assert_not_called()
+            assert install_dirs == [os.path.realpath(
+                cython.get_build_dir(arch.arch))]
+
+
+class FakeRecipe:
+    # unlike a Mock, doesn't change its own attributes when called
+    name = None
+    build_in_parallel = True
+
+    def __init__(self, name, ctx, build_arch):
+        self.name = name
+        self.ctx = ctx
+        self.build_arch = build_arch
+
+    def should_build(self, arch):
+        return True
+
+    def postrestore_arch(self, arch):
+        pass
+
+    def install_libraries(self, arch):
+        pass
+
+
+class TestParallelBuild(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.temp_dir.name, 'build.log')
+        self.ctx = types.SimpleNamespace(hostpython=None)
+        self.arch = ArchAarch_64(self.ctx)
+        # the fake recipes have no fingerprints
+        self.fingerprints = mock.patch.multiple(
+            'pythonforandroid.build', get_source_fingerprint=mock.DEFAULT,
+            get_build_fingerprint=mock.DEFAULT, write_fingerprints=mock.DEFAULT,
+            discard_outdated_build=mock.Mock(return_value=False),
+            get_artifact_cache=mock.Mock(return_value=None))
+        self.fingerprints.start()
+
+    def tearDown(self):
+        self.fingerprints.stop()
+        self.temp_dir.cleanup()
+
+    def get_fake_recipe(self, name, build_arch=None):
+        def default_build_arch(arch):
+            with open(self.log, 'a') as fileh:
+                fileh.write('start {}\n'.format(name))
+            time.sleep(0.2)
+            with open(self.log, 'a') as fileh:
+                fileh.write('end {}\n'.format(name))
+        return FakeRecipe(name, self.ctx, build_arch or default_build_arch)
+
+    def read_log(self):
+        with open(self.log) as fileh:
+            return fileh.read().splitlines()
+
+    def test_build_recipes_in_parallel(self):
+        def build_hostpython(arch):
+            self.ctx.hostpython = '/path/to/hostpython'
+        recipes = [
+            self.get_fake_recipe('hostpython3', build_hostpython),
+            self.get_fake_recipe('libffi'),
+            self.get_fake_recipe('openssl'),
+            self.get_fake_recipe('python3'),
+        ]
+        graph = {
+            'hostpython3': set(),
+            'libffi': set(),
+            'openssl': set(),
+            'python3': {'hostpython3', 'libffi', 'openssl'},
+        }
+        with mock.patch('pythonforandroid.build.get_build_graph',
+                        return_value=graph), \
+                mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.info_main'), \
+                mock.patch.object(timing, '_records', []):
+            build_recipes_in_parallel(recipes, self.arch, self.ctx, 3)
+            records = timing.get_records()
+        log = self.read_log()
+        # the independent recipes were built at the same time...
+        assert sorted(log[:2]) == ['start libffi', 'start openssl']
+        # ...and python3 only once all its dependencies were done
+        assert log[-2:] == ['start python3', 'end python3']
+        # context changes done in the worker processes are kept
+        assert self.ctx.hostpython == '/path/to/hostpython'
+        # and so are their timings
+        builds = [record for record in records if record['name'] == 'build']
+        assert sorted(record['recipe'] for record in builds) == [
+            'hostpython3', 'libffi', 'openssl', 'python3']
+        assert os.getpid() not in {record['pid'] for record in builds}
+
+    def test_build_recipes_in_parallel_artifact_cache(self):
+        recipes = [
+            self.get_fake_recipe('libffi'),
+            self.get_fake_recipe('openssl'),
+            self.get_fake_recipe('python3'),
+        ]
+        graph = {
+            'libffi': set(),
+            'openssl': set(),
+            'python3': {'libffi', 'openssl'},
+        }
+        with mock.patch.multiple(
+                'pythonforandroid.build', info=mock.DEFAULT,
+                info_main=mock.DEFAULT, debug=mock.DEFAULT,
+                get_build_graph=mock.Mock(return_value=graph),
+                get_artifact_cache=mock.Mock(return_value='cache'),
+                get_output_dirs=mock.DEFAULT,
+                snapshot_dirs=mock.Mock(return_value={}),
+                restore_recipe_artifact=mock.Mock(return_value=False),
+                read_fingerprints=mock.Mock(
+                    return_value={'build': 'fingerprint'}),
+                store_recipe_artifact=mock.DEFAULT) as mocks:
+            build_recipes_in_parallel(recipes, self.arch, self.ctx, 2)
+        # libffi and openssl were built together, so the files they added
+        # to the shared dirs can't be told apart: only python3 is stored
+        mocks['store_recipe_artifact'].assert_called_once_with(
+            'cache', recipes[2], self.arch, 'fingerprint', {})
+
+    def build_in_parallel(self, recipes, graph, jobs=2):
+        with mock.patch('pythonforandroid.build.get_build_graph',
+                        return_value=graph), \
+                mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.info_main'):
+            build_recipes_in_parallel(recipes, self.arch, self.ctx, jobs)
+
+    def test_build_recipes_in_parallel_state(self):
+        def build_libffi(arch):
+            os.environ['P4A_TEST_LIBFFI'] = 'built'
+            recipes[0].libdir = '/path/to/libffi'
+        recipes = [self.get_fake_recipe('libffi', build_libffi)]
+        with mock.patch.dict(os.environ):
+            self.build_in_parallel(recipes, {'libffi': set()})
+            # plain recipe attributes and the environment are kept
+            assert os.environ['P4A_TEST_LIBFFI'] == 'built'
+        assert recipes[0].libdir == '/path/to/libffi'
+
+    def test_build_recipes_in_parallel_lost_state(self):
+        def build_libffi(arch):
+            self.ctx.libffi_dirs = ['/path/to/libffi']
+        recipes = [self.get_fake_recipe('libffi', build_libffi)]
+        # other state can't be sent back by the worker
+        with pytest.raises(BuildInterruptingException) as e_info:
+            self.build_in_parallel(recipes, {'libffi': set()})
+        assert 'ctx.libffi_dirs' in e_info.value.message
+        assert not hasattr(self.ctx, 'libffi_dirs')
+
+        # unless the recipe is built in this process
+        recipes = [self.get_fake_recipe('libffi', build_libffi),
+                   self.get_fake_recipe('openssl')]
+        recipes[0].build_in_parallel = False
+        self.build_in_parallel(recipes, {'libffi': set(), 'openssl': set()})
+        assert self.ctx.libffi_dirs == ['/path/to/libffi']
+        assert self.read_log() == ['start openssl', 'end openssl']
+
+    def test_build_recipes_in_parallel_lost_state_in_place(self):
+        def build_libffi(arch):
+            self.ctx.include_dirs.append('/path/to/libffi')
+            self.ctx.flags['libffi'] = {'-O2'}
+        self.ctx.include_dirs = []
+        self.ctx.flags = {}
+        recipes = [self.get_fake_recipe('libffi', build_libffi)]
+        # containers changed in place are not missed
+        with pytest.raises(BuildInterruptingException) as e_info:
+            self.build_in_parallel(recipes, {'libffi': set()})
+        assert 'ctx.flags, ctx.include_dirs' in e_info.value.message
+
+    def test_build_recipes_in_parallel_python_recipes(self):
+        recipes = [
+            self.get_fake_recipe('libffi'),
+            self.get_fake_recipe('kivy'),
+            self.get_fake_recipe('pyjnius'),
+        ]
+        for recipe in recipes[1:]:
+            recipe.__class__ = type('FakePythonRecipe', (
+                FakeRecipe, PythonRecipe), {})
+        self.build_in_parallel(
+            recipes, {'libffi': set(), 'kivy': set(), 'pyjnius': set()},
+            jobs=3)
+        log = self.read_log()
+        # the python recipes don't install at the same time
+        assert 'start libffi' in log[:2]
+        assert log.index('start pyjnius') > log.index('end kivy')
+
+    def test_build_recipes_in_parallel_failure(self):
+        def build_fails(arch):
+            raise RuntimeError('compilation failed')
+        recipes = [
+            self.get_fake_recipe('libffi', build_fails),
+            self.get_fake_recipe('python3'),
+        ]
+        graph = {'libffi': set(), 'python3': {'libffi'}}
+        with mock.patch('pythonforandroid.build.get_build_graph',
+                        return_value=graph), \
+                mock.patch('pythonforandroid.build.info'), \
+                mock.patch('pythonforandroid.build.info_main'), \
+                pytest.raises(BuildInterruptingException) as e_info:
+            build_recipes_in_parallel(recipes, self.arch, self.ctx, 2)
+        assert 'libffi' in e_info.value.message
+        assert not os.path.exists(self.log)
+
+
 class TestTemplates(unittest.TestCase):
 
     def test_android_manifest_xml(self):
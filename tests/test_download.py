@@ -0,0 +1,266 @@
+import hashlib
+import io
+import os
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pytest
+from backports import tempfile
+
+from pythonforandroid.download import (
+    DownloadProgress, add_to_store, cached_file_digests, download_recipes,
+    fetch_from_store, fetch_url, file_digests, format_size,
+    get_digests_record_filename, get_store_filename,
+)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves `self.server.files`, honouring `Range` requests unless
+    `self.server.support_ranges` is False. The first
+    `self.server.failures` responses are cut in the middle of the body.
+    """
+
+    def do_GET(self):
+        server = self.server
+        data = server.files[self.path]
+        server.requests.append(self.headers.get('Range'))
+        range_header = self.headers.get('Range')
+        start = 0
+        if range_header and server.support_ranges:
+            start = int(range_header.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        if server.failures:
+            server.failures -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetchUrl(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(1024 * 1024 + 123)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.files = {'/archive.tar.gz': self.data}
+        self.server.requests = []
+        self.server.support_ranges = True
+        self.server.failures = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/archive.tar.gz'.format(
+            self.server.server_address[1])
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.target = os.path.join(self.temp_dir.name, 'archive.tar.gz')
+        self.progress = DownloadProgress(stream=io.StringIO())
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def read_target(self):
+        with open(self.target, 'rb') as fileh:
+            return fileh.read()
+
+    def test_fetch_url(self):
+        assert fetch_url(self.url, self.target,
+                         progress=self.progress) == self.target
+        assert self.read_target() == self.data
+        assert self.server.requests == [None]
+        assert not os.path.exists(self.target + '.part')
+        assert os.listdir(self.temp_dir.name) == ['archive.tar.gz']
+
+    def test_fetch_url_resumes_partial_download(self):
+        with open(self.target + '.part', 'wb') as fileh:
+            fileh.write(self.data[:1000])
+        fetch_url(self.url, self.target, progress=self.progress)
+        assert self.read_target() == self.data
+        assert self.server.requests == ['bytes=1000-']
+
+    def test_fetch_url_server_without_range_support(self):
+        self.server.support_ranges = False
+        with open(self.target + '.part', 'wb') as fileh:
+            fileh.write(b'stale data')
+        fetch_url(self.url, self.target, progress=self.progress)
+        assert self.read_target() == self.data
+
+    def test_fetch_url_retries_resume(self):
+        """
+        Interrupted transfers are retried, continuing where they stopped.
+        """
+        self.server.failures = 2
+        with mock.patch('pythonforandroid.download.time.sleep') as m_sleep, \
+                mock.patch('pythonforandroid.download.warning'):
+            fetch_url(self.url, self.target, progress=self.progress)
+        assert self.read_target() == self.data
+        assert len(self.server.requests) == 3
+        assert self.server.requests[0] is None
+        assert self.server.requests[1] == 'bytes={}-'.format(len(self.data) // 2)
+        assert m_sleep.call_args_list == [mock.call(1), mock.call(2)]
+
+    def test_fetch_url_oserror(self):
+        """
+        Checks the download is being retried on `OSError`.
+        After a number of retries the exception is re-raised.
+        """
+        with mock.patch('pythonforandroid.download.urlopen') as m_urlopen, \
+                mock.patch('pythonforandroid.download.time.sleep') as m_sleep, \
+                mock.patch('pythonforandroid.download.warning'), \
+                pytest.raises(OSError):
+            m_urlopen.side_effect = OSError
+            fetch_url(self.url, self.target, progress=self.progress)
+        retry = 5
+        assert m_urlopen.call_count == retry
+        expected_call_args_list = [mock.call(2**i) for i in range(retry - 1)]
+        assert m_sleep.call_args_list == expected_call_args_list
+
+
+class TestDownloadProgress(unittest.TestCase):
+
+    def test_format_size(self):
+        assert format_size(10) == '10.0 B'
+        assert format_size(2048) == '2.0 KB'
+        assert format_size(3 * 1024 * 1024) == '3.0 MB'
+        assert format_size(5 * 1024 ** 3) == '5.0 GB'
+
+    def test_status(self):
+        progress = DownloadProgress(stream=io.StringIO())
+        progress.update('url1', 1024, 4096)
+        assert progress.status == '- Download 1 file: 1.0 KB of 4.0 KB (25.00%)'
+        progress.update('url2', 1024, 4096)
+        assert progress.status == '- Download 2 files: 2.0 KB of 8.0 KB (25.00%)'
+        # unknown sizes can't give a percentage
+        progress.update('url3', 1024, None)
+        assert progress.status == '- Download 3 files: 3.0 KB'
+        progress.finish('url3')
+        progress.finish('url2')
+        assert progress.status == '- Download 1 file: 1.0 KB of 4.0 KB (25.00%)'
+
+
+class TestDownloadRecipes(unittest.TestCase):
+
+    def test_download_recipes(self):
+        barrier = threading.Barrier(3, timeout=5)
+        recipes = [mock.Mock() for _ in range(3)]
+        for recipe in recipes:
+            # only passes if the three downloads run at the same time
+            recipe.download_if_necessary.side_effect = barrier.wait
+        download_recipes(recipes, 3)
+        for recipe in recipes:
+            assert recipe.download_if_necessary.call_args_list == [mock.call()]
+
+    def test_download_recipes_error(self):
+        recipes = [mock.Mock(), mock.Mock()]
+        recipes[0].download_if_necessary.side_effect = ValueError('bad digest')
+        with pytest.raises(ValueError):
+            download_recipes(recipes, 2)
+        # the other downloads are not interrupted
+        assert recipes[1].download_if_necessary.call_args_list == [mock.call()]
+
+
+class TestFileDigests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, 'archive.tar.gz')
+        self.data = os.urandom(3 * 1024 * 1024 + 7)
+        with open(self.filename, 'wb') as fileh:
+            fileh.write(self.data)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_file_digests(self):
+        assert file_digests(self.filename, ['md5', 'sha256']) == {
+            'md5': hashlib.md5(self.data).hexdigest(),
+            'sha256': hashlib.sha256(self.data).hexdigest(),
+        }
+
+    def test_file_digests_single_pass(self):
+        m_open = mock.mock_open(read_data=b'data')
+        with mock.patch('pythonforandroid.download.open', m_open):
+            file_digests(self.filename, ['md5', 'sha256', 'sha512'])
+        assert m_open.call_args_list == [mock.call(self.filename, 'rb')]
+
+    def test_cached_file_digests(self):
+        expected = {'sha256': hashlib.sha256(self.data).hexdigest()}
+        assert cached_file_digests(self.filename, ['sha256']) == expected
+        assert os.path.exists(get_digests_record_filename(self.filename))
+        with mock.patch('pythonforandroid.download.file_digests') as m_digests:
+            assert cached_file_digests(self.filename, ['sha256']) == expected
+        assert m_digests.call_args_list == []
+
+    def test_cached_file_digests_new_algorithm(self):
+        cached_file_digests(self.filename, ['sha256'])
+        with mock.patch('pythonforandroid.download.file_digests',
+                        wraps=file_digests) as m_digests:
+            digests = cached_file_digests(self.filename, ['sha256', 'md5'])
+        # only the missing digest is computed
+        assert m_digests.call_args_list == [mock.call(self.filename, ['md5'])]
+        assert digests['md5'] == hashlib.md5(self.data).hexdigest()
+
+    def test_cached_file_digests_file_changed(self):
+        cached_file_digests(self.filename, ['md5'])
+        with open(self.filename, 'ab') as fileh:
+            fileh.write(b'more')
+        assert cached_file_digests(self.filename, ['md5']) == {
+            'md5': hashlib.md5(self.data + b'more').hexdigest()}
+
+
+class TestDownloadStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.temp_dir.name, 'store')
+        self.filename = os.path.join(self.temp_dir.name, 'archive.tar.gz')
+        self.data = b'archive content'
+        with open(self.filename, 'wb') as fileh:
+            fileh.write(self.data)
+        self.digests = {
+            'md5': hashlib.md5(self.data).hexdigest(),
+            'sha512': hashlib.sha512(self.data).hexdigest(),
+        }
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_add_to_store(self):
+        add_to_store(self.filename, self.digests, store=self.store)
+        for alg, digest in self.digests.items():
+            store_filename = get_store_filename(self.store, alg, digest)
+            assert os.path.samefile(store_filename, self.filename)
+
+    def test_fetch_from_store(self):
+        target = os.path.join(self.temp_dir.name, 'copy.tar.gz')
+        assert not fetch_from_store(target, self.digests, store=self.store)
+        assert not os.path.exists(target)
+        add_to_store(self.filename, self.digests, store=self.store)
+        # any of the digests is enough to find the file
+        assert fetch_from_store(
+            target, {'md5': self.digests['md5']}, store=self.store)
+        with open(target, 'rb') as fileh:
+            assert fileh.read() == self.data
+
+    def test_store_disabled(self):
+        with mock.patch.dict(os.environ, clear=True):
+            add_to_store(self.filename, self.digests)
+            assert not fetch_from_store(
+                os.path.join(self.temp_dir.name, 'copy'), self.digests)
+        assert os.listdir(self.temp_dir.name) == ['archive.tar.gz']
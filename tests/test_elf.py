@@ -0,0 +1,121 @@
+import os
+import struct
+import sys
+import unittest
+from unittest import mock
+
+from backports import tempfile
+
+from pythonforandroid import elf
+from pythonforandroid.elf import is_elf_file, read_elf_file
+
+
+def make_elf_file(bits, little_endian, needed, soname=None, symtab=False):
+    '''Returns the contents of a minimal shared library, with one segment
+    loaded at 0x1000 with the whole file.'''
+    byte_order = '<' if little_endian else '>'
+    elf_class = elf.ELFCLASS32 if bits == 32 else elf.ELFCLASS64
+    header_size = 16 + struct.calcsize(
+        byte_order + elf.HEADER_FORMATS[elf_class])
+    phentsize = struct.calcsize(
+        byte_order + elf.PROGRAM_HEADER_FORMATS[elf_class])
+    shentsize = struct.calcsize(
+        byte_order + elf.SECTION_HEADER_FORMATS[elf_class])
+    dynentsize = struct.calcsize(byte_order + elf.DYNAMIC_FORMATS[elf_class])
+
+    strtab = b'\0'
+    offsets = {}
+    for name in needed + ([soname] if soname else []):
+        offsets[name] = len(strtab)
+        strtab += name.encode('utf-8') + b'\0'
+    strtab_offset = header_size + 2 * phentsize
+    dynamic = [(elf.DT_NEEDED, offsets[name]) for name in needed]
+    if soname:
+        dynamic.append((elf.DT_SONAME, offsets[soname]))
+    dynamic += [(elf.DT_STRTAB, 0x1000 + strtab_offset), (elf.DT_NULL, 0)]
+    dynamic_offset = strtab_offset + len(strtab)
+    shoff = dynamic_offset + len(dynamic) * dynentsize
+    sections = [0, elf.SHT_SYMTAB if symtab else 3]
+    size = shoff + len(sections) * shentsize
+
+    def pack(fmt, *values):
+        return struct.pack(byte_order + fmt, *values)
+
+    def program_header(p_type, offset, filesz):
+        if bits == 32:
+            return pack(elf.PROGRAM_HEADER_FORMATS[elf_class], p_type,
+                        offset, 0x1000 + offset, 0, filesz, filesz, 0, 0)
+        return pack(elf.PROGRAM_HEADER_FORMATS[elf_class], p_type, 0,
+                    offset, 0x1000 + offset, 0, filesz, filesz, 0)
+
+    data = elf.ELF_MAGIC + bytes([
+        elf_class,
+        elf.ELFDATA2LSB if little_endian else elf.ELFDATA2MSB,
+        1]) + b'\0' * 9
+    data += pack(elf.HEADER_FORMATS[elf_class], 3, 40, 1, 0, header_size,
+                 shoff, 0, header_size, phentsize, 2, shentsize,
+                 len(sections), 0)
+    data += program_header(elf.PT_LOAD, 0, size)
+    data += program_header(
+        elf.PT_DYNAMIC, dynamic_offset, len(dynamic) * dynentsize)
+    data += strtab
+    for tag, value in dynamic:
+        data += pack(elf.DYNAMIC_FORMATS[elf_class], tag, value)
+    for section_type in sections:
+        data += pack(elf.SECTION_HEADER_FORMATS[elf_class],
+                     0, section_type, *[0] * 8)
+    assert len(data) == size
+    return data
+
+
+class TestElf(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, 'libfoo.so')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, data):
+        with open(self.filename, 'wb') as fileh:
+            fileh.write(data)
+
+    def test_read_elf_file(self):
+        for bits in (32, 64):
+            for little_endian in (True, False):
+                self.write(make_elf_file(
+                    bits, little_endian, ['libc.so', 'libpython3.8.so'],
+                    soname='libfoo.so', symtab=little_endian))
+                elf._elf_files.clear()
+                elf_file = read_elf_file(self.filename)
+                assert elf_file.bits == bits
+                assert elf_file.little_endian == little_endian
+                assert elf_file.machine == 40
+                assert elf_file.needed == ['libc.so', 'libpython3.8.so']
+                assert elf_file.soname == 'libfoo.so'
+                assert elf_file.has_symtab == little_endian
+
+    def test_read_elf_file_cached(self):
+        self.write(make_elf_file(64, True, ['libc.so']))
+        assert read_elf_file(self.filename).needed == ['libc.so']
+        with mock.patch('pythonforandroid.elf._read_elf_file') as m_read:
+            assert read_elf_file(self.filename).needed == ['libc.so']
+            m_read.assert_not_called()
+        # the file is read again once it changes
+        self.write(make_elf_file(64, True, ['libc.so', 'libm.so']))
+        assert read_elf_file(self.filename).needed == ['libc.so', 'libm.so']
+
+    def test_not_elf_file(self):
+        self.write(b'not an ELF file')
+        with self.assertRaises(ValueError):
+            read_elf_file(self.filename)
+        assert not is_elf_file(self.filename)
+        assert not is_elf_file(os.path.join(self.temp_dir.name, 'nope.so'))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'needs Linux')
+    def test_read_python_extension(self):
+        import _ctypes
+        elf_file = read_elf_file(_ctypes.__file__)
+        assert elf_file.bits == struct.calcsize('P') * 8
+        assert elf_file.little_endian == (sys.byteorder == 'little')
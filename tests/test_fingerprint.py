@@ -0,0 +1,164 @@
+import os
+import unittest
+from unittest import mock
+
+from backports import tempfile
+
+from pythonforandroid.build import Context
+from pythonforandroid.fingerprint import (
+    discard_outdated_build, discard_outdated_sources, get_build_fingerprint,
+    get_source_fingerprint, is_build_outdated, read_fingerprints,
+    write_fingerprints,
+)
+from pythonforandroid.recipe import Recipe
+
+
+class DummyRecipe(Recipe):
+    version = '1.0'
+    url = 'https://example.com/dummy-{version}.tar.gz'
+    depends = ['libdep', ('python3', 'python2')]
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.ctx = Context()
+        self.ctx.setup_dirs(self.temp_dir.name)
+        self.ctx.ndk_api = 21
+        self.ctx.recipe_build_order = ['libdep', 'dummy']
+        self.arch = mock.Mock(arch='arm64-v8a')
+        self.recipe_dir = os.path.join(self.temp_dir.name, 'recipe')
+        os.makedirs(self.recipe_dir)
+        self.write_recipe_file('__init__.py', 'recipe = DummyRecipe()')
+        self.recipe = self.get_recipe('dummy')
+        self.env = {'CFLAGS': '-O2'}
+        self.recipe.get_recipe_env = mock.Mock(side_effect=lambda arch: dict(
+            self.env, PATH='/bin', HOME=os.environ.get('HOME')))
+        self.dependency = self.get_recipe('libdep')
+        get_recipe = mock.patch.object(
+            Recipe, 'get_recipe', side_effect=lambda name, ctx: {
+                'libdep': self.dependency}[name])
+        get_recipe.start()
+        self.addCleanup(get_recipe.stop)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def get_recipe(self, name):
+        recipe_class = type(str(name), (DummyRecipe, ), {
+            '__module__': 'pythonforandroid.recipes.{}'.format(name)})
+        recipe = recipe_class()
+        recipe.ctx = self.ctx
+        recipe.get_recipe_dir = mock.Mock(return_value=self.recipe_dir)
+        return recipe
+
+    def write_recipe_file(self, name, content):
+        with open(os.path.join(self.recipe_dir, name), 'w') as fileh:
+            fileh.write(content)
+
+    def get_fingerprints(self):
+        source = get_source_fingerprint(self.recipe, self.arch)
+        return source, get_build_fingerprint(self.recipe, self.arch, source)
+
+    def test_source_fingerprint(self):
+        source, _ = self.get_fingerprints()
+        assert get_source_fingerprint(self.recipe, self.arch) == source
+        # a new patch changes the sources
+        self.write_recipe_file('fix.patch', '--- a/setup.py')
+        patched = get_source_fingerprint(self.recipe, self.arch)
+        assert patched != source
+        self.recipe._version = '2.0'
+        assert get_source_fingerprint(self.recipe, self.arch) not in (
+            source, patched)
+
+    def test_source_fingerprint_download(self):
+        source = get_source_fingerprint(self.recipe, self.arch)
+        package_dir = os.path.join(self.ctx.packages_path, 'dummy')
+        os.makedirs(package_dir)
+        with open(os.path.join(package_dir, 'dummy-1.0.tar.gz'), 'w') as fileh:
+            fileh.write('sources')
+        assert get_source_fingerprint(self.recipe, self.arch) != source
+
+    def test_build_fingerprint_env(self):
+        _, build = self.get_fingerprints()
+        # PATH and our own environment don't matter...
+        with mock.patch.dict(os.environ, {'HOME': '/home/other'}):
+            assert self.get_fingerprints()[1] == build
+        # ...but the flags do
+        self.env['CFLAGS'] = '-O3'
+        assert self.get_fingerprints()[1] != build
+
+    def test_build_fingerprint_dependencies(self):
+        _, build = self.get_fingerprints()
+        write_fingerprints(self.dependency, self.arch, 'source', 'build1')
+        with_dependency = self.get_fingerprints()[1]
+        assert with_dependency != build
+        write_fingerprints(self.dependency, self.arch, 'source', 'build2')
+        assert self.get_fingerprints()[1] not in (build, with_dependency)
+
+    def test_is_build_outdated(self):
+        source, build = self.get_fingerprints()
+        assert is_build_outdated(self.recipe, self.arch, build)
+        write_fingerprints(self.recipe, self.arch, source, build)
+        assert read_fingerprints(self.recipe, self.arch) == {
+            'source': source, 'build': build}
+        assert not is_build_outdated(self.recipe, self.arch, build)
+
+    def test_discard_outdated_sources(self):
+        build_dir = self.recipe.get_build_dir(self.arch.arch)
+        os.makedirs(build_dir)
+        source, build = self.get_fingerprints()
+        write_fingerprints(self.recipe, self.arch, source, build)
+        discard_outdated_sources(self.recipe, self.arch)
+        assert os.path.exists(build_dir)
+
+        self.recipe._version = '2.0'
+        with mock.patch('pythonforandroid.fingerprint.info'):
+            discard_outdated_sources(self.recipe, self.arch)
+        assert not os.path.exists(build_dir)
+
+    def test_discard_outdated_sources_outside_build_dir(self):
+        """
+        Sources not unpacked by p4a (e.g. in the bootstrap) are never removed.
+        """
+        build_dir = os.path.join(self.temp_dir.name, 'bootstrap', 'jni', 'dummy')
+        os.makedirs(build_dir)
+        self.recipe.get_build_dir = mock.Mock(return_value=build_dir)
+        discard_outdated_sources(self.recipe, self.arch)
+        assert os.path.exists(build_dir)
+
+    def test_discard_outdated_build(self):
+        build_dir = self.recipe.get_build_dir(self.arch.arch)
+        os.makedirs(build_dir)
+        source, build = self.get_fingerprints()
+        # never built, or built from the same inputs
+        assert not discard_outdated_build(
+            self.recipe, self.arch, source, build)
+        write_fingerprints(self.recipe, self.arch, source, build)
+        assert not discard_outdated_build(
+            self.recipe, self.arch, source, build)
+        # the sources changed, they were already unpacked again
+        assert not discard_outdated_build(
+            self.recipe, self.arch, 'other-source', 'other-build')
+        assert os.path.exists(build_dir)
+
+        self.env['CFLAGS'] = '-O3'
+        with mock.patch('pythonforandroid.fingerprint.info'):
+            assert discard_outdated_build(
+                self.recipe, self.arch, *self.get_fingerprints())
+        assert not os.path.exists(build_dir)
+
+    def test_arch_independent_recipe(self):
+        """
+        A recipe built once for all the archs (e.g. hostpython3) has the same
+        fingerprints whatever the arch.
+        """
+        self.recipe.get_build_container_dir = mock.Mock(return_value=os.path.join(
+            self.ctx.build_dir, 'other_builds', 'dummy', 'desktop'))
+        source, build = self.get_fingerprints()
+        write_fingerprints(self.recipe, self.arch, source, build)
+        other_arch = mock.Mock(arch='x86_64')
+        self.env['CFLAGS'] = '-march=x86-64'
+        assert get_build_fingerprint(self.recipe, other_arch, source) == build
+        assert not is_build_outdated(self.recipe, other_arch, build)
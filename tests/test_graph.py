@@ -1,15 +1,21 @@
+from pythonforandroid import graph
 from pythonforandroid.build import Context
 from pythonforandroid.graph import (
-    fix_deplist, get_dependency_tuple_list_for_recipe,
+    DependencyResolver, find_levels, find_order, fix_deplist,
+    get_build_graph, get_dependency_tuple_list_for_recipe,
     get_recipe_order_and_bootstrap, obvious_conflict_checker,
 )
 from pythonforandroid.bootstrap import Bootstrap
-from pythonforandroid.recipe import Recipe
 from pythonforandroid.util import BuildInterruptingException
 from itertools import product
+import json
+import os
+
+from ci.benchmark_graph import make_recipes, resolve
 
 from unittest import mock
 import pytest
+from backports import tempfile
 
 ctx = Context()
 
@@ -56,19 +62,21 @@ def get_fake_recipe(name, depends=None, conflicts=None):
     recipe.get_dir_name = lambda: name
     recipe.depends = list(depends or [])
     recipe.conflicts = list(conflicts or [])
+    recipe.opt_depends = []
+    recipe.python_depends = []
     return recipe
 
 
 def register_fake_recipes_for_test(monkeypatch, recipe_list):
-    _orig_get_recipe = Recipe.get_recipe
+    _orig_get_recipe_metadata = graph.get_recipe_metadata
 
-    def mock_get_recipe(name, ctx):
+    def mock_get_recipe_metadata(name, ctx):
         for recipe in recipe_list:
             if recipe.name == name:
                 return recipe
-        return _orig_get_recipe(name, ctx)
-    # Note: staticmethod() needed for python ONLY, don't ask me why:
-    monkeypatch.setattr(Recipe, 'get_recipe', staticmethod(mock_get_recipe))
+        return _orig_get_recipe_metadata(name, ctx)
+    monkeypatch.setattr(
+        graph, 'get_recipe_metadata', mock_get_recipe_metadata)
 
 
 @pytest.mark.parametrize('names,bootstrap', valid_combinations)
@@ -231,6 +239,178 @@ def test_bootstrap_dependency_addition2():
     assert 'hostpython3' in build_order
 
 
+def test_get_build_graph():
+    build_order, python_modules, bs = get_recipe_order_and_bootstrap(
+        ctx, ['kivy'], None)
+    graph = get_build_graph(ctx, build_order)
+    assert set(graph) == set(build_order)
+    assert graph['hostpython3'] == set()
+    assert 'hostpython3' in graph['python3']
+    assert {'python3', 'sdl2', 'pyjnius'} <= graph['kivy']
+    # only earlier recipes may be dependencies, so the graph is a DAG
+    for index, name in enumerate(build_order):
+        assert graph[name] <= set(build_order[:index])
+
+
+def test_get_build_graph_alternatives(monkeypatch):
+    with monkeypatch.context() as m:
+        recipe1 = get_fake_recipe("recipe1", depends=[("lib1", "lib2")])
+        recipe1.opt_depends = ["lib3"]
+        lib1 = get_fake_recipe("lib1")
+        lib1.opt_depends = []
+        lib3 = get_fake_recipe("lib3")
+        lib3.opt_depends = []
+        register_fake_recipes_for_test(m, [recipe1, lib1, lib3])
+        graph = get_build_graph(ctx, ["lib1", "lib3", "recipe1"])
+    assert graph == {"lib1": set(), "lib3": set(), "recipe1": {"lib1", "lib3"}}
+
+
+def test_resolver_prefers_python3_and_sdl2(monkeypatch):
+    with monkeypatch.context() as m:
+        register_fake_recipes_for_test(m, [
+            get_fake_recipe("recipe1", depends=[("genericndkbuild", "sdl2")]),
+            get_fake_recipe("genericndkbuild"),
+            get_fake_recipe("sdl2"),
+        ])
+        assert DependencyResolver(
+            ctx, fix_deplist(["recipe1"])).resolve() == ["sdl2", "recipe1"]
+        assert DependencyResolver(
+            ctx, fix_deplist(["recipe1"]), blacklist={"sdl2"}
+        ).resolve() == ["genericndkbuild", "recipe1"]
+
+
+def test_resolver_backtracks(monkeypatch):
+    # lib1 only conflicts with recipe2 through its own dependency, and
+    # recipe3 depends on recipe1 through a cycle if it picks lib2
+    with monkeypatch.context() as m:
+        register_fake_recipes_for_test(m, [
+            get_fake_recipe("recipe1", depends=[
+                ("lib1", "lib2", "lib3"), "recipe3"]),
+            get_fake_recipe("recipe2", conflicts=["libbase"]),
+            get_fake_recipe("recipe3", depends=[("lib2", "lib3")]),
+            get_fake_recipe("lib1", depends=["libbase"]),
+            get_fake_recipe("lib2", depends=["recipe1"]),
+            get_fake_recipe("lib3"),
+            get_fake_recipe("libbase"),
+        ])
+        resolver = DependencyResolver(
+            ctx, fix_deplist(["recipe2", "recipe1"]))
+        assert resolver.resolve() == [
+            "lib3", "recipe2", "recipe3", "recipe1"]
+    # lib1 was learned not to be buildable along with recipe2
+    assert frozenset({"lib1", "recipe2"}) in resolver.nogoods["lib1"]
+
+
+def test_resolver_explains_failure(monkeypatch):
+    with monkeypatch.context() as m:
+        register_fake_recipes_for_test(m, [
+            get_fake_recipe("recipe1", depends=[("lib1", "lib2")]),
+            get_fake_recipe("recipe2", conflicts=["libbase"]),
+            get_fake_recipe("lib1", depends=["libbase"]),
+            get_fake_recipe("lib2", depends=["recipe1"]),
+            get_fake_recipe("libbase"),
+        ])
+        with pytest.raises(BuildInterruptingException) as e_info:
+            DependencyResolver(
+                ctx, fix_deplist(["recipe2", "recipe1"])).resolve()
+    message = e_info.value.message
+    assert "conflicting dependencies" in message
+    assert "recipe1 -> lib1 -> libbase conflicts with recipe2" in message
+    assert "dependency cycle: lib2 -> recipe1 -> lib2" in message
+
+
+@pytest.mark.parametrize('size', [100, 500])
+def test_resolver_synthetic_graphs(size):
+    # see ci/benchmark_graph.py, this would take the previous resolver
+    # ages, as most requirements have alternatives
+    recipes, requirements = make_recipes(size)
+    order = resolve(recipes, requirements)
+    for index, name in enumerate(order):
+        assert "recipe1" not in recipes[name].depends
+        for dep_tuple in fix_deplist(recipes[name].depends):
+            assert set(dep_tuple) & set(order[:index])
+    for requirement in fix_deplist(requirements):
+        assert set(requirement) & set(order)
+
+
+def test_find_order():
+    graph = {
+        "python3": {"hostpython3", "libffi"},
+        "hostpython3": set(),
+        "libffi": set(),
+        "kivy": {"python3", "sdl2"},
+        "sdl2": set(),
+    }
+    assert list(find_order(graph)) == [
+        "hostpython3", "libffi", "sdl2", "python3", "kivy"]
+    assert find_levels(graph) == [
+        ["hostpython3", "libffi", "sdl2"], ["python3"], ["kivy"]]
+    # the graph is left untouched
+    assert graph["kivy"] == {"python3", "sdl2"}
+
+
+def test_find_order_cycle():
+    graph = {
+        "kivy": {"python3"},
+        "python3": {"libffi"},
+        "libffi": {"openssl"},
+        "openssl": {"libffi"},
+        "sdl2": set(),
+    }
+    with pytest.raises(ValueError) as e_info:
+        list(find_order(graph))
+    assert str(e_info.value) == (
+        "Dependency cycle detected: libffi -> openssl -> libffi")
+    with pytest.raises(ValueError) as e_info:
+        find_levels({"kivy": {"python3"}})
+    assert "not in the dependency graph" in str(e_info.value)
+
+
+def test_get_recipe_order_and_bootstrap_recorded(monkeypatch):
+    resolve_calls = []
+    original_resolve = DependencyResolver.resolve
+
+    def counting_resolve(resolver):
+        resolve_calls.append(resolver.names)
+        return original_resolve(resolver)
+    monkeypatch.setattr(DependencyResolver, 'resolve', counting_resolve)
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        stored_ctx = Context()
+        stored_ctx.storage_dir = storage_dir
+        result = get_recipe_order_and_bootstrap(stored_ctx, ['kivy'], None)
+        assert result[2].name == 'sdl2'
+        calls = len(resolve_calls)
+        assert get_recipe_order_and_bootstrap(
+            stored_ctx, ['kivy'], None) == result
+        assert len(resolve_calls) == calls
+        # the requirements are part of the key...
+        get_recipe_order_and_bootstrap(
+            stored_ctx, ['kivy'], None, blacklist=['libffi'])
+        assert len(resolve_calls) > calls
+        calls = len(resolve_calls)
+        # ...and so is the metadata of the recipes they may depend on
+        with monkeypatch.context() as m:
+            register_fake_recipes_for_test(m, [
+                get_fake_recipe("pyjnius", depends=["six", "python3"]),
+            ])
+            get_recipe_order_and_bootstrap(stored_ctx, ['kivy'], None)
+        assert len(resolve_calls) > calls
+
+
+def test_get_recipe_order_and_bootstrap_recorded_nested():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        stored_ctx = Context()
+        stored_ctx.storage_dir = storage_dir
+        get_recipe_order_and_bootstrap(stored_ctx, ['kivy'], None)
+        # the resolution with the bootstrap it chose is recorded too
+        with open(os.path.join(storage_dir, graph.RESOLUTIONS_FILENAME)) as fileh:
+            names = [json.loads(name[len('recipe order for '):])
+                     for name in json.load(fileh)]
+        assert sorted(bs_name or '' for _, _, bs_name in names) == [
+            '', 'sdl2']
+
+
 if __name__ == "__main__":
     get_recipe_order_and_bootstrap(ctx, ['python3'],
                                    Bootstrap.get_bootstrap('sdl2', ctx))
@@ -0,0 +1,119 @@
+import os
+import unittest
+from unittest import mock
+
+from backports import tempfile
+
+from pythonforandroid.probes import (
+    ProbeCache, get_dir_state, get_path_state,
+)
+
+
+class TestProbeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.sdk_dir = os.path.join(self.temp_dir.name, 'sdk')
+        os.makedirs(os.path.join(self.sdk_dir, 'platforms', 'android-27'))
+        self.filename = os.path.join(self.temp_dir.name, 'probes.json')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def get_apis(self, probe):
+        probes = ProbeCache(self.filename)
+        apis = probes.get(
+            'apis', get_dir_state(self.sdk_dir, ['platforms']), probe)
+        probes.save()
+        return apis
+
+    def test_get(self):
+        probe = mock.Mock(return_value=[27])
+        assert self.get_apis(probe) == [27]
+        # the result is recorded for the next invocations...
+        assert self.get_apis(probe) == [27]
+        assert probe.call_count == 1
+        # ...until the SDK changes
+        os.makedirs(os.path.join(self.sdk_dir, 'platforms', 'android-28'))
+        stat = os.stat(os.path.join(self.sdk_dir, 'platforms'))
+        os.utime(os.path.join(self.sdk_dir, 'platforms'),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        probe.return_value = [27, 28]
+        assert self.get_apis(probe) == [27, 28]
+        assert probe.call_count == 2
+
+    def test_get_without_key(self):
+        # nothing to key the probe on, e.g. the SDK doesn't exist
+        self.sdk_dir = os.path.join(self.temp_dir.name, 'nonexistent')
+        probe = mock.Mock(return_value=[])
+        self.get_apis(probe)
+        self.get_apis(probe)
+        assert probe.call_count == 2
+        assert not os.path.exists(self.filename)
+
+    def test_get_keep(self):
+        probes = ProbeCache(self.filename)
+        probe = mock.Mock(return_value=None)
+        # missing tools are probed for again
+        for _ in range(2):
+            assert probes.get('ccache', ['/usr/bin'], probe, keep=bool) is None
+        assert probe.call_count == 2
+        probe.return_value = '/usr/bin/ccache'
+        for _ in range(2):
+            assert probes.get(
+                'ccache', ['/usr/bin'], probe, keep=bool) == '/usr/bin/ccache'
+        assert probe.call_count == 3
+
+    def test_save_merges(self):
+        outer = ProbeCache(self.filename)
+        outer.get('outer', ['key'], lambda: 'outer')
+        # e.g. a nested resolution, recorded before the outer one
+        inner = ProbeCache(self.filename)
+        inner.get('inner', ['key'], lambda: 'inner')
+        inner.save()
+        outer.save()
+        probes = ProbeCache(self.filename).probes
+        assert sorted(probes) == ['inner', 'outer']
+
+    def test_corrupted_file(self):
+        with open(self.filename, 'w') as fileh:
+            fileh.write('{')
+        assert self.get_apis(mock.Mock(return_value=[27])) == [27]
+        assert ProbeCache(self.filename).probes['apis']['value'] == [27]
+
+    def test_get_dir_state(self):
+        assert get_dir_state(os.path.join(self.temp_dir.name, 'nope')) is None
+        state = get_dir_state(self.sdk_dir, ['platforms', 'tools'])
+        assert state[0] == os.path.realpath(self.sdk_dir)
+        assert state[3] is None
+
+    def test_get_valid(self):
+        probes = ProbeCache(self.filename)
+        ccache = os.path.join(self.temp_dir.name, 'ccache')
+        with open(ccache, 'w'):
+            pass
+        probe = mock.Mock(return_value=ccache)
+        for _ in range(2):
+            assert probes.get('ccache', ['/usr/bin'], probe, keep=bool,
+                              valid=os.path.exists) == ccache
+        assert probe.call_count == 1
+        # the recorded tool was uninstalled
+        os.remove(ccache)
+        probe.return_value = None
+        assert probes.get('ccache', ['/usr/bin'], probe, keep=bool,
+                          valid=os.path.exists) is None
+        assert probe.call_count == 2
+
+    def test_get_path_state(self):
+        bin_dir = os.path.join(self.temp_dir.name, 'bin')
+        os.makedirs(bin_dir)
+        nope = os.path.join(self.temp_dir.name, 'nope')
+        state = get_path_state(':'.join([bin_dir, nope, bin_dir]))
+        assert [entry for entry, mtime in state] == [bin_dir, nope]
+        assert state[1][1] is None
+        # installing a tool changes the state
+        stat = os.stat(bin_dir)
+        with open(os.path.join(bin_dir, 'ccache'), 'w'):
+            pass
+        os.utime(bin_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert get_path_state(':'.join([bin_dir, nope])) != state
@@ -11,11 +11,19 @@ import sys
 import subprocess
 import tempfile
 import textwrap
+import time
+import zipfile
 from unittest import mock
 
 from pythonforandroid.pythonpackage import (
+    MetadataCache,
     _extract_info_from_package,
+    _get_info_from_package,
     get_dep_names_of_package,
+    get_package_dependencies,
+    enable_metadata_cache,
+    find_local_wheel,
+    get_android_dependencies,
     get_package_name,
     _get_system_python_executable,
     is_filesystem_path,
@@ -81,6 +89,201 @@ def test_get_package_name():
         shutil.rmtree(temp_d)
 
 
+def write_fake_wheel(folder, name, version):
+    # Helper function to write out a wheel with fake metadata.
+    wheel = os.path.join(
+        folder, "{}-{}-py3-none-any.whl".format(name, version)
+    )
+    with zipfile.ZipFile(wheel, "w") as f:
+        f.writestr(
+            "{}-{}.dist-info/METADATA".format(name, version),
+            textwrap.dedent("""\
+                Metadata-Version: 2.1
+                Name: {}
+                Version: {}
+                Requires-Dist: testpkg (>=1.0)
+                Requires-Dist: pywin32 ; sys_platform == "win32"
+                Requires-Dist: pyjnius ; sys_platform == "linux"
+                Requires-Dist: pysocks ; extra == "socks"
+
+                Long description.
+                """.format(name, version))
+        )
+    return wheel
+
+
+def test_find_local_wheel():
+    temp_d = tempfile.mkdtemp(prefix="p4a-pythonpackage-test-tmp-")
+    try:
+        old_wheel = write_fake_wheel(temp_d, "Test_Package", "0.1")
+        new_wheel = write_fake_wheel(temp_d, "Test_Package", "0.2")
+        assert find_local_wheel(new_wheel) == new_wheel
+        assert find_local_wheel("file://" + new_wheel) == new_wheel
+        assert find_local_wheel("test-package") is None
+        with mock.patch.dict(os.environ, {
+                "PIP_FIND_LINKS": "https://example.com/ " + temp_d}):
+            assert find_local_wheel("test-package") == new_wheel
+            assert find_local_wheel("test-package<0.2") == old_wheel
+            assert find_local_wheel("test-package>0.2") is None
+            assert find_local_wheel(
+                "test-package; sys_platform == 'win32'") is None
+            assert find_local_wheel("otherpackage") is None
+    finally:
+        shutil.rmtree(temp_d)
+
+
+def test_extract_info_from_local_wheel():
+    temp_d = tempfile.mkdtemp(prefix="p4a-pythonpackage-test-tmp-")
+    try:
+        write_fake_wheel(temp_d, "testpackage", "0.1")
+        with mock.patch("pythonforandroid.pythonpackage."
+                        "extract_metainfo_files_from_package") as m_extract, \
+                mock.patch.dict(os.environ, {"PIP_FIND_LINKS": temp_d}):
+            assert _extract_info_from_package(
+                "testpackage", extract_type="name"
+            ) == "testpackage"
+            assert set(_extract_info_from_package(
+                "testpackage", extract_type="dependencies"
+            )) == {"testpkg (>=1.0)", "pyjnius"}
+            assert set(_extract_info_from_package(
+                "testpackage[socks]", extract_type="dependencies"
+            )) == {"testpkg (>=1.0)", "pyjnius", "pysocks"}
+            m_extract.assert_not_called()
+    finally:
+        shutil.rmtree(temp_d)
+
+
+def test_get_android_dependencies():
+    assert get_android_dependencies([
+        "colorama>=0.3.3", "sh>=1.10; sys_platform!='nt'",
+        "enum34; python_version<'3.4'", "pywin32; os_name == 'nt'",
+    ]) == ["colorama>=0.3.3", "sh>=1.10"]
+
+
+def test_metadata_cache():
+    temp_d = tempfile.mkdtemp(prefix="p4a-pythonpackage-test-tmp-")
+    try:
+        filename = os.path.join(temp_d, "cache.json")
+        cache = MetadataCache(filename, ttl=60, max_entries=2)
+        obtain = mock.Mock(return_value=["testpkg"])
+        assert cache.get("a", obtain) == ["testpkg"]
+        assert cache.get("a", obtain) == ["testpkg"]
+        assert obtain.call_count == 1
+
+        # The entries are recorded for the next runs:
+        cache = MetadataCache(filename, ttl=60, max_entries=2)
+        assert cache.get("a", obtain) == ["testpkg"]
+        assert obtain.call_count == 1
+
+        # Only the most recently used entries are kept:
+        with mock.patch("time.time", return_value=time.time() + 1):
+            cache.get("b", obtain)
+        with mock.patch("time.time", return_value=time.time() + 2):
+            cache.get("a", obtain)
+            cache.get("c", obtain)
+        assert set(cache.entries) == {"a", "c"}
+
+        # ...until they expire:
+        with mock.patch("time.time", return_value=time.time() + 120):
+            cache.get("a", obtain)
+        assert obtain.call_count == 4
+        assert set(cache.entries) == {"a"}
+    finally:
+        shutil.rmtree(temp_d)
+
+
+def test_get_info_from_package_cached():
+    temp_d = tempfile.mkdtemp(prefix="p4a-pythonpackage-test-tmp-")
+    try:
+        with mock.patch("pythonforandroid.pythonpackage.metadata_cache"):
+            enable_metadata_cache(os.path.join(temp_d, "storage"))
+            package_d = os.path.join(temp_d, "package")
+            os.mkdir(package_d)
+            with open(os.path.join(package_d, "setup.py"), "w") as f:
+                f.write("from setuptools import setup\n")
+            with mock.patch("pythonforandroid.pythonpackage."
+                            "_extract_info_from_package",
+                            return_value="testpackage") as m_extract:
+                for _ in range(2):
+                    assert _get_info_from_package(
+                        package_d, extract_type="name") == "testpackage"
+                assert m_extract.call_count == 1
+
+                # The info is obtained again once the setup.py changes:
+                with open(os.path.join(package_d, "setup.py"), "a") as f:
+                    f.write("setup(name='testpackage')\n")
+                _get_info_from_package(package_d, extract_type="name")
+                assert m_extract.call_count == 2
+            assert os.path.exists(os.path.join(
+                temp_d, "storage", "pythonpackage-cache.json"))
+    finally:
+        shutil.rmtree(temp_d)
+
+
+def test_get_info_from_package_cached_file():
+    temp_d = tempfile.mkdtemp(prefix="p4a-pythonpackage-test-tmp-")
+    try:
+        with mock.patch("pythonforandroid.pythonpackage.metadata_cache"):
+            enable_metadata_cache(os.path.join(temp_d, "storage"))
+            wheel = os.path.join(
+                temp_d, "testpackage-1.0-py3-none-any.whl")
+            with open(wheel, "wb") as f:
+                f.write(b"version 1")
+            with mock.patch("pythonforandroid.pythonpackage."
+                            "_extract_info_from_package",
+                            return_value=["six"]) as m_extract:
+                for _ in range(2):
+                    _get_info_from_package(wheel, extract_type="dependencies")
+                assert m_extract.call_count == 1
+
+                # The info is obtained again once the wheel is rebuilt:
+                with open(wheel, "wb") as f:
+                    f.write(b"version 2")
+                _get_info_from_package(wheel, extract_type="dependencies")
+                assert m_extract.call_count == 2
+    finally:
+        shutil.rmtree(temp_d)
+
+
+def test_get_package_dependencies_recursive():
+    # A fake package index, by pip reference:
+    dependencies = {
+        "app": ["kivy>=2", "requests"],
+        "kivy>=2": ["docutils", "pygments"],
+        "requests": ["urllib3", "idna", "pywin32; sys_platform == 'win32'"],
+        "docutils": [],
+        "pygments": [],
+        "urllib3": ["idna"],
+        "idna": [],
+    }
+
+    def get_info(dep, extract_type=None, **kwargs):
+        if extract_type == "name":
+            if ";" in dep:
+                raise ValueError("no downloads")
+            return dep.partition(">")[0]
+        return dependencies[dep]
+
+    with mock.patch("pythonforandroid.pythonpackage."
+                    "_get_info_from_package",
+                    side_effect=get_info) as m_get_info, \
+            mock.patch.dict(os.environ, {"P4A_PYTHONPACKAGE_JOBS": "3"}):
+        assert get_package_dependencies("app", recursive=True) == {
+            "kivy>=2", "requests", "docutils", "pygments", "urllib3", "idna",
+        }
+        # Each package is resolved and examined only once:
+        calls = [
+            (call[0][0], call[1]["extract_type"])
+            for call in m_get_info.call_args_list
+        ]
+        assert len(calls) == len(set(calls))
+        assert len([
+            call for call in calls if call[1] == "dependencies"
+        ]) == len(dependencies)
+
+        assert get_package_dependencies("app") == {"kivy>=2", "requests"}
+
+
 def test_get_dep_names_of_package():
     # TEST 1 from external ref:
     # Check that colorama is returned without the install condition when
@@ -306,6 +509,10 @@ class TestGetSystemPythonExecutable():
                 os.path.join(test_dir, "venv", "bin", "pip"),
                 "install", "-U", "toml"
             ])
+            subprocess.check_output([
+                os.path.join(test_dir, "venv", "bin", "pip"),
+                "install", "-U", "packaging"
+            ])
             sys_python_path = self.run__get_system_python_executable(
                 os.path.join(test_dir, "venv", "bin", "python")
             )
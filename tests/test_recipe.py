@@ -1,12 +1,17 @@
+import hashlib
+import io
 import os
-import pytest
+import subprocess
+import tarfile
 import types
 import unittest
 import warnings
 from unittest import mock
 from backports import tempfile
 
+from pythonforandroid.archive import extract_archive
 from pythonforandroid.build import Context
+from pythonforandroid.download import get_git_mirror_path
 from pythonforandroid.recipe import Recipe, import_recipe
 from pythonforandroid.archs import ArchAarch_64
 from pythonforandroid.bootstrap import Bootstrap
@@ -26,8 +31,8 @@ def patch_logger_debug():
     return patch_logger('debug')
 
 
-def patch_urlretrieve():
-    return mock.patch('pythonforandroid.recipe.urlretrieve')
+def patch_fetch_url():
+    return mock.patch('pythonforandroid.recipe.fetch_url')
 
 
 class DummyRecipe(Recipe):
@@ -139,48 +144,236 @@ class TestRecipe(unittest.TestCase):
                 tempfile.TemporaryDirectory()) as temp_dir:
             recipe.ctx.setup_dirs(temp_dir)
             recipe.download()
-        assert m_download_file.call_args_list == [mock.call(url, filename)]
+            package_dir = os.path.join(temp_dir, 'packages', 'test_recipe')
+        assert m_download_file.call_args_list == [
+            mock.call(url, filename, cwd=package_dir)]
         assert m_debug.call_args_list == [
             mock.call(
                 'Downloading test_recipe from '
                 'https://www.python.org/ftp/python/3.7.4/Python-3.7.4.tgz')]
         assert m_touch.call_count == 1
 
-    def test_download_file_scheme_https(self):
+    def test_get_download_info(self):
+        recipe, filename = self.get_dummy_python_recipe_for_download_tests()
+        digest = 'a' * 64
+        recipe._url += '#sha256=' + digest
+        recipe.md5sum = 'b' * 32
+        assert recipe.get_download_info() == (
+            'https://www.python.org/ftp/python/3.7.4/Python-3.7.4.tgz',
+            filename, {'sha256': digest, 'md5': 'b' * 32})
+
+    def test_download_store(self):
         """
-        Verifies `urlretrieve()` is being called on https downloads.
+        Verified downloads are added to `$P4A_DOWNLOAD_STORE`, and taken
+        from it by the other storage dirs instead of being downloaded.
         """
         recipe, filename = self.get_dummy_python_recipe_for_download_tests()
-        url = recipe.url
+        data = b'Python source'
+        recipe.sha256sum = hashlib.sha256(data).hexdigest()
+
+        def download_file(url, target, cwd=None):
+            with open(os.path.join(cwd, target), 'wb') as fileh:
+                fileh.write(data)
+
         with (
-                patch_urlretrieve()) as m_urlretrieve, (
-                tempfile.TemporaryDirectory()) as temp_dir:
-            recipe.ctx.setup_dirs(temp_dir)
-            assert recipe.download_file(url, filename) == filename
-        assert m_urlretrieve.call_args_list == [
-            mock.call(url, filename, mock.ANY)
-        ]
+                tempfile.TemporaryDirectory()) as store, (
+                tempfile.TemporaryDirectory()) as temp_dir, (
+                mock.patch.dict(os.environ, {'P4A_DOWNLOAD_STORE': store})), (
+                mock.patch.object(Recipe, 'download_file')) as m_download_file:
+            m_download_file.side_effect = download_file
+            recipe.ctx.setup_dirs(os.path.join(temp_dir, 'first'))
+            recipe.download()
+            assert m_download_file.call_count == 1
+            assert os.listdir(os.path.join(store, 'sha256')) == [
+                recipe.sha256sum[:2]]
 
-    def test_download_file_scheme_https_oserror(self):
+            recipe.ctx.setup_dirs(os.path.join(temp_dir, 'second'))
+            recipe.download()
+            assert m_download_file.call_count == 1
+            target = os.path.join(
+                temp_dir, 'second', 'packages', 'test_recipe', filename)
+            with open(target, 'rb') as fileh:
+                assert fileh.read() == data
+
+    def test_download_file_scheme_https(self):
         """
-        Checks `urlretrieve()` is being retried on `OSError`.
-        After a number of retries the exception is re-reaised.
+        Verifies `fetch_url()` is being called on https downloads.
         """
         recipe, filename = self.get_dummy_python_recipe_for_download_tests()
         url = recipe.url
         with (
-                patch_urlretrieve()) as m_urlretrieve, (
-                mock.patch('pythonforandroid.recipe.time.sleep')) as m_sleep, (
-                pytest.raises(OSError)), (
+                patch_fetch_url()) as m_fetch_url, (
                 tempfile.TemporaryDirectory()) as temp_dir:
             recipe.ctx.setup_dirs(temp_dir)
-            m_urlretrieve.side_effect = OSError
+            m_fetch_url.side_effect = lambda url, target: target
             assert recipe.download_file(url, filename) == filename
-        retry = 5
-        expected_call_args_list = [mock.call(url, filename, mock.ANY)] * retry
-        assert m_urlretrieve.call_args_list == expected_call_args_list
-        expected_call_args_list = [mock.call(2**i) for i in range(retry - 1)]
-        assert m_sleep.call_args_list == expected_call_args_list
+        assert m_fetch_url.call_args_list == [mock.call(url, filename)]
+
+
+class TestGitDownload(unittest.TestCase):
+    """
+    Downloads of `git+` urls, from local `file://` repositories.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {
+            'GIT_AUTHOR_NAME': 'p4a', 'GIT_AUTHOR_EMAIL': 'p4a@example.com',
+            'GIT_COMMITTER_NAME': 'p4a',
+            'GIT_COMMITTER_EMAIL': 'p4a@example.com',
+            'P4A_GIT_MIRRORS': self.path('mirrors'),
+        })
+        self.env.start()
+        self.origin = self.path('origin')
+        self.git('init', '--quiet', self.origin, cwd=self.temp_dir.name)
+        self.commit('1')
+        self.git('tag', 'v1')
+        self.commit('2')
+        self.recipe = DummyRecipe()
+        self.recipe.ctx = Context()
+        self.url = 'git+file://' + self.origin
+
+    def tearDown(self):
+        self.env.stop()
+        self.temp_dir.cleanup()
+
+    def path(self, *names):
+        return os.path.join(self.temp_dir.name, *names)
+
+    def git(self, *args, cwd=None):
+        return subprocess.check_output(
+            ('git',) + args, cwd=cwd or self.origin).decode('utf-8').strip()
+
+    def commit(self, version):
+        with open(os.path.join(self.origin, 'version'), 'w') as fileh:
+            fileh.write(version)
+        self.git('add', 'version')
+        self.git('commit', '--quiet', '-m', version)
+
+    def read_version(self, target):
+        with open(os.path.join(target, 'version')) as fileh:
+            return fileh.read()
+
+    def test_download_git(self):
+        target = self.path('storage', 'repo')
+        self.recipe.download_file(self.url, target)
+        assert self.read_version(target) == '2'
+        mirrors = os.listdir(self.path('mirrors'))
+        assert [name for name in mirrors if name.endswith('.git')] == [
+            os.path.basename(get_git_mirror_path('file://' + self.origin))]
+        # the clone doesn't depend on the mirror
+        assert not os.path.exists(os.path.join(
+            target, '.git', 'objects', 'info', 'alternates'))
+        assert self.git('remote', 'get-url', 'origin', cwd=target) == 'file://' + self.origin
+
+        # updates go through the mirror
+        self.commit('3')
+        self.recipe.download_file(self.url, target)
+        assert self.read_version(target) == '3'
+
+    def test_download_git_version(self):
+        self.recipe._version = 'v1'
+        target = self.path('storage', 'repo')
+        self.recipe.download_file(self.url, target)
+        assert self.read_version(target) == '1'
+
+    def test_download_git_shallow(self):
+        self.recipe._version = 'v1'
+        target = self.path('storage', 'repo')
+        with mock.patch.dict(os.environ, {'P4A_GIT_SHALLOW': '1'}):
+            self.recipe.download_file(self.url, target)
+            assert self.read_version(target) == '1'
+            assert self.git('rev-list', '--count', 'HEAD', cwd=target) == '1'
+
+            self.recipe._version = self.git('rev-parse', 'HEAD')
+            self.recipe.download_file(self.url, target)
+            assert self.read_version(target) == '2'
+
+
+class TestUnpack(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.recipe = DummyRecipe()
+        self.recipe._url = 'https://example.com/foo-1.0.tar.gz'
+        self.recipe.ctx = Context()
+        self.recipe.ctx.setup_dirs(self.temp_dir.name)
+        self.recipe.ctx.ndk_api = 21
+        self.recipe.ctx.archs = [
+            mock.Mock(arch='armeabi-v7a'), mock.Mock(arch='arm64-v8a')]
+        package_dir = os.path.join(self.temp_dir.name, 'packages', 'test_recipe')
+        os.makedirs(package_dir)
+        with tarfile.open(os.path.join(package_dir, 'foo-1.0.tar.gz'), 'w:gz') as tar:
+            data = b'version = 1\n'
+            info = tarfile.TarInfo('foo-1.0/setup.py')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        recipe_dir = os.path.join(self.temp_dir.name, 'recipe')
+        os.makedirs(recipe_dir)
+        with open(os.path.join(recipe_dir, 'fix.patch'), 'w') as fileh:
+            fileh.write(
+                '--- a/setup.py\n+++ b/setup.py\n@@ -1 +1 @@\n'
+                '-version = 1\n+version = 2\n')
+        self.recipe.get_recipe_dir = mock.Mock(return_value=recipe_dir)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def read_setup_py(self, arch):
+        with open(os.path.join(
+                self.recipe.get_build_dir(arch), 'setup.py')) as fileh:
+            return fileh.read()
+
+    def unpack_all_archs(self):
+        with mock.patch('pythonforandroid.recipe.extract_archive',
+                        wraps=extract_archive) as m_extract, \
+                mock.patch('pythonforandroid.recipe.Recipe.apply_patch',
+                           autospec=True,
+                           side_effect=Recipe.apply_patch) as m_apply_patch:
+            for arch in self.recipe.ctx.archs:
+                os.makedirs(self.recipe.get_build_container_dir(arch.arch))
+                self.recipe.unpack(arch.arch)
+        return m_extract, m_apply_patch
+
+    def test_unpack_once(self):
+        """
+        The archive is extracted once, and copied to each arch build dir.
+        """
+        m_extract, m_apply_patch = self.unpack_all_archs()
+        assert m_extract.call_count == 1
+        assert m_apply_patch.call_count == 0
+        for arch in self.recipe.ctx.archs:
+            assert self.read_setup_py(arch.arch) == 'version = 1\n'
+            assert not self.recipe.is_patched(arch)
+
+    def test_unpack_prepatched(self):
+        """
+        Patches are applied once, to the sources shared by all the archs.
+        """
+        self.recipe.patches = ['fix.patch']
+        m_extract, m_apply_patch = self.unpack_all_archs()
+        assert m_extract.call_count == 1
+        assert m_apply_patch.call_count == 1
+        for arch in self.recipe.ctx.archs:
+            assert self.read_setup_py(arch.arch) == 'version = 2\n'
+            assert self.recipe.is_patched(arch)
+            # editing the sources of one arch doesn't affect the others
+            with open(os.path.join(self.recipe.get_build_dir(arch.arch),
+                                   'setup.py'), 'w') as fileh:
+                fileh.write(arch.arch)
+        assert self.read_setup_py('armeabi-v7a') == 'armeabi-v7a'
+
+    def test_unpack_custom_prebuild_not_prepatched(self):
+        """
+        Recipes customizing `prebuild_arch` are patched after it, per arch.
+        """
+        self.recipe.patches = ['fix.patch']
+        with mock.patch.object(DummyRecipe, 'prebuild_arch', create=True):
+            _, m_apply_patch = self.unpack_all_archs()
+        assert m_apply_patch.call_count == 0
+        for arch in self.recipe.ctx.archs:
+            assert self.read_setup_py(arch.arch) == 'version = 1\n'
+            assert not self.recipe.is_patched(arch)
 
 
 class TestLibraryRecipe(BaseClassSetupBootstrap, unittest.TestCase):
@@ -297,7 +490,7 @@ class TesSTLRecipe(BaseClassSetupBootstrap, unittest.TestCase):
         mock_glob.assert_called()
         mock_ensure_dir.assert_called()
         mock_find_executable.assert_called_once_with(
-            expected_compiler, path=os.environ['PATH']
+            expected_compiler, path=env['PATH']
         )
         self.assertIsInstance(env, dict)
 
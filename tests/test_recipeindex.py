@@ -0,0 +1,135 @@
+import os
+import unittest
+from unittest import mock
+
+from backports import tempfile
+
+from pythonforandroid.build import Context
+from pythonforandroid.recipe import Recipe
+from pythonforandroid.recipeindex import (
+    INDEX_FILENAME, RecipeIndex, get_metadata, read_metadata,
+)
+
+
+RECIPE = '''
+from pythonforandroid.recipe import PythonRecipe
+
+
+class MyRecipe(PythonRecipe):
+    version = '1.0'
+    depends = ['setuptools', ('libffi', 'openssl')]
+    conflicts = ['sdl2']
+    site_packages_name = 'my'
+
+    def prebuild_arch(self, arch):
+        self.depends = []
+
+
+recipe = MyRecipe()
+'''
+
+
+class TestRecipeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.ctx = Context()
+        self.ctx.local_recipes = os.path.join(self.temp_dir.name, 'recipes')
+        self.ctx.storage_dir = self.temp_dir.name
+        self.filename = os.path.join(self.temp_dir.name, INDEX_FILENAME)
+        self.recipe_file = self.write_recipe('myrecipe', RECIPE)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_recipe(self, name, source):
+        recipe_dir = os.path.join(self.ctx.local_recipes, name)
+        os.makedirs(recipe_dir, exist_ok=True)
+        recipe_file = os.path.join(recipe_dir, '__init__.py')
+        with open(recipe_file, 'w') as fileh:
+            fileh.write(source)
+        return recipe_file
+
+    def test_read_metadata(self):
+        metadata = read_metadata('myrecipe', self.recipe_file)
+        assert metadata['version'] == '1.0'
+        assert metadata['conflicts'] == ['sdl2']
+        assert metadata['site_packages_name'] == 'my'
+        assert metadata['opt_depends'] == []
+        # as set by PythonRecipe.__init__
+        assert sorted(metadata['depends'], key=str) == sorted(
+            ['setuptools', ('libffi', 'openssl'), 'python3'], key=str)
+
+    def test_read_metadata_matches_import(self):
+        for name in ('libffi', 'kivy', 'pyjnius', 'numpy', 'sdl2'):
+            recipe_file = os.path.join(
+                self.ctx.root_dir, 'recipes', name, '__init__.py')
+            metadata = read_metadata(name, recipe_file)
+            expected = get_metadata(Recipe.get_recipe(name, self.ctx))
+            assert sorted(metadata.pop('depends'), key=str) == sorted(
+                expected.pop('depends'), key=str)
+            assert metadata == expected
+
+    def test_read_metadata_needs_import(self):
+        for source in (
+                # __init__ may change the metadata
+                RECIPE.replace('def prebuild_arch(self, arch)',
+                               'def __init__(self)'),
+                # not a literal
+                RECIPE.replace("version = '1.0'", "version = VERSION"),
+                # the base class comes from another recipe
+                RECIPE.replace('pythonforandroid.recipe',
+                               'pythonforandroid.recipes.other'),
+                # the recipe is modified after its creation
+                RECIPE + "recipe.depends = ['python3']\n"):
+            with open(self.recipe_file, 'w') as fileh:
+                fileh.write(source)
+            assert read_metadata('myrecipe', self.recipe_file) is None
+
+    def get_index(self):
+        index = RecipeIndex(self.ctx, self.filename)
+        metadata = index.get('MyRecipe')
+        index.save()
+        return metadata
+
+    def test_get(self):
+        metadata = self.get_index()
+        assert metadata.name == 'myrecipe'
+        assert ('libffi', 'openssl') in metadata.depends
+        assert metadata.get_opt_depends_in_list(['sdl2']) == []
+        with mock.patch.dict(os.environ, {'VERSION_myrecipe': '2.0'}):
+            assert metadata.version == '2.0'
+        with self.assertRaises(ValueError):
+            RecipeIndex(self.ctx, self.filename).get('notarecipe')
+
+    def test_get_recorded(self):
+        self.get_index()
+        with mock.patch('pythonforandroid.recipeindex.read_metadata') as \
+                m_read_metadata:
+            assert self.get_index().conflicts == ['sdl2']
+            m_read_metadata.assert_not_called()
+        # the recipe is read again once it changes
+        with open(self.recipe_file, 'a') as fileh:
+            fileh.write('\n')
+        with mock.patch('pythonforandroid.recipeindex.read_metadata',
+                        return_value=get_metadata(mock.Mock(
+                            depends=[], conflicts=['kivy'], opt_depends=[],
+                            python_depends=[], site_packages_name=None,
+                            _version='1.0'))):
+            assert self.get_index().conflicts == ['kivy']
+
+    def test_get_imported(self):
+        self.write_recipe('myrecipe', RECIPE.replace(
+            'def prebuild_arch(self, arch)', 'def __init__(self)'))
+        recipe = mock.Mock(
+            depends=['python3'], conflicts=[], opt_depends=['libffi'],
+            python_depends=[], site_packages_name=None, _version=None)
+        with mock.patch('pythonforandroid.recipe.Recipe.get_recipe',
+                        return_value=recipe) as m_get_recipe:
+            assert self.get_index().opt_depends == ['libffi']
+            assert self.get_index().opt_depends == ['libffi']
+            assert m_get_recipe.call_count == 1
+            # imported recipes depend on the other recipes too
+            self.write_recipe('other', RECIPE)
+            self.get_index()
+            assert m_get_recipe.call_count == 2
@@ -0,0 +1,116 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+import sh
+from backports import tempfile
+
+from pythonforandroid import timing
+from pythonforandroid.logger import shprint
+from pythonforandroid.timing import (
+    get_records, summarize, timed, to_trace_events, write_timings,
+)
+
+
+class TestTiming(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(timing, '_records', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_timed(self):
+        with timed('build', recipe='libffi', arch='arm64-v8a'):
+            with timed('make', 'command'):
+                sum(range(100000))
+        with timed('biglink', arch='arm64-v8a'):
+            pass
+        command, build, biglink = get_records()
+        assert command['name'] == 'make'
+        # nested records get the recipe and arch of the enclosing one
+        assert (command['recipe'], command['arch']) == (
+            'libffi', 'arm64-v8a')
+        assert build['wall'] >= command['wall'] > 0
+        assert build['cpu'] > 0
+        assert biglink['recipe'] is None
+
+    def test_timed_thread_id(self):
+        # python < 3.8 has no threading.get_native_id
+        m_threading = mock.Mock(spec=['get_ident'])
+        m_threading.get_ident.return_value = 1234
+        with mock.patch.object(timing, 'threading', m_threading):
+            with timed('build'):
+                pass
+        record, = get_records()
+        assert record['tid'] == 1234
+
+    def test_timed_exception(self):
+        with self.assertRaises(ValueError):
+            with timed('build', recipe='libffi'):
+                raise ValueError()
+        assert [record['name'] for record in get_records()] == ['build']
+        with timed('build'):
+            pass
+        assert get_records()[-1]['recipe'] is None
+
+    def test_shprint(self):
+        shprint(sh.echo, 'hello')
+        record, = get_records()
+        assert record['name'] == 'echo hello'
+        assert record['category'] == 'command'
+
+    def test_summarize(self):
+        for _ in range(2):
+            with timed('build', recipe='libffi', arch='armeabi-v7a'):
+                with timed('make', 'command'):
+                    pass
+        summary = summarize(get_records())
+        assert list(summary) == ['libffi']
+        assert summary['libffi']['armeabi-v7a']['build']['count'] == 2
+
+    def test_write_timings(self):
+        assert write_timings('/nonexistent', 'apk') is None
+        with timed('build', recipe='libffi', arch='armeabi-v7a'):
+            pass
+        with tempfile.TemporaryDirectory() as storage_dir:
+            summary = write_timings(storage_dir, 'apk')
+            assert summary.endswith('-apk.json')
+            with open(summary) as fileh:
+                data = json.load(fileh)
+            assert data['command'] == 'apk'
+            assert data['phases']['libffi']['armeabi-v7a']['build']
+            with open(summary[:-len('.json')] + '.trace.json') as fileh:
+                trace = json.load(fileh)
+            event, = trace['traceEvents']
+            assert event['name'] == 'build libffi'
+            assert event['ph'] == 'X'
+            assert event['pid'] == os.getpid()
+        # the records written are forgotten
+        assert get_records() == []
+
+    def test_write_timings_pruned(self):
+        with tempfile.TemporaryDirectory() as storage_dir:
+            timings_dir = os.path.join(storage_dir, 'timings')
+            os.makedirs(timings_dir)
+            for date in ('20230101-000000', '20230102-000000'):
+                for suffix in ('.json', '.trace.json'):
+                    open(os.path.join(
+                        timings_dir, date + '-apk' + suffix), 'w').close()
+            with timed('gradle'):
+                pass
+            with mock.patch.dict(os.environ, {'P4A_TIMINGS_KEEP': '2'}):
+                summary = write_timings(storage_dir, 'apk')
+            # only the oldest command's timings are deleted
+            assert sorted(os.listdir(timings_dir)) == sorted([
+                '20230102-000000-apk.json', '20230102-000000-apk.trace.json',
+                os.path.basename(summary),
+                os.path.basename(summary)[:-len('.json')] + '.trace.json',
+            ])
+
+    def test_to_trace_events(self):
+        with timed('gradle'):
+            pass
+        event, = to_trace_events(get_records())
+        assert event['name'] == 'gradle'
+        assert event['args'].keys() == {'cpu', 'children_cpu'}
@@ -78,7 +78,9 @@ class TestToolchainCL:
         ) as m_build_recipes, mock.patch(
             'pythonforandroid.bootstraps.service_only.'
             'ServiceOnlyBootstrap.assemble_distribution'
-        ) as m_run_distribute:
+        ) as m_run_distribute, mock.patch(
+            'pythonforandroid.toolchain.write_timings'
+        ) as m_write_timings:
             m_get_available_apis.return_value = [27]
             m_get_toolchain_versions.return_value = (['4.9'], True)
             m_get_ndk_sysroot.return_value = (
@@ -114,6 +116,8 @@ class TestToolchainCL:
             )
         ]
         assert m_run_distribute.call_args_list == [mock.call()]
+        assert m_write_timings.call_args_list == [
+            mock.call(tchain.ctx.storage_dir, 'create')]
 
     @mock.patch(
         'pythonforandroid.build.environ',
@@ -137,8 +141,13 @@ class TestToolchainCL:
         Checks the `recipes` command prints out recipes information without crashing.
         """
         argv = ['toolchain.py', 'recipes']
-        with patch_sys_argv(argv), patch_sys_stdout() as m_stdout:
+        with patch_sys_argv(argv), patch_sys_stdout() as m_stdout, \
+                mock.patch(
+                    'pythonforandroid.toolchain.write_timings'
+                ) as m_write_timings:
             ToolchainCL()
+        # the timings are only written for the commands building something
+        assert m_write_timings.call_args_list == []
         # check if we have common patterns in the output
         expected_strings = (
             'conflicts:',
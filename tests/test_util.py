@@ -3,6 +3,8 @@ import types
 import unittest
 from unittest import mock
 
+from backports import tempfile
+
 from pythonforandroid import util
 
 
@@ -119,6 +121,75 @@ class TestUtil(unittest.TestCase):
 
         self.assertEqual(result, expected_result)
 
+    def test_clone_file(self):
+        """
+        Test method :meth:`~pythonforandroid.util.clone_file`, which should
+        hardlink files when allowed, and copy them otherwise.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source")
+            with open(source, "w") as fileh:
+                fileh.write("content")
+
+            util.clone_file(source, os.path.join(temp_dir, "linked"))
+            self.assertTrue(os.path.samefile(
+                source, os.path.join(temp_dir, "linked")))
+
+            util.clone_file(
+                source, os.path.join(temp_dir, "copied"), hardlink=False)
+            self.assertFalse(os.path.samefile(
+                source, os.path.join(temp_dir, "copied")))
+            with open(os.path.join(temp_dir, "copied")) as fileh:
+                self.assertEqual(fileh.read(), "content")
+
+            # no temporary file is left behind
+            self.assertEqual(
+                sorted(os.listdir(temp_dir)), ["copied", "linked", "source"])
+
+            # an existing target is replaced
+            util.clone_file(source, os.path.join(temp_dir, "copied"))
+            self.assertTrue(os.path.samefile(
+                source, os.path.join(temp_dir, "copied")))
+            self.assertEqual(
+                sorted(os.listdir(temp_dir)), ["copied", "linked", "source"])
+
+    @mock.patch("pythonforandroid.util.link")
+    @mock.patch("pythonforandroid.util.reflink_file")
+    def test_clone_file_fallback(self, mock_reflink_file, mock_link):
+        """
+        :meth:`~pythonforandroid.util.clone_file` falls back to a plain copy
+        when neither hardlinks nor reflinks are supported.
+        """
+        mock_link.side_effect = OSError
+        mock_reflink_file.side_effect = OSError
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source")
+            with open(source, "w") as fileh:
+                fileh.write("content")
+            util.clone_file(source, os.path.join(temp_dir, "target"))
+            with open(os.path.join(temp_dir, "target")) as fileh:
+                self.assertEqual(fileh.read(), "content")
+        self.assertEqual(mock_link.call_count, 1)
+        self.assertEqual(mock_reflink_file.call_count, 1)
+
+    def test_copy_tree(self):
+        """
+        Test method :meth:`~pythonforandroid.util.copy_tree`, making sure
+        that only the top level excluded entries are skipped.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source")
+            os.makedirs(os.path.join(source, ".git"))
+            os.makedirs(os.path.join(source, "doc", ".git"))
+            os.symlink("doc", os.path.join(source, "docs"))
+            target = os.path.join(temp_dir, "target")
+            util.copy_tree(source, target, exclude=(".git",))
+            self.assertEqual(sorted(os.listdir(target)), ["doc", "docs"])
+            self.assertEqual(os.listdir(os.path.join(target, "doc")), [".git"])
+            self.assertEqual(os.readlink(os.path.join(target, "docs")), "doc")
+            # no temporary directory is left behind
+            self.assertEqual(sorted(os.listdir(temp_dir)), ["source", "target"])
+
     def test_util_exceptions(self):
         """
         Test exceptions for a couple of methods: